@@ -656,6 +656,8 @@ def __display_plan(api_inst, verbose, noexecute, op=None):
 
         if DebugValues["plan"] and "solver-errors" not in disp:
                 disp.append("solver-errors")
+        if DebugValues["solver_profile"] and "solver-profile" not in disp:
+                disp.append("solver-profile")
 
         plan = api_inst.describe()
 
@@ -784,6 +786,16 @@ made will not be reflected on the next boot.
                                 first = False
                         logger.info(l)
 
+        if "solver-profile" in disp:
+                profile = plan.get_solver_profile()
+                if profile is not None:
+                        if need_blank:
+                                logger.info("")
+                        need_blank = True
+                        logger.info(_("Solver profile:"))
+                        logger.info(json.dumps(profile, sort_keys=True,
+                            indent=2))
+
         if "fmris" in disp:
                 changed = collections.defaultdict(list)
                 for src, dest in itertools.chain(r, i, c, a):
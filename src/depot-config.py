@@ -96,6 +96,7 @@ status 0
 
 # versions response used when we provide search capability
 DEPOT_VERSIONS_STR = """{0}admin 0
+files 0
 search 0 1
 """.format(DEPOT_FRAGMENT_VERSIONS_STR)
 
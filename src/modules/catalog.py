@@ -32,10 +32,14 @@ import datetime
 import errno
 import fnmatch
 import hashlib
+import itertools
+import mmap
 import os
 import simplejson as json
 import six
 import stat
+import struct
+import tempfile
 import threading
 import types
 
@@ -202,6 +206,372 @@ class _JSONWriter(object):
                         self.__sha_1.update(l)
 
 
+# The binary catalog part format is a compact, memory-mappable encoding of the
+# data in a CatalogPart.  It is always generated from (and stored next to) the
+# JSON catalog part file, which remains the source of truth.  The layout is:
+#
+#     header            _BIN_HEADER
+#     publishers        npubs * uint32 (string index), in catalog order
+#     string offsets    (nstrings + 1) * uint64 (relative to string data)
+#     string data       UTF-8 encoded publishers, stems, and versions
+#     stems             nstems * _BIN_STEM, sorted by stem, then publisher
+#     entries           nentries * _BIN_ENTRY, in catalog order for each stem
+#     entry data        JSON encoded catalog entries (without version)
+#
+# All values are stored little-endian.  The header also records the signature
+# of the JSON catalog part it was generated from along with its size, mtime,
+# and last modification time (as recorded in the catalog attributes) so that
+# stale binary parts can be detected and ignored.
+_BIN_MAGIC = b"pkg5bcp\0"
+_BIN_VERSION = 1
+_BIN_HEADER = struct.Struct("<8sHHIIIIQQQQQ40sQqq")
+_BIN_STEM = struct.Struct("<IIII")
+_BIN_ENTRY = struct.Struct("<IQI")
+_BIN_OFFSET = struct.Struct("<Q")
+_BIN_INDEX = struct.Struct("<I")
+
+
+class _BinaryWriter(object):
+        """Private helper class used to serialize catalog part data in the
+        binary catalog part format (see BinaryCatalogPart)."""
+
+        # The file mode to be used for binary catalog part files.
+        __file_mode = stat.S_IRUSR|stat.S_IWUSR|stat.S_IRGRP|stat.S_IROTH
+
+        def __init__(self, data, pathname, src_pathname, signatures=None,
+            last_modified=None, sort_keys=False):
+                self.__data = data
+                self.__last_modified = last_modified
+                self.__signatures = signatures or {}
+                self.__sort_keys = sort_keys
+                self.__src_pathname = src_pathname
+                self.pathname = pathname
+
+        def save(self):
+                """Encodes and stores the provided data in the binary catalog
+                part format."""
+
+                strings = []
+                sindex = {}
+
+                def intern(s):
+                        idx = sindex.get(s)
+                        if idx is None:
+                                idx = sindex[s] = len(strings)
+                                strings.append(misc.force_bytes(s))
+                        return idx
+
+                # Any entries starting with "_" are part of the reserved
+                # catalog namespace.  Publishers are stored in the same order
+                # as the JSON catalog part.
+                pubs = [p for p in self.__data if not p[0] == "_"]
+                if self.__sort_keys:
+                        pubs.sort()
+                pub_idxs = [intern(p) for p in pubs]
+
+                # Stems are sorted by their encoded form so that readers can
+                # perform a binary search on the mapped data; for each stem,
+                # publishers retain their catalog order.
+                stems = sorted(
+                    (misc.force_bytes(stem), porder, stem)
+                    for porder, pub in enumerate(pubs)
+                    for stem in self.__data[pub]
+                )
+
+                stem_recs = []
+                entry_recs = []
+                blobs = []
+                blob_off = 0
+                for bstem, porder, stem in stems:
+                        ver_list = self.__data[pubs[porder]][stem]
+                        stem_recs.append(_BIN_STEM.pack(intern(stem),
+                            pub_idxs[porder], len(entry_recs), len(ver_list)))
+                        for entry in ver_list:
+                                mdata = dict(
+                                    (k, v)
+                                    for k, v in six.iteritems(entry)
+                                    if k != "version"
+                                )
+                                blob = b""
+                                if mdata:
+                                        blob = misc.force_bytes(json.dumps(
+                                            mdata, separators=(",", ":")))
+                                entry_recs.append(_BIN_ENTRY.pack(
+                                    intern(entry["version"]), blob_off,
+                                    len(blob)))
+                                blobs.append(blob)
+                                blob_off += len(blob)
+
+                str_offsets = []
+                str_off = 0
+                for s in strings:
+                        str_offsets.append(_BIN_OFFSET.pack(str_off))
+                        str_off += len(s)
+                str_offsets.append(_BIN_OFFSET.pack(str_off))
+
+                pubs_off = _BIN_HEADER.size
+                strs_off = pubs_off + _BIN_INDEX.size * len(pub_idxs)
+                stems_off = strs_off + _BIN_OFFSET.size * len(str_offsets) + \
+                    str_off
+                entries_off = stems_off + _BIN_STEM.size * len(stem_recs)
+                blobs_off = entries_off + _BIN_ENTRY.size * len(entry_recs)
+
+                sig = misc.force_bytes(self.__signatures.get("sha-1", ""))
+                st = os.stat(self.__src_pathname)
+                header = _BIN_HEADER.pack(_BIN_MAGIC, _BIN_VERSION, 0,
+                    len(pub_idxs), len(strings), len(stem_recs),
+                    len(entry_recs), pubs_off, strs_off, stems_off,
+                    entries_off, blobs_off, sig, st.st_size,
+                    int(st.st_mtime), _datetime_to_usecs(self.__last_modified))
+
+                # The binary part is written to a temporary file first and
+                # then moved into place so that consumers that have the
+                # previous version mapped are unaffected.
+                dest_dir = os.path.dirname(self.pathname)
+                try:
+                        fd, tpath = tempfile.mkstemp(dir=dest_dir,
+                            prefix=os.path.basename(self.pathname) + ".")
+                        with os.fdopen(fd, "wb") as tfile:
+                                tfile.write(header)
+                                tfile.writelines(_BIN_INDEX.pack(i)
+                                    for i in pub_idxs)
+                                tfile.writelines(str_offsets)
+                                tfile.writelines(strings)
+                                tfile.writelines(stem_recs)
+                                tfile.writelines(entry_recs)
+                                tfile.writelines(blobs)
+                        os.chmod(tpath, self.__file_mode)
+                        portable.rename(tpath, self.pathname)
+                except EnvironmentError as e:
+                        if e.errno == errno.EACCES:
+                                raise api_errors.PermissionsException(
+                                    e.filename)
+                        if e.errno == errno.EROFS:
+                                raise api_errors.ReadOnlyFileSystemException(
+                                    e.filename)
+                        raise
+
+
+class BinaryCatalogPart(object):
+        """A BinaryCatalogPart object provides read-only access to the binary
+        encoding of a CatalogPart that is generated by Catalog.save() when
+        binary parts are enabled.  The file is memory-mapped and entries are
+        only decoded as they are requested, so queries do not require the
+        entire catalog part to be loaded.
+
+        The JSON catalog part always remains the source of truth; callers
+        should use matches() to verify that a BinaryCatalogPart corresponds
+        to the current JSON catalog part before using it."""
+
+        # The suffix appended to the pathname of a catalog part to determine
+        # the pathname of its binary encoding.
+        SUFFIX = ".bin"
+
+        def __init__(self, pathname, file_root=None):
+                """Opens and maps the binary catalog part at 'pathname'.
+
+                'file_root' is an optional directory that 'pathname' must
+                reside in.
+
+                Raises InvalidCatalogFile if the file is not a binary catalog
+                part this version of the API can use."""
+
+                self.pathname = pathname
+
+                fobj = misc.open_image_file(file_root or
+                    os.path.dirname(pathname), pathname, os.O_RDONLY,
+                    misc.PKG_FILE_MODE)
+                try:
+                        self.__map = mmap.mmap(fobj.fileno(), 0,
+                            access=mmap.ACCESS_READ)
+                except (EnvironmentError, ValueError):
+                        # Empty or unmappable file.
+                        raise api_errors.InvalidCatalogFile(pathname)
+                finally:
+                        fobj.close()
+
+                try:
+                        (magic, version, flags, self.__npubs, nstrings,
+                            self.__nstems, self.__nentries, self.__pubs_off,
+                            self.__strs_off, self.__stems_off,
+                            self.__entries_off, self.__blobs_off, sig,
+                            self.__src_size, self.__src_mtime,
+                            self.__src_lm) = _BIN_HEADER.unpack_from(
+                            self.__map, 0)
+                except struct.error:
+                        raise api_errors.InvalidCatalogFile(pathname)
+                if magic != _BIN_MAGIC or version != _BIN_VERSION or \
+                    len(self.__map) < self.__blobs_off:
+                        raise api_errors.InvalidCatalogFile(pathname)
+
+                self.__strdata_off = self.__strs_off + \
+                    _BIN_OFFSET.size * (nstrings + 1)
+                self.__signatures = {}
+                sig = misc.force_text(sig.rstrip(b"\0"))
+                if sig:
+                        self.__signatures["sha-1"] = sig
+
+        def __bytes(self, idx):
+                """Returns the encoded form of the string at index 'idx'."""
+
+                start, = _BIN_OFFSET.unpack_from(self.__map,
+                    self.__strs_off + _BIN_OFFSET.size * idx)
+                end, = _BIN_OFFSET.unpack_from(self.__map,
+                    self.__strs_off + _BIN_OFFSET.size * (idx + 1))
+                return self.__map[self.__strdata_off + start:
+                    self.__strdata_off + end]
+
+        def __string(self, idx):
+                return misc.force_text(self.__bytes(idx))
+
+        def __stem_range(self, stem):
+                """Returns a tuple of (first, last) stem record indices for
+                the given stem; first == last if the stem is not present."""
+
+                bstem = misc.force_bytes(stem)
+                lo, hi = 0, self.__nstems
+                while lo < hi:
+                        mid = (lo + hi) // 2
+                        if self.__stem_bytes(mid) < bstem:
+                                lo = mid + 1
+                        else:
+                                hi = mid
+                first = lo
+                hi = self.__nstems
+                while lo < hi:
+                        mid = (lo + hi) // 2
+                        if self.__stem_bytes(mid) <= bstem:
+                                lo = mid + 1
+                        else:
+                                hi = mid
+                return first, lo
+
+        def __stem(self, ridx):
+                """Returns a tuple of (stem string index, publisher string
+                index, first entry index, entry count) for the stem record at
+                index 'ridx'."""
+
+                return _BIN_STEM.unpack_from(self.__map,
+                    self.__stems_off + _BIN_STEM.size * ridx)
+
+        def __stem_bytes(self, ridx):
+                return self.__bytes(self.__stem(ridx)[0])
+
+        def __entry(self, eidx):
+                """Returns the catalog entry at index 'eidx'."""
+
+                vidx, off, length = _BIN_ENTRY.unpack_from(self.__map,
+                    self.__entries_off + _BIN_ENTRY.size * eidx)
+                if length:
+                        start = self.__blobs_off + off
+                        entry = json.loads(misc.force_text(
+                            self.__map[start:start + length]))
+                else:
+                        entry = {}
+                entry["version"] = self.__string(vidx)
+                return entry
+
+        def __version(self, eidx):
+                vidx, = _BIN_INDEX.unpack_from(self.__map,
+                    self.__entries_off + _BIN_ENTRY.size * eidx)
+                return self.__string(vidx)
+
+        def get_entry(self, pub, stem, ver):
+                """Returns the catalog entry for the given FMRI components or
+                None if it does not exist.  Only the entry requested is
+                decoded."""
+
+                first, last = self.__stem_range(stem)
+                for ridx in range(first, last):
+                        sidx, pidx, eidx, count = self.__stem(ridx)
+                        if self.__string(pidx) != pub:
+                                continue
+                        for i in range(eidx, eidx + count):
+                                if self.__version(i) == ver:
+                                        return self.__entry(i)
+                        return
+
+        def matches(self, src_pathname, signatures=None, last_modified=None):
+                """Returns a boolean value indicating whether this binary
+                catalog part was generated from the current contents of the
+                JSON catalog part at 'src_pathname'.
+
+                'signatures' is an optional dict of the signatures expected
+                for the JSON catalog part (such as those stored in the
+                catalog attributes).
+
+                'last_modified' is an optional UTC datetime object of the
+                last modification time expected for the JSON catalog part
+                (such as the one stored in the catalog attributes)."""
+
+                try:
+                        st = os.stat(src_pathname)
+                except EnvironmentError:
+                        return False
+                if st.st_size != self.__src_size or \
+                    int(st.st_mtime) != self.__src_mtime:
+                        return False
+
+                if last_modified is not None and \
+                    _datetime_to_usecs(last_modified) != self.__src_lm:
+                        return False
+
+                if signatures and "sha-1" in signatures and \
+                    signatures["sha-1"] != self.__signatures.get("sha-1"):
+                        return False
+                return True
+
+        def publishers(self, pubs=EmptyI):
+                """A generator function that returns publisher prefixes in
+                catalog order.
+
+                'pubs' is an optional list that contains the prefixes of the
+                publishers to restrict the results to."""
+
+                for i in range(self.__npubs):
+                        pidx, = _BIN_INDEX.unpack_from(self.__map,
+                            self.__pubs_off + _BIN_INDEX.size * i)
+                        pub = self.__string(pidx)
+                        if not pubs or pub in pubs:
+                                yield pub
+
+        def stem_entries(self, stem, pubs=EmptyI):
+                """A generator function that produces tuples of the form (pub,
+                entries) for the given stem, where 'entries' is the list of
+                catalog entries for the stem from that publisher in catalog
+                order.  Results are in catalog publisher order.
+
+                'pubs' is an optional list of publisher prefixes to restrict
+                the results to."""
+
+                first, last = self.__stem_range(stem)
+                for ridx in range(first, last):
+                        sidx, pidx, eidx, count = self.__stem(ridx)
+                        pub = self.__string(pidx)
+                        if pubs and pub not in pubs:
+                                continue
+                        yield pub, [
+                            self.__entry(i)
+                            for i in range(eidx, eidx + count)
+                        ]
+
+        @property
+        def package_count(self):
+                """The number of unique (per-publisher) packages."""
+                return self.__nstems
+
+        @property
+        def package_version_count(self):
+                """The number of unique (per-publisher) package versions."""
+                return self.__nentries
+
+        @property
+        def signatures(self):
+                """A dict of the signatures of the JSON catalog part the binary
+                catalog part was generated from."""
+                return self.__signatures
+
+
 class CatalogPartBase(object):
         """A CatalogPartBase object is an abstract class containing core
         functionality shared between CatalogPart and CatalogAttrs."""
@@ -399,14 +769,21 @@ class CatalogPart(CatalogPartBase):
         """A CatalogPart object is the representation of a subset of the package
         FMRIs available from a package repository."""
 
+        __binary_part = None
         __data = None
+        binary = False
         ordered = None
 
         def __init__(self, name, meta_root=None, ordered=True, sign=True,
-            file_root=None):
-                """Initializes a CatalogPart object."""
+            file_root=None, binary=False):
+                """Initializes a CatalogPart object.
+
+                'binary' is an optional boolean value indicating whether the
+                binary encoding of the catalog part (see BinaryCatalogPart)
+                should be stored alongside the catalog part when saved."""
 
                 self.__data = {}
+                self.binary = binary
                 self.ordered = ordered
                 if not name.startswith("catalog."):
                         raise api_errors.UnrecognizedCatalogPart(name)
@@ -459,6 +836,29 @@ class CatalogPart(CatalogPartBase):
                     for entry in self.__data[pub][stem]
                 )
 
+        def __stem_entries(self, name, pubs=EmptyI):
+                """A generator function that produces tuples of the form
+                (pub, entries) for the package stem 'name', where entries is
+                the list of catalog entries for the stem from that publisher.
+                If the catalog part hasn't been loaded and a binary encoding
+                of it is available, only the entries for the stem are
+                decoded; otherwise, the catalog part is loaded.
+
+                'pubs' is an optional list of publisher prefixes to restrict
+                the results to."""
+
+                if not self.loaded and self.__binary_part is not None:
+                        for pub, ver_list in self.__binary_part.stem_entries(
+                            name, pubs=pubs):
+                                yield pub, ver_list
+                        return
+
+                self.load()
+                for pub in self.publishers(pubs=pubs):
+                        ver_list = self.__data[pub].get(name, None)
+                        if ver_list:
+                                yield pub, ver_list
+
         def add(self, pfmri=None, metadata=None, op_time=None, pub=None,
             stem=None, ver=None):
                 """Add a catalog entry for a given FMRI or FMRI components.
@@ -515,6 +915,19 @@ class CatalogPart(CatalogPartBase):
                 discards all content."""
 
                 self.__data = {}
+                self.__binary_part = None
+                bpath = self.binary_pathname
+                if bpath and os.path.exists(bpath):
+                        try:
+                                portable.remove(bpath)
+                        except EnvironmentError as e:
+                                if e.errno == errno.EACCES:
+                                        raise api_errors.PermissionsException(
+                                            e.filename)
+                                if e.errno == errno.EROFS:
+                                        raise api_errors.ReadOnlyFileSystemException(
+                                            e.filename)
+                                raise
                 return CatalogPartBase.destroy(self)
 
         def entries(self, cb=None, last=False, ordered=False, pubs=EmptyI):
@@ -564,12 +977,9 @@ class CatalogPart(CatalogPartBase):
                 'pubs' is an optional list of publisher prefixes to restrict
                 the results to."""
 
-                self.load()
-
                 versions = {}
                 entries = {}
-                for pub in self.publishers(pubs=pubs):
-                        ver_list = self.__data[pub].get(name, ())
+                for pub, ver_list in self.__stem_entries(name, pubs=pubs):
                         for entry in ver_list:
                                 sver = entry["version"]
                                 pfmri = fmri.PkgFmri(name=name, publisher=pub,
@@ -628,15 +1038,9 @@ class CatalogPart(CatalogPartBase):
                 'pubs' is an optional list of publisher prefixes to restrict
                 the results to."""
 
-                self.load()
-
                 versions = {}
                 entries = {}
-                for pub in self.publishers(pubs=pubs):
-                        ver_list = self.__data[pub].get(name, None)
-                        if not ver_list:
-                                continue
-
+                for pub, ver_list in self.__stem_entries(name, pubs=pubs):
                         for entry in ver_list:
                                 sver = entry["version"]
                                 pfmri = fmri.PkgFmri(name=name, publisher=pub,
@@ -657,15 +1061,20 @@ class CatalogPart(CatalogPartBase):
                 if pfmri and not pfmri.publisher:
                         raise api_errors.AnarchicalCatalogFMRI(str(pfmri))
 
+                if pfmri:
+                        pub, stem, ver = pfmri.tuple()
+                        ver = str(ver)
+
                 # Since this is a hot path, this function checks for loaded
                 # status before attempting to call the load function.
                 if not self.loaded:
+                        if self.__binary_part is not None:
+                                # Only the requested entry needs to be
+                                # decoded.
+                                return self.__binary_part.get_entry(pub, stem,
+                                    ver)
                         self.load()
 
-                if pfmri:
-                        pub, stem, ver = pfmri.tuple()
-                        ver = str(ver)
-
                 pkg_list = self.__data.get(pub, None)
                 if not pkg_list:
                         return
@@ -719,6 +1128,54 @@ class CatalogPart(CatalogPartBase):
                         return
                 self.__data = CatalogPartBase.load(self)
 
+        @property
+        def binary_part(self):
+                """The BinaryCatalogPart opened by open_binary() or None if
+                one is not available."""
+
+                return self.__binary_part
+
+        @property
+        def binary_pathname(self):
+                """The absolute path of the file used to store the binary
+                encoding of this part or None if meta_root or name is not
+                set."""
+
+                if not self.pathname:
+                        return None
+                return self.pathname + BinaryCatalogPart.SUFFIX
+
+        def open_binary(self, signatures=None, last_modified=None):
+                """Opens the binary encoding of the catalog part if it exists
+                and was generated from the current JSON catalog part, making
+                it available as 'binary_part'.  Returns the BinaryCatalogPart
+                or None if one could not be used.
+
+                'signatures' is an optional dict of the signatures expected
+                for the catalog part.
+
+                'last_modified' is an optional UTC datetime object of the last
+                modification time expected for the catalog part."""
+
+                self.__binary_part = None
+                bpath = self.binary_pathname
+                if not bpath:
+                        return None
+
+                try:
+                        bpart = BinaryCatalogPart(bpath,
+                            file_root=self.file_root)
+                except (EnvironmentError, api_errors.ApiException):
+                        # Binary part doesn't exist, isn't accessible,
+                        # or is unusable; the JSON part will be used.
+                        return None
+
+                if not bpart.matches(self.pathname, signatures=signatures,
+                    last_modified=last_modified):
+                        return None
+                self.__binary_part = bpart
+                return bpart
+
         def names(self, pubs=EmptyI):
                 """Returns a set containing the names of all the packages in
                 the CatalogPart.
@@ -836,6 +1293,15 @@ class CatalogPart(CatalogPartBase):
 
                 CatalogPartBase.save(self, self.__data, single_pass=single_pass)
 
+                # Any previously opened binary part no longer reflects the
+                # stored data.
+                self.__binary_part = None
+                if self.binary:
+                        _BinaryWriter(self.__data, self.binary_pathname,
+                            self.pathname, signatures=self.signatures,
+                            last_modified=self.last_modified,
+                            sort_keys=self.sign).save()
+
         def sort(self, pfmris=None, pubs=None):
                 """Re-sorts the contents of the CatalogPart such that version
                 entries for each package stem are in ascending order.
@@ -1180,6 +1646,11 @@ class CatalogAttrs(CatalogPartBase):
         def __get_updates(self):
                 return self.__data["updates"]
 
+        def __get_deltas(self):
+                # Optional element; catalogs written by older versions of
+                # this module don't have it.
+                return self.__data.get("deltas", EmptyDict)
+
         def __get_version(self):
                 return self.__data["version"]
 
@@ -1207,6 +1678,13 @@ class CatalogAttrs(CatalogPartBase):
                 self.__data["updates"] = value
                 self.signatures = {}
 
+        def __set_deltas(self, value):
+                if value:
+                        self.__data["deltas"] = value
+                else:
+                        self.__data.pop("deltas", None)
+                self.signatures = {}
+
         def __set_version(self, value):
                 self.__data["version"] = value
                 self.signatures = {}
@@ -1224,7 +1702,7 @@ class CatalogAttrs(CatalogPartBase):
                                 struct[key] = datetime_to_basic_ts(val)
                                 continue
 
-                        if key in ("parts", "updates"):
+                        if key in ("parts", "updates", "deltas"):
                                 for e in val:
                                         lm = val[e].get("last-modified", None)
                                         if lm:
@@ -1262,14 +1740,14 @@ class CatalogAttrs(CatalogPartBase):
                                         struct[key] = cat_ts_to_datetime(val)
                                 continue
 
-                        if key in ("parts", "updates"):
+                        if key in ("parts", "updates", "deltas"):
                                 if type(val) != dict:
                                         raise api_errors.InvalidCatalogFile(
                                             location)
 
-                                # 'parts' and 'updates' have a more complex
-                                # structure.  Check that all of the subparts
-                                # look sane.
+                                # 'parts', 'updates', and 'deltas' have a more
+                                # complex structure.  Check that all of the
+                                # subparts look sane.
                                 for subpart in val:
                                         if subpart != os.path.basename(subpart):
                                                 raise api_errors.\
@@ -1348,6 +1826,10 @@ class CatalogAttrs(CatalogPartBase):
 
         updates = property(__get_updates, __set_updates)
 
+        deltas = property(__get_deltas, __set_deltas, doc="A dict of the "
+            "update logs that each combine the operations recorded by the "
+            "update logs for a range of hours.")
+
         version = property(__get_version, __set_version)
 
 
@@ -1382,7 +1864,7 @@ class Catalog(object):
         DEPENDENCY, SUMMARY = range(2)
 
         def __init__(self, batch_mode=False, meta_root=None, log_updates=False,
-            read_only=False, sign=True, file_root=None):
+            read_only=False, sign=True, file_root=None, binary_parts=False):
                 """Initializes a Catalog object.
 
                 'batch_mode' is an optional boolean value that indicates that
@@ -1413,9 +1895,16 @@ class Catalog(object):
                 the catalog data should have signature data generated and
                 embedded when serialized.  This option is primarily a matter
                 of convenience for callers that wish to trade integrity checks
-                for improved catalog serialization performance."""
+                for improved catalog serialization performance.
+
+                'binary_parts' is an optional boolean value that indicates
+                that a binary, memory-mappable encoding of each catalog part
+                (see BinaryCatalogPart) should be stored alongside it when the
+                catalog is saved, and used for queries when it matches the
+                catalog part on-disk."""
 
                 self.__batch_mode = batch_mode
+                self.binary_parts = binary_parts
                 self.__parts = {}
                 self.__updates = {}
 
@@ -1576,6 +2065,12 @@ class Catalog(object):
                                         continue
                                 parts.append(part)
 
+                # Every entry of the other parts will be examined, so load
+                # them once instead of decoding each entry from the binary
+                # encoding separately.
+                for part in parts:
+                        part.load()
+
                 def merge_entry(src, dest):
                         for k, v in six.iteritems(src):
                                 if k == "actions":
@@ -1865,6 +2360,82 @@ class Catalog(object):
                                 error = e
                         yield (pat, error, npat, matcher)
 
+        def __compact_updates(self):
+                """Private helper function that combines the update logs for
+                each complete day and week into deltas so that clients that
+                haven't been updated recently can catch up using fewer
+                requests.  The update logs themselves are retained for use by
+                older clients.  Caller is responsible for locking the
+                catalog."""
+
+                attrs = self._attrs
+                if not attrs.updates or not attrs.last_modified:
+                        return
+
+                # Days are only complete once an operation has been logged on
+                # a later day.
+                today = attrs.last_modified.date()
+                week_len = datetime.timedelta(days=6)
+
+                periods = {}
+                for name in attrs.updates:
+                        ts = _update_range(name)[0]
+                        day = datetime.date(int(ts[0:4]), int(ts[4:6]),
+                            int(ts[6:8]))
+                        if day >= today:
+                                continue
+
+                        # The last component of the update name is the locale.
+                        locale = name.split(".", 2)[2]
+                        periods.setdefault((locale, day, day), []).append(name)
+
+                        week = day - datetime.timedelta(days=day.weekday())
+                        if week + week_len < today:
+                                periods.setdefault((locale, week,
+                                    week + week_len), []).append(name)
+
+                deltas = dict(attrs.deltas)
+                for (locale, first, last), names in six.iteritems(periods):
+                        days = set(_update_range(n)[0][:8] for n in names)
+                        if len(names) < 2 or (first != last and len(days) < 2):
+                                # The delta wouldn't save any requests.
+                                continue
+
+                        lm = max(attrs.updates[n]["last-modified"]
+                            for n in names)
+                        dname = "update.{0}T00Z-{1}T23Z.{2}".format(
+                            first.strftime("%Y%m%d"), last.strftime("%Y%m%d"),
+                            locale)
+                        if dname in deltas and \
+                            deltas[dname]["last-modified"] == lm:
+                                # Already up to date.
+                                continue
+
+                        delta = CatalogUpdate(dname, meta_root=self.meta_root,
+                            sign=self.__sign)
+                        if delta.exists:
+                                delta.destroy()
+                                delta = CatalogUpdate(dname,
+                                    meta_root=self.meta_root, sign=self.__sign)
+
+                        # Update logs are named so that they sort in
+                        # chronological order.
+                        for name in sorted(names):
+                                ulog = self.__get_update(name, cache=False)
+                                for pfmri, op_type, op_time, mdata in \
+                                    ulog.updates():
+                                        delta.add(pfmri, op_type, op_time,
+                                            metadata=mdata)
+                        delta.last_modified = lm
+                        delta.save()
+
+                        entry = deltas[dname] = {
+                            "last-modified": lm
+                        }
+                        for n, v in six.iteritems(delta.signatures):
+                                entry["signature-{0}".format(n)] = v
+                attrs.deltas = deltas
+
         def __save(self):
                 """Private save function.  Caller is responsible for locking
                 the catalog."""
@@ -1882,6 +2453,9 @@ class Catalog(object):
                                 for n, v in six.iteritems(ulog.signatures):
                                         entry["signature-{0}".format(n)] = v
 
+                        if self.meta_root:
+                                self.__compact_updates()
+
                 # Save any CatalogParts that are currently in-memory,
                 # updating their related information in catalog.attrs
                 # as they are saved.
@@ -1960,6 +2534,7 @@ class Catalog(object):
                 files = [self._attrs.name]
                 files.extend(self._attrs.parts.keys())
                 files.extend(self._attrs.updates.keys())
+                files.extend(self._attrs.deltas.keys())
 
                 # Force file_mode, so that unprivileged users can read these.
                 bad_modes = []
@@ -2363,7 +2938,8 @@ class Catalog(object):
                         part = self.get_part(name)
                         part.destroy()
 
-                for name in self._attrs.updates:
+                for name in itertools.chain(self._attrs.updates,
+                    self._attrs.deltas):
                         ulog = self.__get_update(name, cache=False)
                         ulog.destroy()
 
@@ -3382,7 +3958,7 @@ class Catalog(object):
                 # for it and add it to catalog attributes.
                 part = CatalogPart(name, meta_root=self.meta_root,
                     ordered=not self.__batch_mode, sign=self.__sign,
-                    file_root=self.file_root)
+                    file_root=self.file_root, binary=self.binary_parts)
                 if must_exist and self.meta_root and not part.exists:
                         # This is a double-check for the client case where
                         # there is a part that is known to the catalog but
@@ -3392,6 +3968,13 @@ class Catalog(object):
 
                 self.__parts[name] = part
 
+                if self.binary_parts and name in aparts and not part.loaded:
+                        # The binary encoding is only used if it matches the
+                        # part as described by the catalog attributes.
+                        mdata = aparts[name]
+                        part.open_binary(signatures=_get_sigs(mdata),
+                            last_modified=mdata.get("last-modified"))
+
                 if name not in aparts:
                         # Add a new entry to the catalog attributes for this new
                         # part since it didn't exist previously.
@@ -3407,7 +3990,10 @@ class Catalog(object):
                 A value of None will be returned if the the catalog has
                 not been modified, while an empty list will be returned
                 if no catalog parts need to be updated, but the catalog
-                itself has changed."""
+                itself has changed.  Where the catalog offers deltas that
+                combine the update logs for a range of time, they are used
+                instead of those update logs to minimize the number of files
+                needed."""
 
                 new_attrs = CatalogAttrs(meta_root=path)
                 if not new_attrs.exists:
@@ -3453,7 +4039,8 @@ class Catalog(object):
                         logdate = datetime_to_update_ts(old_lm)
                         logname = "update.{0}.{1}".format(logdate, locale)
 
-                        if logname not in new_attrs.updates:
+                        if logname not in new_attrs.updates and \
+                            not self.__get_deltas(new_attrs, locale, logdate):
                                 incremental = False
 
                         parts.setdefault(locale, set())
@@ -3519,6 +4106,7 @@ class Catalog(object):
                                 if not last_lm or lm > last_lm:
                                         last_lm = lm
 
+                        needed = set()
                         for name, uattrs in six.iteritems(new_attrs.updates):
                                 up_lm = uattrs["last-modified"]
 
@@ -3540,11 +4128,58 @@ class Catalog(object):
                                 # newest catalog part for this locale, then
                                 # it is needed to update one or more catalog
                                 # parts for this locale.
-                                updates.add(name)
+                                needed.add(name)
+
+                        updates.update(self.__cover_updates(new_attrs, locale,
+                            needed))
 
                 # Ensure updates are in chronological ascending order.
                 return sorted(updates)
 
+        @staticmethod
+        def __get_deltas(attrs, locale, ts):
+                """Returns a list of tuples of the form (last, name) for each
+                delta offered by the catalog attributes 'attrs' for 'locale'
+                that includes the hour indicated by the update timestamp 'ts',
+                where 'last' is the timestamp of the last hour it includes."""
+
+                deltas = []
+                for name in attrs.deltas:
+                        if name.split(".", 2)[2] != locale:
+                                continue
+                        first, last = _update_range(name)
+                        if first <= ts <= last:
+                                deltas.append((last, name))
+                return deltas
+
+        def __cover_updates(self, attrs, locale, names):
+                """Returns the smallest set of update logs and deltas offered
+                by the catalog attributes 'attrs' for 'locale' that together
+                include all of the operations recorded by the update logs
+                named in 'names'.
+
+                Deltas may also include operations older than those needed,
+                but apply_updates() skips those for each catalog part based
+                on when it was last modified."""
+
+                # Update timestamps sort in chronological order.
+                pending = sorted((_update_range(n)[0], n) for n in names)
+                updates = set()
+                while pending:
+                        ts, name = pending[0]
+                        deltas = self.__get_deltas(attrs, locale, ts)
+                        if not deltas:
+                                updates.add(name)
+                                pending.pop(0)
+                                continue
+
+                        # Use the delta that covers the most of the remaining
+                        # hours.
+                        last, dname = max(deltas)
+                        updates.add(dname)
+                        pending = [e for e in pending if e[0] > last]
+                return updates
+
         def names(self, pubs=EmptyI):
                 """Returns a set containing the names of all the packages in
                 the Catalog.
@@ -3794,8 +4429,10 @@ class Catalog(object):
                                     version=ver)
                         raise api_errors.UnknownCatalogEntry(pfmri.get_fmri())
 
-                # get_entry returns the actual catalog entry, so updating it
-                # simply requires reassignment.
+                # get_entry returns the actual catalog entry once the part
+                # has been loaded (instead of a decoded copy from its binary
+                # encoding), so updating it simply requires reassignment.
+                base.load()
                 entry = base.get_entry(pfmri=pfmri, pub=pub, stem=stem, ver=ver)
                 if entry is None:
                         if not pfmri:
@@ -3823,34 +4460,23 @@ class Catalog(object):
 
                 self._attrs.validate(require_signatures=require_signatures)
 
-                def get_sigs(mdata):
-                        sigs = {}
-                        for key in mdata:
-                                if not key.startswith("signature-"):
-                                        continue
-                                sig = key.split("signature-")[1]
-                                sigs[sig] = mdata[key]
-                        if not sigs:
-                                # Allow validate() to perform its own fallback
-                                # logic if signature data isn't available.
-                                return None
-                        return sigs
-
                 for name, mdata in six.iteritems(self._attrs.parts):
                         part = self.get_part(name, must_exist=True)
                         if part is None:
                                 # Part does not exist; no validation needed.
                                 continue
-                        part.validate(signatures=get_sigs(mdata),
+                        part.validate(signatures=_get_sigs(mdata),
                             require_signatures=require_signatures)
 
-                for name, mdata in six.iteritems(self._attrs.updates):
+                for name, mdata in itertools.chain(
+                    six.iteritems(self._attrs.updates),
+                    six.iteritems(self._attrs.deltas)):
                         ulog = self.__get_update(name, cache=False,
                             must_exist=True)
                         if ulog is None:
                                 # Update does not exist; no validation needed.
                                 continue
-                        ulog.validate(signatures=get_sigs(mdata),
+                        ulog.validate(signatures=_get_sigs(mdata),
                             require_signatures=require_signatures)
 
         batch_mode = property(__get_batch_mode, __set_batch_mode)
@@ -3889,6 +4515,39 @@ def verify(filename):
         catobj.validate(require_signatures=True)
 
 # Methods used by Catalog classes.
+def _get_sigs(mdata):
+        """Returns a dict of the signatures found in the catalog attributes
+        entry 'mdata' for a catalog part or update log, or None if signature
+        data isn't available."""
+
+        sigs = {}
+        for key in mdata:
+                if not key.startswith("signature-"):
+                        continue
+                sig = key.split("signature-")[1]
+                sigs[sig] = mdata[key]
+        if not sigs:
+                # Allow validate() to perform its own fallback logic if
+                # signature data isn't available.
+                return None
+        return sigs
+
+def _update_range(name):
+        """Returns a tuple of the form (first, last) containing the update
+        timestamps (see datetime_to_update_ts) of the first and last hours
+        whose operations are recorded by the update log or delta 'name'."""
+
+        first, sep, last = name.split(".", 2)[1].partition("-")
+        return first, last or first
+
+def _datetime_to_usecs(dt):
+        """Returns the number of microseconds since the epoch for the UTC
+        datetime object 'dt', or zero if 'dt' is None."""
+
+        if dt is None:
+                return 0
+        return calendar.timegm(dt.utctimetuple()) * 1000000 + dt.microsecond
+
 def datetime_to_ts(dt):
         """Take datetime object dt, and convert it to a ts in ISO-8601
         format. """
@@ -114,6 +114,10 @@ class GlobalSettings(object):
                 # Maximum number of transient errors before we abort an
                 # endpoint.
                 self.pkg_client_max_consecutive_error_default = 4
+                # Default number of publishers to refresh in parallel.
+                self.pkg_client_refresh_concurrency_default = 1
+                # Whether HTTP/2 is negotiated with repositories by default.
+                self.pkg_client_http2_default = 0
 
                 # The location within the image of the cache for pkg.sysrepo(8)
                 self.sysrepo_pub_cache_path = \
@@ -163,6 +167,25 @@ class GlobalSettings(object):
                 except ValueError:
                         self.PKG_CLIENT_MAX_REDIRECT = \
                             self.pkg_client_max_redirect_default
+                try:
+                        # Number of publishers to refresh in parallel; 0 or
+                        # a negative number means all of them.
+                        self.PKG_CLIENT_REFRESH_CONCURRENCY = int(
+                            os.environ.get("PKG_CLIENT_REFRESH_CONCURRENCY",
+                            self.pkg_client_refresh_concurrency_default))
+                except ValueError:
+                        self.PKG_CLIENT_REFRESH_CONCURRENCY = \
+                            self.pkg_client_refresh_concurrency_default
+                try:
+                        # Whether to negotiate HTTP/2 with repositories so
+                        # that requests can be multiplexed over a few
+                        # connections.
+                        self.PKG_CLIENT_HTTP2 = bool(int(
+                            os.environ.get("PKG_CLIENT_HTTP2",
+                            self.pkg_client_http2_default)))
+                except ValueError:
+                        self.PKG_CLIENT_HTTP2 = \
+                            bool(self.pkg_client_http2_default)
                 self.reset_logging()
 
         def __get_error_log_handler(self):
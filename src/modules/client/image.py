@@ -39,11 +39,13 @@ import six
 import stat
 import sys
 import tempfile
+import threading
 import time
 
 from contextlib import contextmanager
 from cryptography import x509
 from cryptography.hazmat.backends import default_backend
+from six.moves import queue
 from six.moves.urllib.parse import quote, unquote
 
 import pkg.actions
@@ -62,6 +64,7 @@ import pkg.client.publisher             as publisher
 import pkg.client.sigpolicy             as sigpolicy
 import pkg.client.transport.transport   as transport
 import pkg.config                       as cfg
+import pkg.file_layout.file_manager     as file_manager
 import pkg.file_layout.layout           as fl
 import pkg.fmri
 import pkg.lockfile                     as lockfile
@@ -121,6 +124,11 @@ class Image(object):
 
         __STATE_UPDATING_FILE = "state_updating"
 
+        # Records the publisher catalogs and configuration that the image
+        # catalogs were last built from.
+        __CATALOG_SOURCES_FILE = "catalog_sources"
+        __CATALOG_SOURCES_VERSION = 1
+
         def __init__(self, root, user_provided_dir=False, progtrack=None,
             should_exist=True, imgtype=None, force=False,
             augment_ta_from_parent_image=True, allow_ondisk_upgrade=None,
@@ -186,11 +194,21 @@ in the environment or by setting simulate_cmdpath in DebugValues.""")
                 self.__write_cache_dir = None
                 self.__user_cache_dir = None
                 self._incoming_cache_dir = None
+                self._partial_cache_dir = None
 
                 # Set if write_cache is actually a tree like /var/pkg/publisher
                 # instead of a flat cache.
                 self.__write_cache_root = None
 
+                # Flat cache shared by linked images, whether this image owns
+                # (and so is the only one to add content to) it, the
+                # FileManager used to add content to it during an operation,
+                # and the hashes of the content added so far.
+                self.__shared_cache_dir = None
+                self.__shared_cache_owner = False
+                self.__shared_cache_fm = None
+                self.__shared_cache_hashes = set()
+
                 self.__lock = pkg.nrlock.NRLock()
                 self.__lockfile = None
                 self.__sig_policy = None
@@ -305,6 +323,16 @@ in the environment or by setting simulate_cmdpath in DebugValues.""")
                 self.__sig_policy = sigpolicy.Policy.policy_factory(txt, names)
                 return self.__sig_policy
 
+        @property
+        def solver_cache_file(self):
+                """The absolute path of the file used by the solver to retain
+                the setup of recent operations, or None if temporary package
+                data is merged with the image's catalogs."""
+
+                if self.__alt_pkg_pub_map:
+                        return None
+                return os.path.join(self.imgdir, "cache", "solver")
+
         @property
         def trust_anchors(self):
                 """A dictionary mapping subject hashes for certificates this
@@ -903,6 +931,21 @@ in the environment or by setting simulate_cmdpath in DebugValues.""")
                             self.__user_cache_dir,
                             "incoming-{0:d}".format(os.getpid()))
 
+                # Linked images share a flat cache for retrieved content so
+                # that it is only downloaded once for all of them.  A parent
+                # image passes its cache to the children it operates on using
+                # PKG_SHARED_CACHEDIR (see enable_shared_cache()).  Only the
+                # parent adds content to the cache, so the children use it
+                # read-only and retrieve anything else into their own caches.
+                self.__shared_cache_dir = None
+                self.__shared_cache_owner = False
+                self.__shared_cache_fm = None
+                self.__shared_cache_hashes = set()
+                if not self.__user_cache_dir and \
+                    "PKG_SHARED_CACHEDIR" in os.environ:
+                        self.__shared_cache_dir = os.path.normpath(
+                            os.environ["PKG_SHARED_CACHEDIR"])
+
                 self.__action_cache_dir = os.path.join(self.imgdir, "cache")
 
                 if not self._incoming_cache_dir:
@@ -932,6 +975,11 @@ in the environment or by setting simulate_cmdpath in DebugValues.""")
                 else:
                         os.removedirs(self._incoming_cache_dir)
 
+                # Downloads that were interrupted are kept here, named by
+                # hash, so that they can be resumed by a later operation.
+                self._partial_cache_dir = os.path.join(
+                    os.path.dirname(self._incoming_cache_dir), "partial")
+
                 # Forcibly discard image catalogs so they can be re-loaded
                 # from the new location if they are already loaded.  This
                 # also prevents scribbling on image state information in
@@ -1186,13 +1234,18 @@ in the environment or by setting simulate_cmdpath in DebugValues.""")
                 if self.__write_cache_dir:
                         cdirs.append((self.__write_cache_dir, False, None,
                             file_layout))
+                elif self.__shared_cache_dir:
+                        cdirs.append((self.__shared_cache_dir,
+                            not self.__shared_cache_owner, None, file_layout))
 
                 # For images newer than version 3, file data can be stored
                 # in the publisher's file root.
                 for pub in self.gen_publishers(inc_disabled=True):
                         froot = os.path.join(pub.meta_root, "file")
                         readonly = False
-                        if self.__write_cache_dir or self.__write_cache_root:
+                        if self.__write_cache_dir or \
+                            self.__write_cache_root or \
+                            self.__shared_cache_owner:
                                 readonly = True
                         cdirs.append((froot, readonly, pub.prefix, file_layout))
 
@@ -1206,6 +1259,56 @@ in the environment or by setting simulate_cmdpath in DebugValues.""")
 
                 return cdirs
 
+        @property
+        def shared_cache_dir(self):
+                """The absolute path of the content cache shared with linked
+                images, or None if this image doesn't use one."""
+
+                return self.__shared_cache_dir
+
+        def enable_shared_cache(self):
+                """Store content retrieved for this image in a cache that its
+                linked children will also use, so that content needed by
+                more than one image is only retrieved once.  Has no effect
+                if the user specified a cache or this image is already using
+                a cache shared by its parent."""
+
+                if self.__user_cache_dir or self.__shared_cache_dir:
+                        return
+
+                self.__shared_cache_dir = os.path.join(self.imgdir, "cache",
+                    "shared")
+                self.__shared_cache_owner = True
+                self.transport.cfg.reset_caches()
+
+        def share_cached_content(self, hashval, path):
+                """Hard link the content for 'hashval' that this image cached
+                at 'path' into the content cache it shares with its children,
+                if it has one, so that they don't retrieve it again."""
+
+                sroot = self.__shared_cache_dir
+                if not self.__shared_cache_owner or \
+                    hashval in self.__shared_cache_hashes or \
+                    not path.startswith(os.path.join(self.imgdir,
+                    self._get_publisher_meta_dir()) + os.path.sep):
+                        # Only content in the image's own publisher caches
+                        # is shared; everything else is either already in
+                        # the shared cache or not the image's to share.
+                        return
+
+                # Content is looked up once for each action that delivers
+                # it, but only needs to be linked once per operation.
+                self.__shared_cache_hashes.add(hashval)
+                try:
+                        if not self.__shared_cache_fm:
+                                self.__shared_cache_fm = \
+                                    file_manager.FileManager(sroot, False,
+                                    layouts=fl.V1Layout())
+                        self.__shared_cache_fm.link(hashval, path)
+                except (apx.ApiException, EnvironmentError):
+                        # Linked images will retrieve the content themselves.
+                        pass
+
         def get_root(self):
                 return self.root
 
@@ -1958,6 +2061,34 @@ in the environment or by setting simulate_cmdpath in DebugValues.""")
                         return on_disk
                 return False
 
+        def remove_manifest(self, pfmri):
+                """Remove the on-disk manifest and manifest cache for pfmri,
+                if present."""
+
+                mcdir = self.get_manifest_dir(pfmri)
+                manifest.FactoredManifest.clear_cache(mcdir)
+
+                # Remove package cache directory if possible; we don't
+                # care if it fails.
+                try:
+                        os.rmdir(os.path.dirname(mcdir))
+                except:
+                        pass
+
+                mpath = self.get_manifest_path(pfmri)
+                try:
+                        portable.remove(mpath)
+                except EnvironmentError as e:
+                        if e.errno != errno.ENOENT:
+                                raise apx._convert_error(e)
+
+                # Remove package manifest directory if possible; we
+                # don't care if it fails.
+                try:
+                        os.rmdir(os.path.dirname(mpath))
+                except:
+                        pass
+
         def get_license_dir(self, pfmri):
                 """Return path to package license directory."""
                 # Version 4+ images store license files per-stem, instead of
@@ -2214,29 +2345,7 @@ in the environment or by setting simulate_cmdpath in DebugValues.""")
                 # 'Updating package cache'
                 progtrack.job_start(progtrack.JOB_PKG_CACHE, goal=len(removed))
                 for pfmri in removed:
-                        mcdir = self.get_manifest_dir(pfmri)
-                        manifest.FactoredManifest.clear_cache(mcdir)
-
-                        # Remove package cache directory if possible; we don't
-                        # care if it fails.
-                        try:
-                                os.rmdir(os.path.dirname(mcdir))
-                        except:
-                                pass
-
-                        mpath = self.get_manifest_path(pfmri)
-                        try:
-                                portable.remove(mpath)
-                        except EnvironmentError as e:
-                                if e.errno != errno.ENOENT:
-                                        raise apx._convert_error(e)
-
-                        # Remove package manifest directory if possible; we
-                        # don't care if it fails.
-                        try:
-                                os.rmdir(os.path.dirname(mpath))
-                        except:
-                                pass
+                        self.remove_manifest(pfmri)
                         progtrack.job_add_progress(progtrack.JOB_PKG_CACHE)
                 progtrack.job_done(progtrack.JOB_PKG_CACHE)
 
@@ -2365,8 +2474,10 @@ in the environment or by setting simulate_cmdpath in DebugValues.""")
                 # the catalogs (add or remove entries) are only done during an
                 # image upgrade or metadata refresh.  In both cases, the catalog
                 # is resorted and finalized so this is always safe to use.
+                # Binary catalog parts are enabled so that lookups for
+                # individual packages don't require loading entire parts.
                 cat = pkg.catalog.Catalog(batch_mode=True, meta_root=croot,
-                    sign=False, file_root=self.imgdir)
+                    sign=False, file_root=self.imgdir, binary_parts=True)
                 return cat
 
         def __remove_catalogs(self):
@@ -2536,9 +2647,15 @@ in the environment or by setting simulate_cmdpath in DebugValues.""")
                                     e.filename)
                         raise
 
-        def __rebuild_image_catalogs(self, progtrack=None):
+        def __rebuild_image_catalogs(self, progtrack=None, incremental=False):
                 """Rebuilds the image catalogs based on the available publisher
-                catalogs."""
+                catalogs.
+
+                'incremental' is an optional boolean value indicating whether
+                only the changes made to the publisher catalogs since the image
+                catalogs were last rebuilt should be applied to the existing
+                image catalogs.  If that isn't possible, the image catalogs
+                are rebuilt in full instead."""
 
                 if self.version < 4:
                         raise apx.UnsupportedImageError(self.root)
@@ -2585,10 +2702,18 @@ in the environment or by setting simulate_cmdpath in DebugValues.""")
                         if os.path.isfile(fp):
                                 portable.copyfile(fp, os.path.join(tmp_state_root, p))
 
+                sources = self.__get_catalog_sources(publist)
+                if incremental and self.__update_image_catalogs(tmp_state_root,
+                    publist, sources, op_time):
+                        self.__replace_image_catalogs(tmp_state_root, sources)
+                        progtrack.cache_catalogs_done()
+                        self.history.log_operation_end()
+                        return
+
                 kcat = pkg.catalog.Catalog(batch_mode=True,
                     meta_root=os.path.join(tmp_state_root,
                     self.IMG_CATALOG_KNOWN), sign=False,
-                    file_root=self.imgdir)
+                    file_root=self.imgdir, binary_parts=True)
 
                 # XXX if any of the below fails for any reason, the old 'known'
                 # catalog needs to be re-loaded so the client is in a consistent
@@ -2641,7 +2766,7 @@ in the environment or by setting simulate_cmdpath in DebugValues.""")
                 icat = pkg.catalog.Catalog(batch_mode=True,
                     meta_root=os.path.join(tmp_state_root,
                     self.IMG_CATALOG_INSTALLED), sign=False,
-                    file_root=self.imgdir)
+                    file_root=self.imgdir, binary_parts=True)
 
                 excludes = self.list_excludes()
 
@@ -2693,72 +2818,15 @@ in the environment or by setting simulate_cmdpath in DebugValues.""")
                                 # state information and/or other metadata.
                                 mdata = entry.setdefault("metadata", {})
                                 states = mdata.setdefault("states", [])
-                                states.append(pkgdefs.PKG_STATE_KNOWN)
-
-                                # Assume V1 catalog source.
-                                states.append(pkgdefs.PKG_STATE_V1)
-
-                                if installed:
-                                        states.append(
-                                            pkgdefs.PKG_STATE_INSTALLED)
+                                states.extend(self.__get_known_pkg_states(pub,
+                                    stem, ver, installed, frozen_pkgs,
+                                    excludes, dp))
 
                                 nver, snver = newest.get(stem, (None, None))
                                 if snver is not None and ver != snver:
                                         states.append(
                                             pkgdefs.PKG_STATE_UPGRADABLE)
 
-                                # Check if the package is frozen.
-                                if stem in frozen_pkgs:
-                                        f_ver = frozen_pkgs[stem].version
-                                        if f_ver == ver or \
-                                            pkg.version.Version(ver
-                                            ).is_successor(f_ver,
-                                            constraint=
-                                            pkg.version.CONSTRAINT_AUTO):
-                                                states.append(
-                                                    pkgdefs.PKG_STATE_FROZEN)
-
-                                # Determine if package is obsolete or has been
-                                # renamed and mark with appropriate state.
-                                dpent = None
-                                if dp is not None:
-                                        dpent = dp.get_entry(pub=pub, stem=stem,
-                                            ver=ver)
-                                if dpent is not None:
-                                        for a in dpent["actions"]:
-                                                # Constructing action objects
-                                                # for every action would be a
-                                                # lot slower, so a simple string
-                                                # match is done first so that
-                                                # only interesting actions get
-                                                # constructed.
-                                                if not a.startswith("set"):
-                                                        continue
-                                                if not ("pkg.obsolete" in a or \
-                                                    "pkg.renamed" in a):
-                                                        continue
-
-                                                try:
-                                                        act = pkg.actions.fromstr(a)
-                                                except pkg.actions.ActionError:
-                                                        # If the action can't be
-                                                        # parsed or is not yet
-                                                        # supported, continue.
-                                                        continue
-
-                                                if act.attrs["value"].lower() != "true":
-                                                        continue
-
-                                                if act.attrs["name"] == "pkg.obsolete":
-                                                        states.append(
-                                                            pkgdefs.PKG_STATE_OBSOLETE)
-                                                elif act.attrs["name"] == "pkg.renamed":
-                                                        if not act.include_this(
-                                                            excludes, publisher=pub):
-                                                                continue
-                                                        states.append(
-                                                            pkgdefs.PKG_STATE_RENAMED)
-
                                 mdata["states"] = states
 
                                 # Add base entries.
@@ -2842,6 +2910,22 @@ in the environment or by setting simulate_cmdpath in DebugValues.""")
                         cat.finalize(pfmris=final_fmris)
                         cat.save()
 
+                self.__replace_image_catalogs(tmp_state_root, sources)
+                progtrack.cache_catalogs_done()
+                self.history.log_operation_end()
+
+        def __replace_image_catalogs(self, tmp_state_root, sources):
+                """Private helper for __rebuild_image_catalogs that moves the
+                image catalogs built in 'tmp_state_root' into place and
+                records the 'sources' they were built from."""
+
+                try:
+                        with open(os.path.join(tmp_state_root,
+                            self.__CATALOG_SOURCES_FILE), "w") as f:
+                                json.dump(sources, f)
+                except EnvironmentError as e:
+                        raise apx._convert_error(e)
+
                 # Next, preserve the old installed state dir, rename the
                 # new one into place, and then remove the old one.
                 orig_state_root = self.salvage(self._statedir, full_path=True)
@@ -2852,8 +2936,481 @@ in the environment or by setting simulate_cmdpath in DebugValues.""")
                 self.__init_catalogs()
 
                 self.update_last_modified()
-                progtrack.cache_catalogs_done()
-                self.history.log_operation_end()
+
+        def __get_catalog_sources(self, publist):
+                """Returns a dict describing the publisher catalogs and image
+                configuration that image catalogs built now would be based
+                on.  Comparing it to the one recorded when the image catalogs
+                were last built reveals what has changed since."""
+
+                pubs = {}
+                for pub in publist:
+                        pubs[pub.prefix] = dict(
+                            (name, pkg.catalog.datetime_to_ts(
+                                mdata["last-modified"]))
+                            for name, mdata in six.iteritems(pub.catalog.parts)
+                            if mdata.get("last-modified")
+                        )
+
+                # Lists are used since that's what will be loaded from disk.
+                return {
+                    "version": self.__CATALOG_SOURCES_VERSION,
+                    "publishers": pubs,
+                    "frozen": sorted(
+                        str(p[0]) for p in self.get_frozen_list()),
+                    "variants": sorted(
+                        [k, v] for k, v in six.iteritems(self.cfg.variants)),
+                    "facets": sorted(
+                        [k, v] for k, v in six.iteritems(self.cfg.facets)),
+                }
+
+        def __load_catalog_sources(self):
+                """Returns the dict recorded when the image catalogs were last
+                built (see __get_catalog_sources) or None if it isn't
+                available."""
+
+                try:
+                        with open(os.path.join(self._statedir,
+                            self.__CATALOG_SOURCES_FILE)) as f:
+                                sources = json.load(f)
+                except (EnvironmentError, ValueError):
+                        return None
+                if not isinstance(sources, dict) or \
+                    sources.get("version") != self.__CATALOG_SOURCES_VERSION:
+                        return None
+                return sources
+
+        def __get_known_pkg_states(self, pub, stem, ver, installed,
+            frozen_pkgs, excludes, dp):
+                """Returns a list of the states (other than upgradability) of
+                a package entry being added to the image catalogs from a
+                publisher catalog.
+
+                'installed' is a boolean value indicating whether the package
+                is installed.
+
+                'frozen_pkgs' is a dict of the frozen FMRIs keyed by stem.
+
+                'excludes' is a list of the image's variant and facet exclude
+                functions.
+
+                'dp' is the publisher's dependency catalog part, if any."""
+
+                states = [pkgdefs.PKG_STATE_KNOWN]
+
+                # Assume V1 catalog source.
+                states.append(pkgdefs.PKG_STATE_V1)
+
+                if installed:
+                        states.append(pkgdefs.PKG_STATE_INSTALLED)
+
+                # Check if the package is frozen.
+                if stem in frozen_pkgs:
+                        f_ver = frozen_pkgs[stem].version
+                        if f_ver == ver or \
+                            pkg.version.Version(ver).is_successor(f_ver,
+                            constraint=pkg.version.CONSTRAINT_AUTO):
+                                states.append(pkgdefs.PKG_STATE_FROZEN)
+
+                # Determine if package is obsolete or has been renamed and mark
+                # with appropriate state.
+                dpent = None
+                if dp is not None:
+                        dpent = dp.get_entry(pub=pub, stem=stem, ver=ver)
+                if dpent is None:
+                        return states
+
+                for a in dpent["actions"]:
+                        # Constructing action objects for every action would be
+                        # a lot slower, so a simple string match is done first
+                        # so that only interesting actions get constructed.
+                        if not a.startswith("set"):
+                                continue
+                        if not ("pkg.obsolete" in a or "pkg.renamed" in a):
+                                continue
+
+                        try:
+                                act = pkg.actions.fromstr(a)
+                        except pkg.actions.ActionError:
+                                # If the action can't be parsed or is not yet
+                                # supported, continue.
+                                continue
+
+                        if act.attrs["value"].lower() != "true":
+                                continue
+
+                        if act.attrs["name"] == "pkg.obsolete":
+                                states.append(pkgdefs.PKG_STATE_OBSOLETE)
+                        elif act.attrs["name"] == "pkg.renamed":
+                                if not act.include_this(excludes,
+                                    publisher=pub):
+                                        continue
+                                states.append(pkgdefs.PKG_STATE_RENAMED)
+                return states
+
+        @staticmethod
+        def __pkg_entry_changed(sentry, kentry):
+                """Returns a boolean value indicating whether the publisher
+                catalog entry 'sentry' differs from the entry 'kentry' that
+                was previously added to the image catalogs for it, ignoring
+                the state information added by the image."""
+
+                def strip(entry, ignored):
+                        return dict(
+                            (k, v) for k, v in six.iteritems(entry)
+                            if k not in ignored
+                        )
+
+                if strip(sentry, ("metadata",)) != strip(kentry, ("metadata",)):
+                        return True
+                return sentry.get("metadata", {}) != strip(
+                    kentry.get("metadata", {}),
+                    ("states", "last-install", "last-update"))
+
+        def __update_image_catalogs(self, tmp_state_root, publist, sources,
+            op_time):
+                """Private helper for __rebuild_image_catalogs that applies the
+                changes made to the publisher catalogs since the image catalogs
+                were last built to a copy of the image catalogs placed in
+                'tmp_state_root'.  Returns False if that isn't possible, in
+                which case the image catalogs must be rebuilt in full."""
+
+                old_sources = self.__load_catalog_sources()
+                if not old_sources:
+                        return False
+
+                for key in ("frozen", "variants", "facets"):
+                        if old_sources.get(key) != sources[key]:
+                                # Package states depend on these.
+                                return False
+
+                opubs = old_sources.get("publishers", {})
+                if set(opubs) != set(sources["publishers"]):
+                        return False
+
+                changed = []
+                for pub in publist:
+                        oparts = opubs[pub.prefix]
+                        nparts = sources["publishers"][pub.prefix]
+                        if oparts == nparts:
+                                continue
+                        if set(oparts) != set(nparts):
+                                # Any new parts would lack the entries of
+                                # unchanged packages.
+                                return False
+                        changed.append(pub)
+
+                cat_names = (self.IMG_CATALOG_KNOWN, self.IMG_CATALOG_INSTALLED)
+                try:
+                        for name in cat_names:
+                                shutil.copytree(os.path.join(self._statedir,
+                                    name), os.path.join(tmp_state_root, name))
+                        if self.__apply_catalog_changes(tmp_state_root,
+                            changed, op_time):
+                                return True
+                except (EnvironmentError, apx.CatalogError):
+                        # The image catalogs are missing, inaccessible, or
+                        # inconsistent with the publisher catalogs.
+                        pass
+
+                for name in cat_names:
+                        shutil.rmtree(os.path.join(tmp_state_root, name), True)
+                return False
+
+        def __apply_catalog_changes(self, tmp_state_root, changed, op_time):
+                """Private helper for __update_image_catalogs that updates the
+                image catalogs in 'tmp_state_root' to match the current
+                contents of the catalogs of the publisher objects in
+                'changed'.  Returns False if the image catalogs can't be
+                updated."""
+
+                kcat = pkg.catalog.Catalog(batch_mode=True,
+                    meta_root=os.path.join(tmp_state_root,
+                    self.IMG_CATALOG_KNOWN), sign=False,
+                    file_root=self.imgdir, binary_parts=True)
+                icat = pkg.catalog.Catalog(batch_mode=True,
+                    meta_root=os.path.join(tmp_state_root,
+                    self.IMG_CATALOG_INSTALLED), sign=False,
+                    file_root=self.imgdir, binary_parts=True)
+
+                kbase = kcat.get_part("catalog.base.C", must_exist=True)
+                ibase = icat.get_part("catalog.base.C", must_exist=True)
+                if kbase is None or ibase is None:
+                        return False
+
+                # Entries are updated in place, so both parts must be loaded
+                # (see Catalog.update_entry).
+                kbase.load()
+                ibase.load()
+
+                installed = set(
+                    t for t, entry in ibase.tuple_entries()
+                    if pkgdefs.PKG_STATE_INSTALLED in
+                        entry.get("metadata", {}).get("states", EmptyI)
+                )
+                excludes = self.list_excludes()
+                frozen_pkgs = dict([
+                    (p[0].pkg_name, p[0]) for p in self.get_frozen_list()
+                ])
+
+                def set_states(t, kentry, states):
+                        # Installed packages have the same state in both
+                        # catalogs.  Returns True if the installed catalog
+                        # was changed.
+                        pub, stem, ver = t
+                        kentry.setdefault("metadata", {})["states"] = states
+                        ientry = ibase.get_entry(pub=pub, stem=stem, ver=ver)
+                        if ientry is None:
+                                return False
+                        ientry.setdefault("metadata", {})["states"] = \
+                            list(states)
+                        return True
+
+                # Whether the installed catalog needs to be saved.
+                imodified = False
+
+                # Stems that need their upgradability re-evaluated.
+                stems = set()
+                added = []
+                for spub in changed:
+                        pfx = spub.prefix
+                        cat = spub.catalog
+                        sentries = {}
+                        sbase = cat.get_part("catalog.base.C", must_exist=True)
+                        if sbase is not None:
+                                sentries = dict(sbase.tuple_entries(
+                                    pubs=[pfx]))
+
+                        # First, discard entries for packages that have been
+                        # removed or changed.
+                        for t, kentry in list(kbase.tuple_entries(pubs=[pfx])):
+                                pub, stem, ver = t
+                                states = kentry.get("metadata", {}).get(
+                                    "states", [])
+                                known = pkgdefs.PKG_STATE_KNOWN in states
+                                sentry = sentries.get(t)
+                                if sentry is None and not known:
+                                        # Previously removed, but installed.
+                                        continue
+                                if sentry is not None and known and \
+                                    not self.__pkg_entry_changed(sentry,
+                                    kentry):
+                                        # Unchanged.
+                                        del sentries[t]
+                                        continue
+
+                                stems.add(stem)
+                                if sentry is None and t in installed:
+                                        # Installed packages remain in the
+                                        # image catalogs even if they're no
+                                        # longer available.
+                                        imodified |= set_states(t, kentry, [
+                                            s for s in states
+                                            if s != pkgdefs.PKG_STATE_KNOWN
+                                        ])
+                                        continue
+
+                                pfmri = pkg.fmri.PkgFmri(name=stem,
+                                    publisher=pub, version=ver)
+                                kcat.remove_package(pfmri)
+                                if t in installed:
+                                        icat.remove_package(pfmri)
+                                        imodified = True
+
+                        # Then add entries for new or changed packages.
+                        dp = cat.get_part("catalog.dependency.C",
+                            must_exist=True)
+                        sparts = [
+                            (name, cat.get_part(name, must_exist=True))
+                            for name in cat.parts
+                            if not name.startswith("catalog.base.")
+                        ]
+                        for t, sentry in six.iteritems(sentries):
+                                pub, stem, ver = t
+                                stems.add(stem)
+                                inst = t in installed
+
+                                entry = dict(six.iteritems(sentry))
+                                mdata = entry["metadata"] = dict(
+                                    entry.get("metadata", {}))
+                                mdata["states"] = self.__get_known_pkg_states(
+                                    pub, stem, ver, inst, frozen_pkgs,
+                                    excludes, dp)
+                                kbase.add(metadata=entry, op_time=op_time,
+                                    pub=pub, stem=stem, ver=ver)
+                                if inst:
+                                        imodified = True
+                                        ibase.add(metadata=dict(entry,
+                                            metadata=dict(mdata,
+                                            states=list(mdata["states"]))),
+                                            op_time=op_time, pub=pub,
+                                            stem=stem, ver=ver)
+
+                                for name, spart in sparts:
+                                        if spart is None:
+                                                # Client hasn't retrieved this
+                                                # part.
+                                                continue
+                                        pentry = spart.get_entry(pub=pub,
+                                            stem=stem, ver=ver)
+                                        if pentry is None:
+                                                continue
+                                        pentry = dict(six.iteritems(pentry))
+                                        kcat.get_part(name).add(
+                                            metadata=pentry, op_time=op_time,
+                                            pub=pub, stem=stem, ver=ver)
+                                        if inst:
+                                                icat.get_part(name).add(
+                                                    metadata=pentry,
+                                                    op_time=op_time, pub=pub,
+                                                    stem=stem, ver=ver)
+                                added.append(pkg.fmri.PkgFmri(name=stem,
+                                    publisher=pub, version=ver))
+
+                # Finally, upgradability is determined by the newest version
+                # of each stem across all publishers.
+                kcat.finalize(pfmris=added)
+                for stem in stems:
+                        versions = list(kbase.entries_by_version(stem))
+                        if not versions:
+                                continue
+                        snver = str(versions[-1][0])
+                        for nver, entries in versions:
+                                for f, kentry in entries:
+                                        pub, fstem, ver = f.tuple()
+                                        ver = str(ver)
+                                        states = kentry.get("metadata",
+                                            {}).get("states", [])
+                                        upgradable = ver != snver
+                                        if upgradable == (
+                                            pkgdefs.PKG_STATE_UPGRADABLE in
+                                            states):
+                                                continue
+                                        if upgradable:
+                                                states = states + [
+                                                    pkgdefs.PKG_STATE_UPGRADABLE
+                                                ]
+                                        else:
+                                                states = [
+                                                    s for s in states
+                                                    if s != pkgdefs.PKG_STATE_UPGRADABLE
+                                                ]
+                                        imodified |= set_states(
+                                            (pub, fstem, ver), kentry, states)
+
+                cats = [(kcat, kbase)]
+                if imodified:
+                        # Otherwise, the copy of the installed catalog is
+                        # left as is.
+                        cats.append((icat, ibase))
+                for cat, base in cats:
+                        base.last_modified = op_time
+                        cat.finalize(pfmris=added)
+                        cat.save()
+                return True
+
+        def __gen_refreshed_pubs(self, pubs, full_refresh=False,
+            immediate=False, progtrack=None):
+                """A generator function that refreshes the metadata of the
+                given publisher objects, producing a tuple of the form (pub,
+                rval, ex) as the refresh of each publisher completes.  'rval'
+                is the value returned by Publisher.refresh() or None if the
+                refresh failed, in which case 'ex' is the ApiException that
+                was raised.
+
+                If global_settings.PKG_CLIENT_REFRESH_CONCURRENCY allows it,
+                publishers are refreshed in parallel; each worker thread uses
+                its own clone of the image's transport so that retrievals for
+                all publishers are in progress at once.  Results are then
+                produced in completion order, and the progress of individual
+                catalog retrievals isn't reported."""
+
+                concurrency = global_settings.PKG_CLIENT_REFRESH_CONCURRENCY
+                if concurrency <= 0:
+                        concurrency = len(pubs)
+                concurrency = min(concurrency, len(pubs))
+
+                if concurrency <= 1:
+                        for pub in pubs:
+                                progtrack.refresh_start_pub(pub)
+                                try:
+                                        rval = pub.refresh(
+                                            full_refresh=full_refresh,
+                                            immediate=immediate,
+                                            progtrack=progtrack)
+                                except apx.ApiException as e:
+                                        rval, ex = None, e
+                                else:
+                                        ex = None
+                                finally:
+                                        progtrack.refresh_end_pub(pub)
+                                yield pub, rval, ex
+                        return
+
+                pending = queue.Queue()
+                for pub in pubs:
+                        pending.put(pub)
+                results = queue.Queue()
+                abort = threading.Event()
+
+                def refresh_pubs(xport):
+                        try:
+                                while not abort.is_set():
+                                        try:
+                                                pub = pending.get_nowait()
+                                        except queue.Empty:
+                                                break
+
+                                        otransport = pub.transport
+                                        pub.transport = xport
+                                        try:
+                                                rval = pub.refresh(
+                                                    full_refresh=full_refresh,
+                                                    immediate=immediate)
+                                                results.put((pub, rval, None,
+                                                    None))
+                                        except apx.ApiException as e:
+                                                results.put((pub, None, e,
+                                                    None))
+                                        except:
+                                                # Re-raised by the caller's
+                                                # thread.
+                                                results.put((pub, None, None,
+                                                    sys.exc_info()))
+                                        finally:
+                                                pub.transport = otransport
+                                                # Remove the directory the
+                                                # publisher's catalog files
+                                                # were downloaded to.
+                                                shutil.rmtree(os.path.join(
+                                                    xport.cfg.incoming_root,
+                                                    "catalog", pub.prefix),
+                                                    True)
+                        finally:
+                                xport.shutdown()
+
+                threads = []
+                for i in range(concurrency):
+                        t = threading.Thread(target=refresh_pubs,
+                            args=(self.transport.clone(),))
+                        t.daemon = True
+                        t.start()
+                        threads.append(t)
+
+                try:
+                        for i in range(len(pubs)):
+                                pub, rval, ex, exc_info = results.get()
+                                if exc_info:
+                                        six.reraise(*exc_info)
+                                progtrack.refresh_start_pub(pub)
+                                progtrack.refresh_end_pub(pub)
+                                yield pub, rval, ex
+                finally:
+                        # Any publishers not yet being refreshed are skipped
+                        # if the caller stops early.
+                        abort.set()
+                        for t in threads:
+                                t.join()
 
         def refresh_publishers(self, full_refresh=False, immediate=False,
             pubs=None, progtrack=None, ignore_unreachable=True):
@@ -2937,36 +3494,33 @@ in the environment or by setting simulate_cmdpath in DebugValues.""")
                 total = 0
                 succeeded = set()
                 updated = self.__start_state_update()
-                for pub in pubs_to_refresh:
+                for pub, rval, ex in self.__gen_refreshed_pubs(pubs_to_refresh,
+                    full_refresh=full_refresh, immediate=immediate,
+                    progtrack=progtrack):
                         total += 1
-                        progtrack.refresh_start_pub(pub)
-                        try:
-                                changed, e = pub.refresh(
-                                    full_refresh=full_refresh,
-                                    immediate=immediate, progtrack=progtrack)
-                                if changed:
-                                        updated = True
-
-                                if not ignore_unreachable and e:
-                                        failed.append((pub, e))
-                                        continue
-
-                        except apx.PermissionsException as e:
-                                failed.append((pub, e))
+                        if isinstance(ex, apx.PermissionsException):
+                                failed.append((pub, ex))
                                 # No point in continuing since no data can
                                 # be written.
                                 break
-                        except apx.ApiException as e:
+                        if ex:
+                                failed.append((pub, ex))
+                                continue
+
+                        changed, e = rval
+                        if changed:
+                                updated = True
+
+                        if not ignore_unreachable and e:
                                 failed.append((pub, e))
                                 continue
-                        finally:
-                                progtrack.refresh_end_pub(pub)
                         succeeded.add(pub.prefix)
 
                 progtrack.refresh_done()
 
                 if updated:
-                        self.__rebuild_image_catalogs(progtrack=progtrack)
+                        self.__rebuild_image_catalogs(progtrack=progtrack,
+                            incremental=True)
                         # Ensure any configuration or metadata changes made
                         # during refresh are reflected in on-disk state.
                         self.save_config()
@@ -3497,7 +4051,17 @@ in the environment or by setting simulate_cmdpath in DebugValues.""")
                 downloaded content.  This may take a while for a large
                 directory hierarchy.  Don't clean up caches if the
                 user overrode the underlying setting using PKG_CACHEDIR or
-                PKG_CACHEROOT. """
+                PKG_CACHEROOT, or a cache shared by a parent image; a parent
+                image only cleans up the cache it shares once its children
+                are done with it. """
+
+                # Partially downloaded content is of no further use once an
+                # operation has retrieved everything it needed.
+                shutil.rmtree(self._partial_cache_dir, True)
+
+                # The next operation starts afresh with the shared cache.
+                self.__shared_cache_fm = None
+                self.__shared_cache_hashes = set()
 
                 if not self.cfg.get_policy(imageconfig.FLUSH_CONTENT_CACHE):
                         return
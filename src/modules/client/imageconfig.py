@@ -79,10 +79,22 @@ default_policy_map = {
     CONTENT_UPDATE_POLICY: { "default": "always" },
 }
 
+# Bounds on the number of files the transport requests at once and on the
+# number of connections it uses concurrently.  The values used are chosen
+# within these bounds from the observed repository statistics.
+TRANSPORT_CHUNK_MIN = "transport-chunk-min"
+TRANSPORT_CHUNK_MAX = "transport-chunk-max"
+TRANSPORT_CONN_MIN = "transport-connections-min"
+TRANSPORT_CONN_MAX = "transport-connections-max"
+
 CA_PATH = "ca-path"
 # Default CA_PATH is /etc/openssl/certs
 default_properties = {
         CA_PATH: os.path.join(os.path.sep, "etc", "openssl", "certs"),
+        TRANSPORT_CHUNK_MIN: 10,
+        TRANSPORT_CHUNK_MAX: 1024,
+        TRANSPORT_CONN_MIN: 2,
+        TRANSPORT_CONN_MAX: 20,
         # Path default is intentionally relative for this case.
         "trust-anchor-directory": os.path.join("etc", "certs", "CA"),
 }
@@ -186,6 +198,14 @@ class ImageConfig(cfg.FileConfig):
                         default=default_policies[USE_SYSTEM_REPO]),
                     cfg.Property(CA_PATH,
                         default=default_properties[CA_PATH]),
+                    cfg.PropInt(TRANSPORT_CHUNK_MIN, minimum=1,
+                        default=default_properties[TRANSPORT_CHUNK_MIN]),
+                    cfg.PropInt(TRANSPORT_CHUNK_MAX, minimum=1,
+                        default=default_properties[TRANSPORT_CHUNK_MAX]),
+                    cfg.PropInt(TRANSPORT_CONN_MIN, minimum=1,
+                        default=default_properties[TRANSPORT_CONN_MIN]),
+                    cfg.PropInt(TRANSPORT_CONN_MAX, minimum=1,
+                        default=default_properties[TRANSPORT_CONN_MAX]),
                     cfg.Property("trust-anchor-directory",
                         default=DEF_TOKEN),
                     cfg.PropList("signature-required-names"),
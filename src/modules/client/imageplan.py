@@ -39,6 +39,7 @@ import six
 import stat
 import sys
 import tempfile
+import threading
 import time
 import traceback
 import weakref
@@ -59,6 +60,7 @@ import pkg.client.pkg_solver as pkg_solver
 import pkg.client.pkgdefs as pkgdefs
 import pkg.client.pkgplan as pkgplan
 import pkg.client.plandesc as plandesc
+import pkg.client.progress as progress
 import pkg.digest as digest
 import pkg.fmri
 import pkg.manifest as manifest
@@ -451,10 +453,151 @@ class ImagePlan(object):
                 return (new_variants, new_facets, facet_change,
                     masked_facet_change)
 
-        def __run_solver(self, solver_cb, retry_wo_parent_deps=True):
+        def __get_prefetch_fmris(self, proposed_dict, installed_dict,
+            pub_ranks):
+                """Returns a list of the FMRIs of packages that are likely to
+                be part of the solution for the operation and whose manifests
+                aren't available yet: the newest versions of the proposed
+                packages or, if no packages were proposed, the newest versions
+                of any installed incorporations."""
+
+                def rank(f):
+                        return pub_ranks.get(f.publisher, (sys.maxsize,))[0]
+
+                candidates = []
+                if proposed_dict:
+                        for name, fmris in six.iteritems(proposed_dict):
+                                if not fmris:
+                                        continue
+                                inst = installed_dict.get(name)
+                                if inst:
+                                        pfmris = [
+                                            f for f in fmris
+                                            if f.publisher == inst.publisher
+                                        ]
+                                        if pfmris:
+                                                fmris = pfmris
+                                best = min(rank(f) for f in fmris)
+                                candidates.append(max(
+                                    (f for f in fmris if rank(f) == best),
+                                    key=operator.attrgetter("version")))
+                else:
+                        inst_cat = self.image.get_catalog(
+                            self.image.IMG_CATALOG_INSTALLED)
+                        known_cat = self.image.get_catalog(
+                            self.image.IMG_CATALOG_KNOWN)
+                        for name, inst in six.iteritems(installed_dict):
+                                # Only check for incorporate dependencies;
+                                # there's no need to parse the actions.
+                                entry = inst_cat.get_entry(inst,
+                                    info_needed=[
+                                        pkg.catalog.Catalog.DEPENDENCY])
+                                if not entry or not any(
+                                    "type=incorporate" in a
+                                    for a in entry.get("actions", [])):
+                                        continue
+                                newest = None
+                                for ver, fmris in known_cat.fmris_by_version(
+                                    name, pubs=[inst.publisher]):
+                                        newest = fmris[0]
+                                if newest:
+                                        candidates.append(newest)
+
+                return [
+                    f for f in candidates
+                    if f != installed_dict.get(f.pkg_name) and
+                        not os.path.exists(self.image.get_manifest_path(f))
+                ]
+
+        def __start_manifest_prefetch(self, fmris):
+                """Start retrieving the manifests for the given list of FMRIs
+                in the background, so that they're retrieved while the solver
+                runs.  The list must be determined by the caller, as the image
+                catalogs used to do so are shared with the solver and aren't
+                safe to load from another thread.
+
+                Returns a tuple of the list, a threading.Event that can be set
+                to abandon the retrieval, and the thread performing it, or
+                None if there's nothing to retrieve."""
+
+                if not fmris:
+                        return None
+
+                abort = threading.Event()
+
+                def ccancel():
+                        return abort.is_set() or bool(self.__check_cancel and
+                            self.__check_cancel())
+
+                # The retrieval isn't reported using the plan's progress
+                # tracker, as it's being used by the solver.
+                progtrack = progress.NullProgressTracker()
+                progtrack.set_major_phase(progtrack.PHASE_PLAN)
+
+                def prefetch(xport):
+                        # Catch "Exception"; pylint: disable=W0703
+                        try:
+                                xport.prefetch_manifests([
+                                    (f, None) for f in fmris
+                                ], ccancel=ccancel, progtrack=progtrack)
+                        except Exception:
+                                # Any manifests that couldn't be retrieved
+                                # will be retrieved again (and any failures
+                                # reported) when the plan is evaluated.
+                                pass
+                        finally:
+                                xport.shutdown()
+
+                t = threading.Thread(target=prefetch,
+                    args=(self.image.transport.clone(),))
+                t.daemon = True
+                t.start()
+                return fmris, abort, t
+
+        def __finish_manifest_prefetch(self, prefetch, solution):
+                """Wait for the retrieval started by __start_manifest_prefetch
+                to finish, and discard any manifests retrieved for packages
+                that aren't part of 'solution', the set of FMRIs chosen by the
+                solver (or None if no solution was found)."""
+
+                if prefetch is None:
+                        return
+
+                fmris, abort, t = prefetch
+                if solution is None:
+                        abort.set()
+                t.join()
+
+                for f in fmris:
+                        if solution is not None and f in solution:
+                                continue
+                        try:
+                                self.image.remove_manifest(f)
+                        except api_errors.ApiException:
+                                pass
+
+        def __run_solver(self, solver_cb, retry_wo_parent_deps=True,
+            prefetch=misc.EmptyI):
                 """Run the solver, and if it fails, optionally retry the
                 operation once while relaxing installed parent
-                dependencies."""
+                dependencies.
+
+                'prefetch' is an optional list of FMRIs of packages likely to
+                be part of the solution whose manifests should be retrieved
+                while the solver runs."""
+
+                prefetch = self.__start_manifest_prefetch(prefetch)
+                rv = None
+                try:
+                        rv = self.__run_solver_cb(solver_cb,
+                            retry_wo_parent_deps)
+                        return rv
+                finally:
+                        self.__finish_manifest_prefetch(prefetch,
+                            rv and rv[1])
+
+        def __run_solver_cb(self, solver_cb, retry_wo_parent_deps):
+                """Helper function for __run_solver that runs the solver."""
 
                 # have the solver try to satisfy parent dependencies.
                 ignore_inst_parent_deps = False
@@ -677,6 +820,17 @@ class ImagePlan(object):
                 else:
                         variants = self.image.get_variants()
 
+                if new_facets is not None:
+                        facets = new_facets
+                else:
+                        facets = self.image.cfg.facets
+
+                # The solver cache isn't used when changing variants as only
+                # the variants being changed are known to the solver.
+                cache_path = None
+                if not new_variants:
+                        cache_path = self.image.solver_cache_file
+
                 installed_dict_tmp = {}
                 # If exact_install is on, clear the installed_dict.
                 if exact_install:
@@ -701,7 +855,9 @@ class ImagePlan(object):
                             variants,
                             avoid_set,
                             self.image.linked.parent_fmris(),
-                            self.__progtrack)
+                            self.__progtrack,
+                            facets=facets,
+                            cache_path=cache_path)
 
                         if reject_list:
                                 # use reject_list, not reject_set, to preserve
@@ -733,7 +889,9 @@ class ImagePlan(object):
                 # Solve; will raise exceptions if no solution is found.
                 solver, new_vector, self.pd._new_avoid_obs = \
                     self.__run_solver(solver_cb, \
-                        retry_wo_parent_deps=retry_wo_parent_deps)
+                        retry_wo_parent_deps=retry_wo_parent_deps,
+                        prefetch=inst_dict and self.__get_prefetch_fmris(
+                            inst_dict, installed_dict, pub_ranks))
 
                 # Restore the installed_dict for checking fmri changes.
                 if exact_install:
@@ -748,6 +906,7 @@ class ImagePlan(object):
                 self.__add_pkg_actuators_to_pd(reject_set)
 
                 self.pd._solver_summary = str(solver)
+                self.pd._solver_profile = solver.get_profile()
                 if DebugValues["plan"]:
                         self.pd._solver_errors = solver.get_trim_errors()
 
@@ -1319,6 +1478,7 @@ class ImagePlan(object):
                     [x.pkg_name for x in proposed_removals])
 
                 self.pd._solver_summary = str(solver)
+                self.pd._solver_profile = solver.get_profile()
                 if DebugValues["plan"]:
                         self.pd._solver_errors = solver.get_trim_errors()
 
@@ -1332,6 +1492,10 @@ class ImagePlan(object):
 
                 # check if inherited facets are changing
                 new_facets = self.__evaluate_excludes()[1]
+                if new_facets is not None:
+                        facets = new_facets
+                else:
+                        facets = self.image.cfg.facets
 
                 # get ranking of publishers
                 pub_ranks = self.image.get_publisher_ranks()
@@ -1366,7 +1530,9 @@ class ImagePlan(object):
                             self.image.get_variants(),
                             self.image.avoid_set_get(),
                             self.image.linked.parent_fmris(),
-                            self.__progtrack)
+                            self.__progtrack,
+                            facets=facets,
+                            cache_path=self.image.solver_cache_file)
 
                         if reject_list:
                                 # use reject_list, not reject_set, to preserve
@@ -1403,7 +1569,10 @@ class ImagePlan(object):
                 # Solve; will raise exceptions if no solution is found.
                 solver, new_vector, self.pd._new_avoid_obs = \
                     self.__run_solver(solver_cb, \
-                        retry_wo_parent_deps=retry_wo_parent_deps)
+                        retry_wo_parent_deps=retry_wo_parent_deps,
+                        prefetch=self.__get_prefetch_fmris(
+                            pkgs_update and update_dict, installed_dict,
+                            pub_ranks))
 
                 self.pd._fmri_changes = self.__vector_2_fmri_changes(
                     installed_dict, new_vector,
@@ -1412,6 +1581,7 @@ class ImagePlan(object):
                 self.__add_pkg_actuators_to_pd(reject_set)
 
                 self.pd._solver_summary = str(solver)
+                self.pd._solver_profile = solver.get_profile()
                 if DebugValues["plan"]:
                         self.pd._solver_errors = solver.get_trim_errors()
 
@@ -5121,6 +5291,12 @@ class ImagePlan(object):
                         if lic_errors:
                                 raise api_errors.PlanLicenseErrors(lic_errors)
 
+                        # Checking whether each action's content has already
+                        # been downloaded would otherwise probe the caches
+                        # once per action; index them once instead.  The
+                        # index is kept until the content is loaded during
+                        # execution.
+                        self.image.transport.index_caches()
                         try:
                                 for p in self.pd.pkg_plans:
                                         p.download(self.__progtrack,
@@ -5142,6 +5318,7 @@ class ImagePlan(object):
                         self.image.transport.shutdown()
                         self.__progtrack.download_done()
                 except:
+                        self.image.transport.drop_cache_indexes()
                         self.pd.state = plandesc.PREEXECUTED_ERROR
                         raise
 
@@ -5178,6 +5355,8 @@ class ImagePlan(object):
                                 raise api_errors.PermissionsException(
                                     e.filename)
                         raise
+                finally:
+                        self.image.transport.drop_cache_indexes()
 
                 # check for available space
                 self.__update_avail_space()
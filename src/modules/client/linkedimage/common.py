@@ -2388,6 +2388,11 @@ class LinkedImage(object):
                 if repos:
                         raise apx.PlanCreationException(no_tmp_origins=True)
 
+                # retrieve content through a cache that our children will
+                # also use, so that content common to several images is only
+                # downloaded once.
+                self.__img.enable_shared_cache()
+
         def api_recurse_pubcheck(self, progtrack):
                 """Do a recursive publisher check"""
 
@@ -3267,6 +3272,13 @@ class LinkedImageChild(object):
 
                 self.__child_op = _pkg_op
 
+                # let the child use the content cache we share with it.
+                env = None
+                if self.__img.shared_cache_dir:
+                        env = os.environ.copy()
+                        env["PKG_SHARED_CACHEDIR"] = self.__img.shared_cache_dir
+                self.__pkg_remote.set_environ(env)
+
                 if _pkg_op == pkgdefs.PKG_OP_AUDIT_LINKED:
                         self.__child_setup_audit(_pmd, **kwargs)
                 elif _pkg_op == pkgdefs.PKG_OP_DETACH:
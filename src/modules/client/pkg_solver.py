@@ -27,7 +27,11 @@
 """Provides the interfaces and exceptions needed to determine which packages
 should be installed, updated, or removed to perform a requested operation."""
 
+import hashlib
 import operator
+import os
+import simplejson as json
+import tempfile
 import time
 
 from collections import defaultdict
@@ -44,6 +48,7 @@ import pkg.client.api_errors as api_errors
 import pkg.client.image
 import pkg.fmri
 import pkg.misc as misc
+import pkg.portable as portable
 import pkg.solver
 import pkg.version as version
 
@@ -91,6 +96,13 @@ _TRIM_SYNCED_INC = 23              # incorporation must be in sync with parent
 _TRIM_CPU = 24                     # cpu version requirement
 _TRIM_MAX = 25                     # number of trim constants
 
+# names of trim constants, indexed by value; used for solver profiles
+_TRIM_NAMES = dict(
+    (v, k[len("_TRIM_"):].lower())
+    for k, v in list(globals().items())
+    if k.startswith("_TRIM_") and k != "_TRIM_MAX"
+)
+
 
 class DependencyException(Exception):
         """local exception used to pass failure to match
@@ -123,15 +135,33 @@ class PkgSolver(object):
         should be installed, updated, or removed to perform a requested
         operation."""
 
+        # The solver cache retains the setup of the solver for recent
+        # operations (the possible packages, the clauses generated for them,
+        # and the trimming decisions made) so that planning the same
+        # operation again can skip straight to finding a solution.
+        #
+        # format is (version, catalog key, [(operation key, setup), ...]),
+        # with the most recently cached setup first.
+        __SOLVER_CACHE_VERSION = 1
+        __SOLVER_CACHE_SIZE = 4
+
         def __init__(self, cat, installed_dict, pub_ranks, variants, avoids,
-            parent_pkgs, progtrack):
+            parent_pkgs, progtrack, facets=None, cache_path=None):
                 """Create a PkgSolver instance; catalog should contain all
                 known pkgs, installed fmris should be a dict of fmris indexed
                 by name that define pkgs current installed in the image.
                 Pub_ranks dict contains (rank, stickiness, enabled) for each
                 publisher.  variants are the current image variants; avoids is
                 the set of pkg stems being avoided in the image due to
-                administrator action (e.g. --reject, uninstall)."""
+                administrator action (e.g. --reject, uninstall).
+
+                'facets' are the facets of the image the operation is planned
+                for; they're only used to identify the operation in the solver
+                cache.
+
+                'cache_path' is the optional pathname of a file used to retain
+                the setup of the solver for recent operations.  It's ignored
+                if 'facets' isn't provided."""
 
                 # Value 'DebugValues' is unsubscriptable;
                 # pylint: disable=E1136
@@ -212,6 +242,12 @@ class PkgSolver(object):
                 self.__iterations = 0
                 self.__clauses     = 0
                 self.__variables   = 0
+                self.__activations = 0          # variables used to enable
+                                                # clauses by assumption
+                self.__solves = 0               # SAT solver invocations
+                self.__cache_hits = 0           # lookups satisfied by __cache
+                self.__cache_misses = 0
+                self.__trim_counts = None       # trimmed fmris by reason_id
                 self.__subphasename = None
                 self.__timings = []
                 self.__start_time = 0
@@ -268,6 +304,18 @@ class PkgSolver(object):
                 self.__dg_incorp_cache = {}        # cache for downgradable
                                                    # incorp deps
 
+                self.__facets = facets
+                self.__setup_cache_path = None
+                if cache_path and facets is not None:
+                        self.__setup_cache_path = cache_path
+                self.__setup_cache = []         # cached setups
+                self.__setup_key = None         # operation key
+                self.__setup = None             # setup to be cached
+                self.__setup_clauses = None     # clauses generated by setup
+                self.__setup_uncacheable = False # setup depends on root image
+                self.__setup_cache_hits = 0
+                self.__setup_cache_misses = 0
+
         def __str__(self):
                 s = "Solver: ["
                 if self.__state in [SOLVER_FAIL, SOLVER_SUCCESS]:
@@ -298,6 +346,8 @@ class PkgSolver(object):
                 This allows early garbage collection to take place, and should
                 be performed after a solution is successfully returned."""
 
+                self.__trim_counts = self.__count_trimmed()
+
                 self.__catalog = None
                 self.__installed_dict = {}
                 self.__installed_pkgs = frozenset()
@@ -326,6 +376,9 @@ class PkgSolver(object):
                 self.__allowed_downgrades = None
                 self.__dg_incorp_cache = None
                 self.__linked_pkgs = set()
+                self.__setup_cache = None
+                self.__setup = None
+                self.__setup_clauses = None
 
                 # Value 'DebugValues' is unsubscriptable;
                 # pylint: disable=E1136
@@ -336,6 +389,235 @@ class PkgSolver(object):
                 self.__trim_dict = None
                 return rval
 
+        def __get_catalog_key(self):
+                """Returns a list identifying the current state of the
+                solver's catalog or None if it can't be identified."""
+
+                lm = self.__catalog.last_modified
+                if not lm:
+                        return None
+                return [catalog.datetime_to_basic_ts(lm),
+                    self.__catalog.package_version_count,
+                    self.__catalog.signatures]
+
+        def __str2fmri(self, s):
+                """Returns the FMRI object for the FMRI string 's'."""
+
+                try:
+                        return self.__fmridict[s]
+                except KeyError:
+                        f = pkg.fmri.PkgFmri(s)
+                        self.__fmridict[s] = f
+                        return f
+
+        def __load_setup(self, op, existing_freezes, reject_set,
+            proposed_dict, *args):
+                """Determine the key identifying the operation in the solver
+                cache and return the cached setup for it or None if there
+                isn't one.
+
+                'op' is the name of the solve_*() method used.  The remaining
+                arguments are those of the operation; 'args' must be
+                serializable using JSON."""
+
+                if not self.__setup_cache_path:
+                        return None
+
+                key = [
+                    op,
+                    sorted(str(f) for f in self.__installed_fmris),
+                    sorted(
+                        [p] + list(pstate)
+                        for p, pstate in six.iteritems(self.__pub_ranks)
+                    ),
+                    sorted(six.iteritems(self.__variants)),
+                    sorted(six.iteritems(self.__facets)),
+                    sorted(self.__avoid_set),
+                    sorted([str(f), r] for f, r, _t in existing_freezes),
+                    self.__parent_pkgs is not None and
+                        sorted(str(f) for f in self.__parent_pkgs),
+                    dict(
+                        (name, [str(f) for f in flist])
+                        for name, flist in six.iteritems(proposed_dict or {})
+                    ),
+                    sorted(reject_set),
+                    list(args),
+                ]
+                self.__setup_key = hashlib.sha1(misc.force_bytes(json.dumps(
+                    key, sort_keys=True))).hexdigest()
+
+                cat_key = self.__get_catalog_key()
+                if cat_key is None:
+                        self.__setup_cache_path = None
+                        return None
+
+                try:
+                        with open(self.__setup_cache_path, "r") as f:
+                                version, ckey, entries = json.load(f)
+                        if version == self.__SOLVER_CACHE_VERSION and \
+                            ckey == cat_key:
+                                # Setups for a different catalog are
+                                # discarded when the cache is saved.
+                                self.__setup_cache = [
+                                    (k, setup)
+                                    for k, setup in entries
+                                    if isinstance(setup, dict)
+                                ]
+                except (EnvironmentError, ValueError, TypeError):
+                        # Missing, unreadable, or corrupt; it will be
+                        # replaced when the cache is saved.
+                        pass
+
+                for k, setup in self.__setup_cache:
+                        if k == self.__setup_key:
+                                self.__setup_cache_hits += 1
+                                return setup
+                self.__setup_cache_misses += 1
+                return None
+
+        def __restore_setup(self, setup, proposed_dict):
+                """Restore the state of the solver after setup for an
+                operation from the cached 'setup' and add the clauses that
+                were generated for it.  Returns the set of possible FMRIs.
+
+                'proposed_dict' contains user specified FMRI objects indexed by
+                pkg_name; versions that were trimmed are removed from it."""
+
+                tofmri = self.__str2fmri
+
+                reasons = []
+                for reason_id, reason, fmri_adds in setup["reasons"]:
+                        if isinstance(reason, list):
+                                reason = (reason[0], tuple(reason[1]))
+                        reasons.append((reason_id, reason,
+                            frozenset(tofmri(s) for s in fmri_adds)))
+                for s, idx in setup["trimmed"]:
+                        f = tofmri(s)
+                        self.__trim_dict[f].update(reasons[i] for i in idx)
+                        self.__mark_pub_trimmed(f.pkg_name)
+
+                self.__removal_fmris = set(
+                    tofmri(s) for s in setup["removal"])
+                self.__reject_set = frozenset(setup["reject"])
+                self.__req_pkg_names = frozenset(setup["required"])
+                self.__avoid_set = set(setup["avoid"])
+                self.__implicit_avoid_set = set(setup["implicit_avoid"])
+                self.__allowed_downgrades = set(
+                    tofmri(s) for s in setup["downgrades"])
+                self.__inc_list = [
+                    tofmri(s) for s in setup["incorporations"]
+                ]
+                self.__linked_pkgs = set(
+                    tofmri(s) for s in setup["linked"])
+                self.__known_incs = set(setup["known_incs"])
+                self.__depend_ts = setup["depend_ts"]
+
+                if proposed_dict is not None:
+                        for name, flist in six.iteritems(setup["proposed"]):
+                                flist = set(flist)
+                                proposed_dict[name] = [
+                                    f
+                                    for f in proposed_dict[name]
+                                    if str(f) in flist
+                                ]
+
+                possible_set = set(tofmri(s) for s in setup["possible"])
+                for f in possible_set:
+                        self.__mark_pub_trimmed(f.pkg_name)
+                self.__assign_fmri_ids(possible_set)
+                self.__addclauses(setup["clauses"])
+                return possible_set
+
+        def __record_setup(self, possible_set, proposed_dict):
+                """Record the state of the solver after setup for an
+                operation so that it can be cached once a solution has been
+                found."""
+
+                clauses = self.__setup_clauses
+                self.__setup_clauses = None
+                if clauses is None or self.__setup_uncacheable:
+                        return
+
+                # Trim reasons are shared by many FMRIs, so they're only
+                # stored once.
+                reasons = {}
+                trimmed = []
+                for f, tups in six.iteritems(self.__trim_dict):
+                        if not tups:
+                                continue
+                        trimmed.append([str(f), [
+                            reasons.setdefault(tup, len(reasons))
+                            for tup in tups
+                        ]])
+
+                reason_list = [None] * len(reasons)
+                for (reason_id, reason, fmri_adds), i in \
+                    six.iteritems(reasons):
+                        if not isinstance(reason, six.string_types):
+                                reason = [reason[0],
+                                    [str(a) for a in reason[1]]]
+                        reason_list[i] = [reason_id, reason,
+                            [str(f) for f in fmri_adds]]
+
+                self.__setup = {
+                    "possible": [str(f) for f in possible_set],
+                    "clauses": clauses,
+                    "reasons": reason_list,
+                    "trimmed": trimmed,
+                    "removal": [str(f) for f in self.__removal_fmris],
+                    "reject": sorted(self.__reject_set),
+                    "required": sorted(self.__req_pkg_names),
+                    "avoid": sorted(self.__avoid_set),
+                    "implicit_avoid": sorted(self.__implicit_avoid_set),
+                    "downgrades": [
+                        str(f) for f in self.__allowed_downgrades
+                    ],
+                    "incorporations": [str(f) for f in self.__inc_list],
+                    "linked": [str(f) for f in self.__linked_pkgs],
+                    "known_incs": sorted(self.__known_incs),
+                    "depend_ts": self.__depend_ts,
+                    "proposed": dict(
+                        (name, [str(f) for f in flist])
+                        for name, flist in six.iteritems(proposed_dict or {})
+                    ),
+                }
+
+        def __save_setup(self):
+                """Add the setup recorded for the operation to the solver
+                cache and save it.  Failure to do so is not fatal as the setup
+                is simply generated again by the next operation."""
+
+                if self.__setup is None:
+                        return
+
+                entries = [(self.__setup_key, self.__setup)]
+                entries.extend(
+                    (k, setup)
+                    for k, setup in self.__setup_cache
+                    if k != self.__setup_key
+                )
+                del entries[self.__SOLVER_CACHE_SIZE:]
+
+                cache_dir = os.path.dirname(self.__setup_cache_path)
+                tmp_file = None
+                try:
+                        misc.makedirs(cache_dir)
+                        fd, tmp_file = tempfile.mkstemp(dir=cache_dir,
+                            prefix="solver.")
+                        with os.fdopen(fd, "w") as f:
+                                json.dump((self.__SOLVER_CACHE_VERSION,
+                                    self.__get_catalog_key(), entries), f)
+                        os.chmod(tmp_file, misc.PKG_FILE_MODE)
+                        portable.rename(tmp_file, self.__setup_cache_path)
+                except (EnvironmentError, api_errors.ApiException):
+                        # Most likely an unprivileged user planning an
+                        # operation.
+                        if tmp_file:
+                                try:
+                                        portable.remove(tmp_file)
+                                except EnvironmentError:
+                                        pass
+
         def __progress(self):
                 """Bump progress tracker to indicate processing is active."""
                 assert self.__progitem
@@ -585,15 +867,16 @@ class PkgSolver(object):
                 for name in self.__possible_dict:
                         self.__progress()
                         # Ensure only one version of a package is installed
-                        self.__addclauses(self.__gen_highlander_clauses(
-                            self.__possible_dict[name]))
+                        clauses = self.__gen_highlander_clauses(
+                            self.__possible_dict[name])
                         # generate dependency clauses for each pkg
                         for fmri in self.__possible_dict[name]:
                                 for da in self.__get_dependency_actions(fmri,
                                     excludes=excludes):
-                                        self.__addclauses(
+                                        clauses.extend(
                                             self.__gen_dependency_clauses(fmri,
                                             da))
+                        self.__addclauses(clauses)
 
         def __generate_operation_clauses(self, proposed=None,
             proposed_dict=None):
@@ -666,6 +949,7 @@ class PkgSolver(object):
                 pt = self.__progtrack
                 self.__end_subphase()  # end the last subphase.
                 pt.plan_done(pt.PLAN_SOLVE_SOLVER)
+                self.__save_setup()
                 return self.__cleanup((self.__elide_possible_renames(solution,
                     excludes), (self.__avoid_set, self.__implicit_avoid_set,
                         self.__obs_set)))
@@ -955,8 +1239,6 @@ class PkgSolver(object):
                 # re-freeze reject set
                 reject_set = frozenset(r_set)
 
-                proposed_pkgs = set(proposed_dict)
-
                 if new_variants:
                         self.__variants = new_variants
 
@@ -984,6 +1266,87 @@ class PkgSolver(object):
                                 self.__publisher[name] = \
                                     proposed_dict[name][0].publisher
 
+                setup = self.__load_setup("install", existing_freezes,
+                    reject_set, proposed_dict, trim_proposed_installed,
+                    relax_all, ignore_inst_parent_deps, exact_install,
+                    sorted(str(f) for f in installed_dict_tmp.values()))
+                if setup is not None:
+                        possible_set = self.__restore_setup(setup,
+                            proposed_dict)
+                else:
+                        possible_set = self.__setup_install(existing_freezes,
+                            proposed_dict, excludes, reject_set,
+                            trim_proposed_installed, relax_all,
+                            ignore_inst_parent_deps, exact_install,
+                            installed_dict_tmp)
+                inc_list = self.__inc_list
+
+                pt.plan_done(pt.PLAN_SOLVE_SETUP)
+
+                self.__progitem = pt.PLAN_SOLVE_SOLVER
+                pt.plan_start(pt.PLAN_SOLVE_SOLVER)
+                self.__start_subphase(13)
+                # save a solver instance so we can come back here
+                # this is where errors happen...
+                saved_solver = self.__save_solver()
+                try:
+                        saved_solution = self.__solve()
+                except api_errors.PlanCreationException as exp:
+                        # no solution can be found.
+                        self.__raise_install_error(exp, inc_list, proposed_dict,
+                            possible_set, excludes)
+
+                self.__start_subphase(14)
+                # we have a solution that works... attempt to
+                # reduce collateral damage to other packages
+                # while still keeping command line pkgs at their
+                # optimum level
+
+                self.__restore_solver(saved_solver)
+
+                # fix the fmris that were specified on the cmd line
+                # at their optimum (newest) level along with the
+                # new dependencies, but try and avoid upgrading
+                # already installed pkgs or adding un-needed new pkgs.
+
+                for fmri in saved_solution:
+                        if fmri.pkg_name in proposed_dict:
+                                self.__addclauses(
+                                    self.__gen_one_of_these_clauses([fmri]))
+
+                self.__start_subphase(15)
+                # save context
+                saved_solver = self.__save_solver()
+
+                saved_solution = self.__solve(older=True)
+
+                self.__start_subphase(16)
+                # Now we have the oldest possible original fmris
+                # but we may have some that are not original
+                # Since we want to move as far forward as possible
+                # when we have to move a package, fix the originals
+                # and drive forward again w/ the remainder
+                self.__restore_solver(saved_solver)
+
+                for fmri in saved_solution & self.__installed_fmris:
+                        self.__addclauses(
+                            self.__gen_one_of_these_clauses([fmri]))
+
+                solution = self.__solve()
+                self.__progress()
+                solution = self.__update_solution_set(solution, excludes)
+
+                return self.__end_solve(solution, excludes)
+
+        def __setup_install(self, existing_freezes, proposed_dict,
+            excludes, reject_set, trim_proposed_installed, relax_all,
+            ignore_inst_parent_deps, exact_install, installed_dict_tmp):
+                """Private logic for solve_install() to determine the set of
+                possible FMRIs for the operation and generate the clauses for
+                them.  Returns the set of possible FMRIs."""
+
+                proposed_pkgs = set(proposed_dict)
+
                 # Determine which packages are to be removed, rejected, and
                 # avoided and also determine which ones must not be removed
                 # during the operation.
@@ -1205,6 +1568,11 @@ class PkgSolver(object):
                             possible_set, excludes)
 
                 self.__start_subphase(11)
+                if self.__setup_key and not self.__setup_uncacheable:
+                        # Record the clauses generated from here on so that
+                        # the setup for the operation can be cached.
+                        self.__setup_clauses = []
+
                 #
                 # Generate ids, possible_dict for clause generation.  Prepare
                 # the solver for invocation.
@@ -1228,62 +1596,8 @@ class PkgSolver(object):
                         self.__raise_install_error(exp, inc_list, proposed_dict,
                             possible_set, excludes)
 
-                pt.plan_done(pt.PLAN_SOLVE_SETUP)
-
-                self.__progitem = pt.PLAN_SOLVE_SOLVER
-                pt.plan_start(pt.PLAN_SOLVE_SOLVER)
-                self.__start_subphase(13)
-                # save a solver instance so we can come back here
-                # this is where errors happen...
-                saved_solver = self.__save_solver()
-                try:
-                        saved_solution = self.__solve()
-                except api_errors.PlanCreationException as exp:
-                        # no solution can be found.
-                        self.__raise_install_error(exp, inc_list, proposed_dict,
-                            possible_set, excludes)
-
-                self.__start_subphase(14)
-                # we have a solution that works... attempt to
-                # reduce collateral damage to other packages
-                # while still keeping command line pkgs at their
-                # optimum level
-
-                self.__restore_solver(saved_solver)
-
-                # fix the fmris that were specified on the cmd line
-                # at their optimum (newest) level along with the
-                # new dependencies, but try and avoid upgrading
-                # already installed pkgs or adding un-needed new pkgs.
-
-                for fmri in saved_solution:
-                        if fmri.pkg_name in proposed_dict:
-                                self.__addclauses(
-                                    self.__gen_one_of_these_clauses([fmri]))
-
-                self.__start_subphase(15)
-                # save context
-                saved_solver = self.__save_solver()
-
-                saved_solution = self.__solve(older=True)
-
-                self.__start_subphase(16)
-                # Now we have the oldest possible original fmris
-                # but we may have some that are not original
-                # Since we want to move as far forward as possible
-                # when we have to move a package, fix the originals
-                # and drive forward again w/ the remainder
-                self.__restore_solver(saved_solver)
-
-                for fmri in saved_solution & self.__installed_fmris:
-                        self.__addclauses(
-                            self.__gen_one_of_these_clauses([fmri]))
-
-                solution = self.__solve()
-                self.__progress()
-                solution = self.__update_solution_set(solution, excludes)
-
-                return self.__end_solve(solution, excludes)
+                self.__record_setup(possible_set, proposed_dict)
+                return possible_set
 
         def solve_update_all(self, existing_freezes, excludes=EmptyI,
             reject_set=frozenset()):
@@ -1303,6 +1617,94 @@ class PkgSolver(object):
 
                 pt = self.__begin_solve()
 
+                setup = self.__load_setup("update_all", existing_freezes,
+                    reject_set, None)
+                if setup is not None:
+                        possible_set = self.__restore_setup(setup, None)
+                else:
+                        possible_set = self.__setup_update_all(
+                            existing_freezes, excludes, reject_set)
+
+                pt.plan_done(pt.PLAN_SOLVE_SETUP)
+
+                self.__progitem = pt.PLAN_SOLVE_SOLVER
+                pt.plan_start(pt.PLAN_SOLVE_SOLVER)
+                self.__start_subphase(6)
+                try:
+                        solution = self.__solve()
+                except api_errors.PlanCreationException:
+                        # No solution can be found; attempt a full trim to see
+                        # if we can raise a sensible error.  If not, re-raise.
+                        self.__assert_trim_errors(possible_set, excludes)
+                        raise
+
+                self.__update_solution_set(solution, excludes)
+
+                for f in solution.copy():
+                        if self.__fmri_is_obsolete(f):
+                                solution.remove(f)
+
+                # If solution doesn't match installed set of packages, then an
+                # upgrade solution was found (heuristic):
+                if solution != self.__installed_fmris:
+                        return self.__end_solve(solution, excludes)
+
+                incorps = self.__get_installed_upgradeable_incorps(
+                    excludes)
+                if not incorps or self.__is_child():
+                        # If there are no installed, upgradeable incorporations,
+                        # then assume that no updates were available.  Also if
+                        # we're a linked image child we may not be able to
+                        # update to the latest available incorporations due to
+                        # parent constraints, so don't generate an error.
+                        return self.__end_solve(solution, excludes)
+
+                # Before making a guess, apply extra trimming to see if we can
+                # reject the operation based on changing packages.
+                self.__assert_trim_errors(possible_set, excludes)
+
+                # Despite all of the trimming done, we still don't know why the
+                # solver couldn't find a solution, so make a best-effort guess
+                # at the reason why.
+                skey = operator.attrgetter('pkg_name')
+                info = []
+                info.append(_("No solution found to update to latest available "
+                    "versions."))
+                info.append(_("This may indicate an overly constrained set of "
+                    "packages are installed."))
+                info.append(" ")
+                info.append(_("latest incorporations:"))
+                info.append(" ")
+                info.extend((
+                    "  {0}".format(f)
+                    for f in sorted(incorps, key=skey)
+                ))
+                info.append(" ")
+
+                ms = self.__generate_dependency_errors(incorps,
+                    excludes=excludes)
+                ms.extend(self.__check_installed())
+
+                if ms:
+                        info.append(_("The following indicates why the system "
+                            "cannot update to the latest version:"))
+                        info.append(" ")
+                        for s in ms:
+                                info.append("  {0}".format(s))
+                else:
+                        info.append(_("Dependency analysis is unable to "
+                            "determine the cause."))
+                        info.append(_("Try specifying expected versions to "
+                            "obtain more detailed error messages."))
+
+                self.__raise_solution_error(no_solution=info)
+
+        def __setup_update_all(self, existing_freezes, excludes,
+            reject_set):
+                """Private logic for solve_update_all() to determine the set
+                of possible FMRIs for the operation and generate the clauses
+                for them.  Returns the set of possible FMRIs."""
+
                 # Determine which packages are to be removed, rejected, and
                 # avoided and also determine which ones must not be removed
                 # during the operation.
@@ -1381,6 +1783,11 @@ class PkgSolver(object):
                 # remove all trimmed fmris from consideration
                 possible_set.difference_update(six.iterkeys(self.__trim_dict))
 
+                if self.__setup_key and not self.__setup_uncacheable:
+                        # Record the clauses generated from here on so that
+                        # the setup for the operation can be cached.
+                        self.__setup_clauses = []
+
                 #
                 # Generate ids, possible_dict for clause generation.  Prepare
                 # the solver for invocation.
@@ -1402,79 +1809,8 @@ class PkgSolver(object):
                         self.__assert_trim_errors(possible_set, excludes)
                         raise
 
-                pt.plan_done(pt.PLAN_SOLVE_SETUP)
-
-                self.__progitem = pt.PLAN_SOLVE_SOLVER
-                pt.plan_start(pt.PLAN_SOLVE_SOLVER)
-                self.__start_subphase(6)
-                try:
-                        solution = self.__solve()
-                except api_errors.PlanCreationException:
-                        # No solution can be found; attempt a full trim to see
-                        # if we can raise a sensible error.  If not, re-raise.
-                        self.__assert_trim_errors(possible_set, excludes)
-                        raise
-
-                self.__update_solution_set(solution, excludes)
-
-                for f in solution.copy():
-                        if self.__fmri_is_obsolete(f):
-                                solution.remove(f)
-
-                # If solution doesn't match installed set of packages, then an
-                # upgrade solution was found (heuristic):
-                if solution != self.__installed_fmris:
-                        return self.__end_solve(solution, excludes)
-
-                incorps = self.__get_installed_upgradeable_incorps(
-                    excludes)
-                if not incorps or self.__is_child():
-                        # If there are no installed, upgradeable incorporations,
-                        # then assume that no updates were available.  Also if
-                        # we're a linked image child we may not be able to
-                        # update to the latest available incorporations due to
-                        # parent constraints, so don't generate an error.
-                        return self.__end_solve(solution, excludes)
-
-                # Before making a guess, apply extra trimming to see if we can
-                # reject the operation based on changing packages.
-                self.__assert_trim_errors(possible_set, excludes)
-
-                # Despite all of the trimming done, we still don't know why the
-                # solver couldn't find a solution, so make a best-effort guess
-                # at the reason why.
-                skey = operator.attrgetter('pkg_name')
-                info = []
-                info.append(_("No solution found to update to latest available "
-                    "versions."))
-                info.append(_("This may indicate an overly constrained set of "
-                    "packages are installed."))
-                info.append(" ")
-                info.append(_("latest incorporations:"))
-                info.append(" ")
-                info.extend((
-                    "  {0}".format(f)
-                    for f in sorted(incorps, key=skey)
-                ))
-                info.append(" ")
-
-                ms = self.__generate_dependency_errors(incorps,
-                    excludes=excludes)
-                ms.extend(self.__check_installed())
-
-                if ms:
-                        info.append(_("The following indicates why the system "
-                            "cannot update to the latest version:"))
-                        info.append(" ")
-                        for s in ms:
-                                info.append("  {0}".format(s))
-                else:
-                        info.append(_("Dependency analysis is unable to "
-                            "determine the cause."))
-                        info.append(_("Try specifying expected versions to "
-                            "obtain more detailed error messages."))
-
-                self.__raise_solution_error(no_solution=info)
+                self.__record_setup(possible_set, None)
+                return possible_set
 
         def solve_uninstall(self, existing_freezes, uninstall_list, excludes,
             ignore_inst_parent_deps=False):
@@ -1596,8 +1932,12 @@ class PkgSolver(object):
 
         def __save_solver(self):
                 """Duplicate current current solver state and return it."""
-                return (self.__addclause_failure,
-                    pkg.solver.msat_solver(self.__solver))
+
+                if self.__addclause_failure:
+                        # A solver that needs to be reset can't be copied,
+                        # but it won't be used again either.
+                        return (True, self.__solver)
+                return (False, pkg.solver.msat_solver(self.__solver))
 
         def __restore_solver(self, solver):
                 """Set the current solver state to the previously saved one"""
@@ -1610,7 +1950,11 @@ class PkgSolver(object):
                 solution_vector = []
                 self.__state = SOLVER_FAIL
                 eliminated = set()
-                while not self.__addclause_failure and self.__solver.solve([]):
+                removed = set()         # fmris excluded from the solution
+                moving = True
+                solved = not self.__addclause_failure and \
+                    self.__sat_solve([])
+                while solved:
                         self.__progress()
                         self.__iterations += 1
 
@@ -1623,6 +1967,7 @@ class PkgSolver(object):
 
                         # prevent the selection of any older pkgs except for
                         # those that are part of the set of allowed downgrades;
+                        exclusions = []
                         for fid in solution_vector:
                                 pfmri = self.__getfmri(fid)
                                 matching, remaining = \
@@ -1638,14 +1983,30 @@ class PkgSolver(object):
                                 else:
                                         remove = matching - set([pfmri]) - \
                                             eliminated
-                                for f in remove:
-                                        self.__addclauses([[-self.__getid(f)]])
-
+                                exclusions.extend(
+                                    [-self.__getid(f)]
+                                    for f in remove - removed
+                                )
+                                removed.update(remove)
+                        self.__addclauses(exclusions)
+
+                        # Rather than moving a single package at a time,
+                        # first try to move every package that can be moved;
+                        # once that fails, it's unlikely to succeed again.
+                        # (The current solution still satisfies the clauses
+                        # at this point, so a failure doesn't require the
+                        # solver to be reset.)
+                        if moving and not self.__addclause_failure:
+                                moving = self.__solve_moving(solution_vector,
+                                    removed, older)
 
                         # prevent the selection of this exact combo;
                         # permit [] solution
                         self.__addclauses([[-i for i in solution_vector]])
 
+                        solved = not self.__addclause_failure and (moving or
+                            self.__sat_solve([]))
+
                 if not self.__iterations:
                         self.__raise_solution_error(no_solution=True)
 
@@ -1655,12 +2016,51 @@ class PkgSolver(object):
 
                 return solution
 
+        def __solve_moving(self, solution_vector, removed, older):
+                """Attempt to find a solution in which every package of the
+                given solution vector that still has a newer (or older, if
+                'older' is True) version that can be selected moves to one of
+                them.  'removed' is the set of fmris that may not be selected.
+
+                The requirement is only applied by assumption, so if no such
+                solution exists the solver remains usable.  Returns a boolean
+                indicating whether a solution was found."""
+
+                movable = []
+                for fid in solution_vector:
+                        pfmri = self.__getfmri(fid)
+                        ids = [
+                            self.__getid(f)
+                            for f in self.__possible_dict[pfmri.pkg_name]
+                            if (f < pfmri if older else f > pfmri) and
+                                f not in removed
+                        ]
+                        if ids:
+                                movable.append(ids)
+
+                if not movable:
+                        return False
+
+                # The clauses only apply while this new variable is assumed
+                # to be true; they're retired afterwards.
+                self.__activations += 1
+                act = self.__variables + self.__activations
+                self.__solver.hint_variables(act)
+                self.__addclauses([[-act] + ids for ids in movable])
+                found = self.__sat_solve([act])
+                self.__addclauses([[-act]])
+                return found
+
+        def __sat_solve(self, assumptions):
+                """Run the SAT solver with the given assumptions, returning
+                whether a solution was found."""
+
+                self.__solves += 1
+                return self.__solver.solve(assumptions)
+
         def __get_solution_vector(self):
                 """Return solution vector from solver"""
-                return frozenset([
-                    (i + 1) for i in range(self.__solver.get_variables())
-                    if self.__solver.dereference(i)
-                ])
+                return frozenset(self.__solver.get_solution(self.__variables))
 
         def __assign_possible(self, possible_set):
                 """Assign __possible_dict of possible package FMRIs by pkg stem
@@ -1700,7 +2100,10 @@ class PkgSolver(object):
 
         def __get_fmris_by_version(self, pkg_name):
                 """Cache for catalog entries; helps performance"""
-                if pkg_name not in self.__cache:
+                if pkg_name in self.__cache:
+                        self.__cache_hits += 1
+                else:
+                        self.__cache_misses += 1
                         self.__cache[pkg_name] = [
                             t
                             for t in self.__catalog.fmris_by_version(pkg_name)
@@ -1737,6 +2140,7 @@ class PkgSolver(object):
                 tp = (fmri, dotrim, constraint, obsolete_ok) # cache index
                 # determine if the data is cacheable or cached:
                 if (not self.__trimdone and dotrim) or tp not in self.__cache:
+                        self.__cache_misses += 1
                         # use frozensets so callers don't inadvertently update
                         # these sets (which may be cached).
                         all_fmris = set(self.__get_catalog_fmris(fmri.pkg_name))
@@ -1757,6 +2161,8 @@ class PkgSolver(object):
                                 return matching, remaining
                         # cache the result
                         self.__cache[tp] = (matching, remaining)
+                else:
+                        self.__cache_hits += 1
 
                 return self.__cache[tp]
 
@@ -2522,6 +2928,52 @@ class PkgSolver(object):
                         needs_processing |= newfmris - already_processed
                 return ret
 
+        def __count_trimmed(self):
+                """Returns a dictionary of the number of fmris trimmed from
+                consideration indexed by the name of the reason."""
+
+                counts = {}
+                for reasons in six.itervalues(self.__trim_dict):
+                        for reason_id in set(r[0] for r in reasons):
+                                name = _TRIM_NAMES[reason_id]
+                                counts[name] = counts.get(name, 0) + 1
+                return counts
+
+        def get_profile(self):
+                """Returns a dictionary describing the work done by the
+                solver for the last operation: the time taken by each
+                subphase, the number of variables and clauses generated, the
+                number of SAT solver iterations and invocations, the number of
+                fmris trimmed for each reason, the hit rates of the solver's
+                caches, and whether the setup for the operation was found in
+                the solver cache.  It only contains types that can be
+                serialized using JSON."""
+
+                trimmed = self.__trim_counts
+                if trimmed is None:
+                        trimmed = self.__count_trimmed()
+
+                return {
+                    "state": self.__state,
+                    "variables": self.__variables,
+                    "clauses": self.__clauses,
+                    "iterations": self.__iterations,
+                    "solves": self.__solves,
+                    "timings": [
+                        [name, round(t, 6)]
+                        for name, t in self.__timings
+                    ],
+                    "trimmed": trimmed,
+                    "cache": {
+                        "hits": self.__cache_hits,
+                        "misses": self.__cache_misses,
+                    },
+                    "setup_cache": {
+                        "hits": self.__setup_cache_hits,
+                        "misses": self.__setup_cache_misses,
+                    },
+                }
+
         def get_trim_errors(self):
                 """Returns a list of strings for all FMRIs evaluated by the
                 solver explaining why they were rejected.  (All packages
@@ -2865,14 +3317,41 @@ class PkgSolver(object):
         def __addclauses(self, clauses):
                 """add list of clause lists to solver"""
 
-                for c in clauses:
-                        try:
-                                if not self.__solver.add_clause(c):
-                                        self.__addclause_failure = True
-                                self.__clauses += 1
-                        except TypeError:
-                                raise TypeError(_("List of integers, not {0}, "
-                                    "expected").format(c))
+                if not clauses:
+                        return
+
+                if self.__setup_clauses is not None:
+                        self.__setup_clauses.extend(clauses)
+
+                self.__clauses += len(clauses)
+                if self.__addclause_failure:
+                        # Once the clauses can't be satisfied, the solver
+                        # needs to be reset before any more can be added.
+                        return
+
+                try:
+                        # Pass all of the clauses to the solver in a single
+                        # call as a list of integers with each clause
+                        # terminated by 0.
+                        flat = []
+                        for c in clauses:
+                                flat.extend(c)
+                                flat.append(0)
+                        if not self.__solver.add_clauses(flat):
+                                self.__addclause_failure = True
+                except TypeError:
+                        bad = None
+                        for c in clauses:
+                                if not isinstance(c, (list, tuple)) or \
+                                    not c or not all(
+                                    isinstance(l, six.integer_types) and l
+                                    for l in c):
+                                        bad = c
+                                        break
+                        if bad is None:
+                                raise
+                        raise TypeError(_("List of integers, not {0}, "
+                            "expected").format(bad))
 
         def __get_child_holds(self, install_holds, pkg_cons, inc_set):
                 """Returns the list of installed packages that are incorporated
@@ -3292,6 +3771,11 @@ class PkgSolver(object):
                         req_fmri = pkg.fmri.PkgFmri(da.attrs["fmri"])
 
                         if da.attrs.get("root-image", "").lower() == "true":
+                                # The outcome depends on the running system,
+                                # so the setup for the operation can't be
+                                # cached.
+                                self.__setup_uncacheable = True
+
                                 # Are firmware (driver) updates needed?
                                 if req_fmri.pkg_name.startswith(
                                     "feature/firmware/"):
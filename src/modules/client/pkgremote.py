@@ -72,6 +72,7 @@ class PkgRemote(object):
                 self.__rpc_server_fstdout = None
                 self.__rpc_server_fstderr = None
                 self.__rpc_server_prog_pipe_fobj = None
+                self.__rpc_server_env = None
 
                 # initialize RPC client process state
                 self.__rpc_client = None
@@ -147,10 +148,12 @@ class PkgRemote(object):
                         # Redefinition of p type
                         if six.PY2:
                                 p = pkg.pkgsubprocess.Popen(pkg_cmd,
-                                    stdout=fstdout, stderr=fstderr)
+                                    stdout=fstdout, stderr=fstderr,
+                                    env=self.__rpc_server_env)
                         else:
                                 p = subprocess.Popen(pkg_cmd,
                                     stdout=fstdout, stderr=fstderr,
+                                    env=self.__rpc_server_env,
                                     pass_fds=(server_cmd_pipe,
                                     server_prog_pipe_fobj.fileno()))
 
@@ -415,6 +418,13 @@ class PkgRemote(object):
                 # drain the progress pipe
                 self.__rpc_client_prog_pipe_drain()
 
+        def set_environ(self, env):
+                """Set the environment that "pkg remote" server processes
+                are started with.  If 'env' is None, they inherit the
+                environment of the current process."""
+
+                self.__rpc_server_env = env
+
         def setup(self, img_path, pkg_op, **kwargs):
                 """Public interface to setup a remote packaging operation.
 
@@ -192,6 +192,7 @@ class PlanDescription(object):
                 }
                 self._solver_summary = []
                 self._solver_errors = None
+                self._solver_profile = None
                 self.li_attach = False
                 self.li_ppkgs = frozenset()
                 self.li_ppubs = None
@@ -719,6 +720,16 @@ class PlanDescription(object):
 
                 return self._solver_errors
 
+        def get_solver_profile(self):
+                """Returns a dictionary describing the work done by the solver
+                to create this plan (see PkgSolver.get_profile), or None if
+                the solver wasn't used."""
+
+                assert self.state >= EVALUATED_PKGS, \
+                        "{0} >= {1}".format(self.state, EVALUATED_PKGS)
+
+                return self._solver_profile
+
         def get_parsable_plan(self, parsable_version, child_images=None,
             api_inst=None):
                 """Display the parsable version of the plan."""
@@ -1961,6 +1961,8 @@ pkg unset-publisher {0}
                         if include_updates:
                                 for update in attrs.updates:
                                         flist.append(update)
+                                for delta in attrs.deltas:
+                                        flist.append(delta)
 
                 if flist:
                         # More catalog files to retrieve.
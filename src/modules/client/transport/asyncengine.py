@@ -0,0 +1,392 @@
+#!/usr/bin/python
+#
+# CDDL HEADER START
+#
+# The contents of this file are subject to the terms of the
+# Common Development and Distribution License (the "License").
+# You may not use this file except in compliance with the License.
+#
+# You can obtain a copy of the license at usr/src/OPENSOLARIS.LICENSE
+# or http://www.opensolaris.org/os/licensing.
+# See the License for the specific language governing permissions
+# and limitations under the License.
+#
+# When distributing Covered Code, include this CDDL HEADER in each
+# file and include the License file at usr/src/OPENSOLARIS.LICENSE.
+# If applicable, add the following below this CDDL HEADER, with the
+# fields enclosed by brackets "[]" replaced with your own identifying
+# information: Portions Copyright [yyyy] [name of copyright owner]
+#
+# CDDL HEADER END
+#
+
+#
+# Copyright (c) 2017, Oracle and/or its affiliates. All rights reserved.
+#
+
+"""An asyncio facade over the curl transport engine, for callers that run
+an event loop and want to retrieve several resources concurrently without
+using threads.  The facade drives its own CurlTransportEngine using
+libcurl's socket and timer callbacks, so it coexists with the blocking
+transport operations, which use a different engine."""
+
+import asyncio
+import os
+import pycurl
+
+from io import BytesIO
+from six.moves.urllib.parse import quote, urljoin
+
+import pkg.client.transport.engine as engine
+import pkg.client.transport.exception as tx
+
+from pkg.misc import force_str
+
+
+class AsyncTransportEngine(object):
+        """Retrieves resources using a CurlTransportEngine driven by an
+        asyncio event loop.
+
+        Each retrieval method returns an asyncio.Future, which callers can
+        await or add callbacks to.  Transient errors are reported in the
+        same way as by the blocking transport: the future is given the
+        transport exception as its exception, or, for get_files(), the
+        exceptions are its result.  Cancelling a future removes its
+        request from the engine."""
+
+        def __init__(self, transport, max_conn=20, loop=None):
+                """'transport' is the Transport object whose statistics
+                are updated by the requests; 'max_conn' is the maximum
+                number of requests performed at once, and 'loop' is the
+                event loop to use; by default, the current event loop is
+                used."""
+
+                self.__xport = transport
+                self.__loop = loop or asyncio.get_event_loop()
+                self.__engine = engine.CurlTransportEngine(transport,
+                    max_conn=max_conn)
+                self.__engine.set_socket_callbacks(self.__socket_cb,
+                    self.__timer_cb)
+                # Events being waited for, keyed by file descriptor.
+                self.__fds = {}
+                self.__timer = None
+                # Futures of the requests in progress, the functions
+                # returning their results, and the files the content is
+                # retrieved into, keyed by URL.
+                self.__pending = {}
+
+        def __socket_cb(self, what, sockfd, multi, data):
+                """Called by libcurl to change the events that are waited
+                for on 'sockfd'."""
+
+                loop = self.__loop
+                events = self.__fds.pop(sockfd, 0)
+                if events & pycurl.POLL_IN:
+                        loop.remove_reader(sockfd)
+                if events & pycurl.POLL_OUT:
+                        loop.remove_writer(sockfd)
+                if what == pycurl.POLL_REMOVE:
+                        return
+
+                if what & pycurl.POLL_IN:
+                        loop.add_reader(sockfd, self.__action, sockfd,
+                            pycurl.CSELECT_IN)
+                if what & pycurl.POLL_OUT:
+                        loop.add_writer(sockfd, self.__action, sockfd,
+                            pycurl.CSELECT_OUT)
+                self.__fds[sockfd] = what
+
+        def __timer_cb(self, timeout_ms):
+                """Called by libcurl to change when it next needs to perform
+                work if no socket is ready before then."""
+
+                if self.__timer:
+                        self.__timer.cancel()
+                        self.__timer = None
+                if timeout_ms >= 0:
+                        # old-division; pylint: disable=W1619
+                        self.__timer = self.__loop.call_later(
+                            timeout_ms / 1000.0, self.__action,
+                            pycurl.SOCKET_TIMEOUT, 0)
+
+        def __action(self, sockfd, ev_bitmask):
+                """Have the engine perform the work that is ready, then
+                complete the futures of the requests that finished."""
+
+                if sockfd == pycurl.SOCKET_TIMEOUT:
+                        self.__timer = None
+
+                try:
+                        self.__engine.socket_action(sockfd, ev_bitmask)
+                except tx.ExcessiveTransientFailure as e:
+                        # As with the blocking transport, give up on all of
+                        # the outstanding requests.
+                        self.__engine.reset()
+                        self.__fail_all(e)
+                        return
+                except tx.TransportException as e:
+                        # A permanent failure; fail the request it is for.
+                        entry = self.__pending.pop(getattr(e, "url", None),
+                            None)
+                        if entry:
+                                fut = entry[0]
+                                if not fut.done():
+                                        fut.set_exception(e)
+                        else:
+                                self.__engine.reset()
+                                self.__fail_all(e)
+                                return
+
+                self.__complete()
+
+        def __complete(self):
+                """Complete the futures of the requests that finished."""
+
+                if not self.__pending:
+                        return
+
+                errors, success = self.__engine.check_status(
+                    list(self.__pending), good_reqs=True)
+                for e in errors:
+                        fut = self.__pending.pop(e.url)[0]
+                        if not fut.done():
+                                fut.set_exception(e)
+                for url in success:
+                        fut, result, filepath = self.__pending.pop(url)
+                        if fut.done():
+                                continue
+                        try:
+                                fut.set_result(result())
+                        except Exception as e:
+                                fut.set_exception(e)
+
+        def __fail_all(self, ex):
+                """Fail all of the outstanding requests with 'ex'."""
+
+                pending = self.__pending
+                self.__pending = {}
+                for fut, result, filepath in pending.values():
+                        if not fut.done():
+                                fut.set_exception(ex)
+
+        def __add(self, url, result, filepath=None, **kwargs):
+                """Queue a request for 'url' with the engine and return a
+                future that is given the value returned by 'result' once
+                the request completes.  The content is retrieved into the
+                file 'filepath', if given.  Any remaining keyword arguments
+                are passed to the engine's add_url()."""
+
+                fut = self.__loop.create_future()
+                if url in self.__pending:
+                        pfut, presult, pfilepath = self.__pending[url]
+                        if pfilepath == filepath:
+                                # Share the request that is already in
+                                # progress.
+                                return pfut
+
+                        # The engine identifies requests by URL alone, so
+                        # the same content can't be retrieved into another
+                        # file until the request in progress is done.
+                        fut.set_exception(tx.TransportOperationError(
+                            "{0} is already being retrieved into {1}".format(
+                            url, pfilepath)))
+                        return fut
+
+                self.__pending[url] = (fut, result, filepath)
+                self.__engine.add_url(url, filepath=filepath, **kwargs)
+
+                def done(f):
+                        if f.cancelled() and \
+                            self.__pending.get(url, (None,))[0] is f:
+                                del self.__pending[url]
+                                self.__engine.remove_request(url, None)
+                fut.add_done_callback(done)
+
+                # Starting a request has libcurl set a timer for the work
+                # needed to perform it.
+                self.__engine.start_requests()
+                return fut
+
+        def __repo_args(self, repouri):
+                """Return the keyword arguments for add_url() needed to
+                retrieve content from the TransportRepoURI 'repouri', and
+                make sure statistics are kept for it."""
+
+                rs = self.__xport.stats.get_repostats([repouri])[0][0]
+                return {
+                    "repourl": rs.url,
+                    "proxy": repouri.proxy,
+                    "runtime_proxy": repouri.runtime_proxy,
+                    "sslcert": repouri.ssl_cert,
+                    "sslkey": repouri.ssl_key,
+                }
+
+        @staticmethod
+        def __request_url(repouri, methodstr, pub=None):
+                """Return the URL of the operation 'methodstr' for the
+                publisher 'pub' of the repository 'repouri'.  Repositories
+                are assumed to support version 1 of the publisher
+                operation."""
+
+                base = repouri.uri
+                if not base.endswith("/"):
+                        base += "/"
+                prefix = getattr(pub, "prefix", pub)
+                if prefix and not base.endswith("/{0}/".format(prefix)):
+                        base = urljoin(base, prefix) + "/"
+                return urljoin(base, methodstr)
+
+        def get_url(self, repouri, url, header=None, compressible=False):
+                """Return a future for the content of 'url', which belongs
+                to the repository described by the TransportRepoURI
+                'repouri', as bytes.
+
+                'header' is an optional dictionary of headers to send with
+                the request, and 'compressible' indicates whether the
+                content may be compressed in transit."""
+
+                buf = BytesIO()
+                return self.__add(url, buf.getvalue, writefunc=buf.write,
+                    header=header, compressible=compressible,
+                    **self.__repo_args(repouri))
+
+        def get_manifest(self, repouri, fmri, header=None, pub=None):
+                """Return a future for the text of the manifest of the
+                package 'fmri' in the repository 'repouri'.  'pub' is the
+                optional publisher or publisher prefix of the package."""
+
+                url = self.__request_url(repouri, "manifest/0/", pub=pub) + \
+                    fmri.get_url_path()
+                fut = self.get_url(repouri, url, header=header,
+                    compressible=True)
+                return self.__then(fut, force_str)
+
+        def get_catalog1(self, repouri, filelist, dest, header=None,
+            pub=None):
+                """Return a future for retrieving the catalog parts named in
+                'filelist' from the repository 'repouri' into the directory
+                'dest'.  Its result is a list of the transient errors that
+                occurred, as for get_files()."""
+
+                baseurl = self.__request_url(repouri, "catalog/1/", pub=pub)
+                return self.__get_list(repouri, baseurl, filelist, dest,
+                    header=header, compressible=True)
+
+        def get_files(self, repouri, filelist, dest, version=0, header=None,
+            pub=None):
+                """Return a future for retrieving the files whose hashes are
+                listed in 'filelist' from the repository 'repouri' into the
+                directory 'dest', using version 'version' of the file
+                operation.  Its result is a list of the transient errors
+                that occurred; each has a 'request' attribute naming the
+                file it is for.  Files that were not in the list of errors
+                were retrieved."""
+
+                baseurl = self.__request_url(repouri,
+                    "file/{0}/".format(version), pub=pub)
+                return self.__get_list(repouri, baseurl, filelist, dest,
+                    header=header)
+
+        def __get_list(self, repouri, baseurl, filelist, dest, header=None,
+            compressible=False):
+                """Retrieve each of the names in 'filelist', relative to
+                'baseurl', into a file of the same name in 'dest'."""
+
+                kwargs = self.__repo_args(repouri)
+                result = self.__loop.create_future()
+                if not filelist:
+                        result.set_result([])
+                        return result
+
+                futs = []
+                for f in filelist:
+                        url = urljoin(baseurl, quote(f))
+                        fut = self.__add(url, lambda: None,
+                            filepath=os.path.join(dest, f), header=header,
+                            compressible=compressible, **kwargs)
+                        futs.append(self.__then(fut, lambda r, f=f: None,
+                            request=f))
+
+                def gathered(g):
+                        if result.done():
+                                return
+                        if g.cancelled():
+                                result.cancel()
+                                return
+                        errors = []
+                        for r in g.result():
+                                if r is None:
+                                        continue
+                                if not isinstance(r, tx.TransportException) \
+                                    or isinstance(r,
+                                    tx.ExcessiveTransientFailure) or \
+                                    not r.retryable:
+                                        result.set_exception(r)
+                                        return
+                                errors.append(r)
+                        result.set_result(errors)
+
+                gfut = asyncio.gather(*futs, return_exceptions=True)
+                gfut.add_done_callback(gathered)
+                result.add_done_callback(
+                    lambda r: r.cancelled() and gfut.cancel())
+                return result
+
+        def __then(self, fut, func, request=None):
+                """Return a future for the value 'func' returns when called
+                with the result of 'fut'.  If 'request' is not None, it is
+                recorded in any exception 'fut' fails with."""
+
+                result = self.__loop.create_future()
+
+                def done(f):
+                        if result.done():
+                                return
+                        if f.cancelled():
+                                result.cancel()
+                                return
+                        ex = f.exception()
+                        if ex is not None:
+                                if request is not None:
+                                        ex.request = request
+                                result.set_exception(ex)
+                                return
+                        try:
+                                result.set_result(func(f.result()))
+                        except Exception as e:
+                                result.set_exception(e)
+
+                fut.add_done_callback(done)
+                result.add_done_callback(
+                    lambda r: r.cancelled() and fut.cancel())
+                return result
+
+        @property
+        def pending(self):
+                """True if there are requests that haven't completed."""
+
+                return bool(self.__pending)
+
+        def set_user_agent(self, ua_str):
+                """Set the User-Agent sent with each request."""
+
+                self.__engine.set_user_agent(ua_str)
+
+        def shutdown(self):
+                """Cancel the outstanding requests and release the
+                engine's resources."""
+
+                for fut, result, filepath in list(self.__pending.values()):
+                        fut.cancel()
+                self.__pending = {}
+                if self.__timer:
+                        self.__timer.cancel()
+                        self.__timer = None
+                self.__engine.reset()
+                for sockfd, events in self.__fds.items():
+                        if events & pycurl.POLL_IN:
+                                self.__loop.remove_reader(sockfd)
+                        if events & pycurl.POLL_OUT:
+                                self.__loop.remove_writer(sockfd)
+                self.__fds = {}
+                self.__engine.shutdown()
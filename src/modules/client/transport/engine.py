@@ -31,6 +31,7 @@ import os
 import pycurl
 import six
 import time
+import zlib
 
 from six.moves import http_client
 from six.moves.urllib.parse import urlsplit
@@ -81,6 +82,9 @@ class CurlTransportEngine(TransportEngine):
                 self.__success = []
                 # List of Orphaned URLs.
                 self.__orphans = set()
+                # Digests of files computed during their transfer, keyed
+                # by filepath.
+                self.__digests = {}
                 # Set default file buffer size at 128k, callers override
                 # this setting after looking at VFS block size.
                 self.__file_bufsz = 131072
@@ -89,27 +93,64 @@ class CurlTransportEngine(TransportEngine):
                 self.__common_header = {}
                 self.__last_stall_check = 0
 
-                # Set options on multi-handle
-                self.__mhandle.setopt(pycurl.M_PIPELINING, 0)
+                # Set options on multi-handle.  If it was requested and
+                # libcurl supports it, HTTP/2 is negotiated so that
+                # concurrent requests to a repository are multiplexed over
+                # a few connections.
+                self.__multiplex = global_settings.PKG_CLIENT_HTTP2 and \
+                    bool(pycurl.version_info()[4] &
+                    getattr(pycurl, "VERSION_HTTP2", 0))
+                if self.__multiplex:
+                        self.__mhandle.setopt(pycurl.M_PIPELINING,
+                            pycurl.PIPE_MULTIPLEX)
+                else:
+                        self.__mhandle.setopt(pycurl.M_PIPELINING, 0)
 
                 # initialize easy handles
                 for i in range(self.__max_handles):
-                        eh = pycurl.Curl()
-                        eh.url = None
-                        eh.repourl = None
-                        eh.fobj = None
-                        eh.r_fobj = None
-                        eh.filepath = None
-                        eh.success = False
-                        eh.fileprog = None
-                        eh.filetime = -1
-                        eh.starttime = -1
-                        eh.uuid = None
-                        self.__chandles.append(eh)
+                        self.__chandles.append(self.__new_handle())
 
                 # copy handles into handle freelist
                 self.__freehandles = self.__chandles[:]
 
+        @staticmethod
+        def __new_handle():
+                """Return a new curl easy handle with the attributes the
+                engine keeps for each request."""
+
+                eh = pycurl.Curl()
+                eh.url = None
+                eh.repourl = None
+                eh.fobj = None
+                eh.r_fobj = None
+                eh.filepath = None
+                eh.success = False
+                eh.fileprog = None
+                eh.digest = None
+                eh.resume_path = None
+                eh.filetime = -1
+                eh.starttime = -1
+                eh.uuid = None
+                return eh
+
+        def __multiplexed(self, hdl):
+                """Return true if the request performed by the handle 'hdl'
+                was multiplexed over a connection that had already been
+                established for another request."""
+
+                return self.__multiplex and \
+                    hdl.getinfo(pycurl.NUM_CONNECTS) == 0 and \
+                    hdl.getinfo(pycurl.INFO_HTTP_VERSION) == \
+                    pycurl.CURL_HTTP_VERSION_2_0
+
+        def __can_add_handle(self):
+                """Return true if another request can be started without
+                exceeding the number of concurrent connections allowed."""
+
+                return bool(self.__freehandles) and \
+                    len(self.__chandles) - len(self.__freehandles) < \
+                    self.__max_handles
+
         def __call_perform(self):
                 """An internal method that invokes the multi-handle's
                 perform method."""
@@ -125,7 +166,8 @@ class CurlTransportEngine(TransportEngine):
         def add_url(self, url, filepath=None, writefunc=None, header=None,
             progclass=None, progtrack=None, sslcert=None, sslkey=None,
             repourl=None, compressible=False, failonerror=True, proxy=None,
-            runtime_proxy=None):
+            runtime_proxy=None, hash_func=None, hash_decompressed=False,
+            resume_path=None):
                 """Add a URL to the transport engine.  Caller must supply
                 either a filepath where the file should be downloaded,
                 or a callback to a function that will peform the write.
@@ -134,6 +176,14 @@ class CurlTransportEngine(TransportEngine):
                 it should pass the tracker in progtrack.  The caller should
                 also supply a class that wraps the tracker in progclass.
 
+                'hash_func' and 'hash_decompressed' request that the digest
+                of the file be computed while it is downloaded; it can be
+                obtained using get_digest() once the transfer completes.
+
+                'resume_path' is where the partially downloaded content of
+                filepath is kept if the transfer fails; a later request with
+                the same resume_path continues from where it stopped.
+
                 'proxy' is the persistent proxy value for this url and is
                 stored as part of the transport stats accounting.
 
@@ -145,7 +195,9 @@ class CurlTransportEngine(TransportEngine):
                     progtrack=progtrack, sslcert=sslcert, sslkey=sslkey,
                     repourl=repourl, compressible=compressible,
                     failonerror=failonerror, proxy=proxy,
-                    runtime_proxy=runtime_proxy)
+                    runtime_proxy=runtime_proxy, hash_func=hash_func,
+                    hash_decompressed=hash_decompressed,
+                    resume_path=resume_path)
 
                 self.__req_q.appendleft(t)
 
@@ -228,6 +280,15 @@ class CurlTransportEngine(TransportEngine):
                         # pkg.client.publisher.TransportRepoURI.key()
                         repostats = self.__xport.stats[(h.repourl, h.proxy)]
                         visited_repos.add(repostats)
+
+                        # If the content retrieved earlier could not be used
+                        # to resume the transfer, discard it so that the
+                        # request is retried from the start.
+                        if en in (pycurl.E_RANGE_ERROR,
+                            pycurl.E_BAD_DOWNLOAD_RESUME) or \
+                            h.getinfo(pycurl.RESPONSE_CODE) == \
+                            http_client.REQUESTED_RANGE_NOT_SATISFIABLE:
+                                h.resume_path = None
                         repostats.record_tx()
                         nbytes = h.getinfo(pycurl.SIZE_DOWNLOAD)
                         seconds = h.getinfo(pycurl.TOTAL_TIME)
@@ -246,8 +307,11 @@ class CurlTransportEngine(TransportEngine):
                         # for a request using http(s), then it was pipelined and
                         # the total time must be obtained by subtracting the
                         # time the transfer of the individual request started
-                        # from the total time.
-                        if conn_time == 0 and proto in pipelined_protocols:
+                        # from the total time.  The same is true of requests
+                        # multiplexed over an HTTP/2 connection.
+                        multiplexed = self.__multiplexed(h)
+                        if conn_time == 0 and (multiplexed or
+                            proto in pipelined_protocols):
                                 # Only performing this subtraction when the
                                 # conn_time is 0 allows the first request in
                                 # the pipeline to properly include connection
@@ -266,9 +330,14 @@ class CurlTransportEngine(TransportEngine):
 
                         # Only count connections if the connection time is
                         # positive for http(s); for all other protocols,
-                        # record the connection regardless.
+                        # record the connection regardless.  Requests
+                        # multiplexed over an existing connection are
+                        # recorded as such.
                         if conn_count > 0 and conn_time > 0:
                                 repostats.record_connection(conn_time)
+                        elif multiplexed:
+                                repostats.record_connection(0,
+                                    multiplexed=True)
 
                         respcode = h.getinfo(pycurl.RESPONSE_CODE)
 
@@ -343,8 +412,11 @@ class CurlTransportEngine(TransportEngine):
                         # for a request using http(s), then it was pipelined and
                         # the total time must be obtained by subtracting the
                         # time the transfer of the individual request started
-                        # from the total time.
-                        if conn_time == 0 and proto in pipelined_protocols:
+                        # from the total time.  The same is true of requests
+                        # multiplexed over an HTTP/2 connection.
+                        multiplexed = self.__multiplexed(h)
+                        if conn_time == 0 and (multiplexed or
+                            proto in pipelined_protocols):
                                 # Only performing this subtraction when the
                                 # conn_time is 0 allows the first request in
                                 # the pipeline to properly include connection
@@ -375,18 +447,30 @@ class CurlTransportEngine(TransportEngine):
 
                         # Only count connections if the connection time is
                         # positive for http(s); for all other protocols,
-                        # record the connection regardless.
+                        # record the connection regardless.  Requests
+                        # multiplexed over an existing connection are
+                        # recorded as such.
                         if conn_count > 0 and conn_time > 0:
                                 repostats.record_connection(conn_time)
+                        elif multiplexed:
+                                repostats.record_connection(0,
+                                    multiplexed=True)
 
                         respcode = h.getinfo(pycurl.RESPONSE_CODE)
 
                         if proto not in response_protocols or \
-                            respcode == http_client.OK:
+                            respcode in (http_client.OK,
+                            http_client.PARTIAL_CONTENT):
                                 h.success = True
+                                if h.digest:
+                                        self.__digests[h.filepath] = \
+                                            h.digest.hexdigest()
                                 repostats.clear_consecutive_errors()
                                 success.append(url)
                         else:
+                                # Whatever was written is not the content
+                                # that was requested.
+                                h.resume_path = None
                                 proto_reason = None
                                 if proto in tx.proto_code_map:
                                         # Look up protocol error code map
@@ -522,6 +606,14 @@ class CurlTransportEngine(TransportEngine):
 
                 return rf, rs
 
+        def get_digest(self, filepath):
+                """Return the digest computed while the file at 'filepath'
+                was downloaded, or None if no digest was requested for it or
+                it could not be computed.  The digest is only returned
+                once."""
+
+                return self.__digests.pop(filepath, None)
+
         def get_url(self, url, header=None, sslcert=None, sslkey=None,
             repourl=None, compressible=False, ccancel=None,
             failonerror=True, proxy=None, runtime_proxy=None, system=False):
@@ -623,6 +715,20 @@ class CurlTransportEngine(TransportEngine):
                         if timeout:
                                 self.__mhandle.select(timeout)
 
+                self.start_requests()
+
+                self.__call_perform()
+
+                self.__cleanup_requests()
+
+                self.__stall_check()
+
+        def start_requests(self):
+                """Start as many of the queued requests as the number of
+                connections allows.  This is done by run(); callers driving
+                the engine with socket_action() must call it once they have
+                added requests."""
+
                 # If object deletion has given the transport engine orphaned
                 # requests to purge, do this first, in case the cleanup yields
                 # free handles.
@@ -630,18 +736,51 @@ class CurlTransportEngine(TransportEngine):
                         url, uuid = self.__orphans.pop()
                         self.remove_request(url, uuid)
 
-                while self.__freehandles and self.__req_q:
+                while self.__req_q and self.__can_add_handle():
                         t = self.__req_q.pop()
                         eh = self.__freehandles.pop(-1)
                         self.__setup_handle(eh, t)
                         self.__mhandle.add_handle(eh)
 
-                self.__call_perform()
+        def set_socket_callbacks(self, socketfunc, timerfunc):
+                """Have libcurl report the sockets it needs to wait on to
+                'socketfunc' and the time it needs to wait for to 'timerfunc',
+                so that an event loop can drive the engine using
+                socket_action() instead of run().  See the descriptions of
+                CURLMOPT_SOCKETFUNCTION and CURLMOPT_TIMERFUNCTION in the
+                libcurl documentation for the arguments they are called
+                with."""
+
+                self.__mhandle.setopt(pycurl.M_SOCKETFUNCTION, socketfunc)
+                self.__mhandle.setopt(pycurl.M_TIMERFUNCTION, timerfunc)
+
+        def socket_action(self, sockfd=pycurl.SOCKET_TIMEOUT, ev_bitmask=0):
+                """Perform the I/O that is ready on the socket 'sockfd', as
+                described by 'ev_bitmask', or the work due if 'sockfd' is
+                pycurl.SOCKET_TIMEOUT, then clean up the requests that
+                finished and start queued ones in their place.  Their status
+                can be retrieved using check_status() as for run()."""
 
-                self.__cleanup_requests()
+                while 1:
+                        ret, active_handles = self.__mhandle.socket_action(
+                            sockfd, ev_bitmask)
+                        if ret != pycurl.E_CALL_MULTI_PERFORM:
+                                break
+                self.__active_handles = active_handles
+
+                try:
+                        self.__cleanup_requests()
+                finally:
+                        self.start_requests()
+
+                self.__stall_check()
+
+        def __stall_check(self):
+                """Check whether any of the transfers in progress have
+                stalled, at most once a second."""
 
-                if self.__active_handles and (not self.__freehandles or not
-                    self.__req_q):
+                if self.__active_handles and (not self.__can_add_handle() or
+                    not self.__req_q):
                         cur_clock = time.time()
                         if cur_clock - self.__last_stall_check > 1:
                                 self.__last_stall_check = cur_clock
@@ -716,6 +855,7 @@ class CurlTransportEngine(TransportEngine):
                 self.__failures = []
                 self.__success = []
                 self.__orphans = set()
+                self.__digests = {}
 
         def send_data(self, url, data=None, header=None, sslcert=None,
             sslkey=None, repourl=None, ccancel=None,
@@ -763,6 +903,24 @@ class CurlTransportEngine(TransportEngine):
 
                 self.__file_bufsz = size
 
+        def set_max_connections(self, count):
+                """Limit the number of requests that the engine performs
+                concurrently to 'count'.  Requests that are already in
+                progress are not affected."""
+
+                while len(self.__chandles) < count:
+                        eh = self.__new_handle()
+                        self.__chandles.append(eh)
+                        self.__freehandles.append(eh)
+                self.__max_handles = count
+
+        @property
+        def max_connections(self):
+                """The number of requests that the engine performs
+                concurrently."""
+
+                return self.__max_handles
+
         def set_header(self, hdrdict=None):
                 """Supply a dictionary of name/value pairs in hdrdict.
                 These will be included on all requests issued by the transport
@@ -782,6 +940,24 @@ class CurlTransportEngine(TransportEngine):
 
                 self.__user_agent = ua_str
 
+        @staticmethod
+        def __resume_partial(resume_path, filepath):
+                """If partial content for a request exists at resume_path,
+                move it to filepath and return its size so that the transfer
+                can continue from there; otherwise, return 0."""
+
+                try:
+                        offset = os.path.getsize(resume_path)
+                except EnvironmentError as e:
+                        if e.errno != errno.ENOENT:
+                                raise
+                        return 0
+                if not offset:
+                        return 0
+                if resume_path != filepath:
+                        os.rename(resume_path, filepath)
+                return offset
+
         def __setup_handle(self, hdl, treq):
                 """Setup the curl easy handle, hdl, with the parameters
                 specified in the TransportRequest treq.  If global
@@ -802,6 +978,15 @@ class CurlTransportEngine(TransportEngine):
                 hdl.setopt(pycurl.LOW_SPEED_TIME,
                     global_settings.PKG_CLIENT_LOWSPEED_TIMEOUT)
 
+                if self.__multiplex:
+                        # Use HTTP/2 if the repository supports it, and wait
+                        # for a connection that is being established to it
+                        # rather than opening another, so that the request
+                        # can be multiplexed over that connection.
+                        hdl.setopt(pycurl.HTTP_VERSION,
+                            pycurl.CURL_HTTP_VERSION_2_0)
+                        hdl.setopt(pycurl.PIPEWAIT, 1)
+
                 # Follow redirects
                 hdl.setopt(pycurl.FOLLOWLOCATION, True)
                 # Set limit on maximum number of redirects
@@ -869,8 +1054,15 @@ class CurlTransportEngine(TransportEngine):
                 # error output, and statistics reporting.
                 hdl.repourl = treq.repourl
                 if treq.filepath:
+                        offset = 0
+                        mode = "wb+"
                         try:
-                                hdl.fobj = open(treq.filepath, "wb+",
+                                if treq.resume_path:
+                                        offset = self.__resume_partial(
+                                            treq.resume_path, treq.filepath)
+                                if offset:
+                                        mode = "ab+"
+                                hdl.fobj = open(treq.filepath, mode,
                                     self.__file_bufsz)
                         except EnvironmentError as e:
                                 if e.errno == errno.EACCES:
@@ -884,7 +1076,24 @@ class CurlTransportEngine(TransportEngine):
                                 raise tx.TransportOperationError(
                                     "Unable to open file: {0}".format(e))
 
-                        hdl.setopt(pycurl.WRITEDATA, hdl.fobj)
+                        # Any digest left from an earlier transfer to this
+                        # path no longer describes its content.
+                        self.__digests.pop(treq.filepath, None)
+                        if treq.hash_func:
+                                hdl.digest = _TransferDigest(treq.hash_func,
+                                    treq.hash_decompressed)
+                                if offset:
+                                        # Account for the content that was
+                                        # already retrieved.
+                                        hdl.fobj.seek(0)
+                                        hdl.digest.update_from(hdl.fobj)
+                                hdl.setopt(pycurl.WRITEFUNCTION,
+                                    hdl.digest.writer(hdl.fobj))
+                        else:
+                                hdl.setopt(pycurl.WRITEDATA, hdl.fobj)
+                        if offset:
+                                hdl.setopt(pycurl.RESUME_FROM_LARGE, offset)
+                        hdl.resume_path = treq.resume_path
                         # Request filetime, if endpoint knows it.
                         hdl.setopt(pycurl.OPT_FILETIME, True)
                         hdl.filepath = treq.filepath
@@ -1005,6 +1214,7 @@ class CurlTransportEngine(TransportEngine):
                 self.__failures = None
                 self.__success = None
                 self.__orphans = None
+                self.__digests = None
                 self.__active_handles = 0
 
         @staticmethod
@@ -1022,7 +1232,14 @@ class CurlTransportEngine(TransportEngine):
                                 if hdl.fileprog:
                                         hdl.fileprog.abort()
                                 try:
-                                        os.remove(hdl.filepath)
+                                        if not hdl.resume_path or \
+                                            not os.path.getsize(hdl.filepath):
+                                                os.remove(hdl.filepath)
+                                        elif hdl.resume_path != hdl.filepath:
+                                                # Keep what was retrieved so
+                                                # the next attempt can resume.
+                                                os.rename(hdl.filepath,
+                                                    hdl.resume_path)
                                 except EnvironmentError as e:
                                         if e.errno != errno.ENOENT:
                                                 raise \
@@ -1050,6 +1267,8 @@ class CurlTransportEngine(TransportEngine):
                 hdl.success = False
                 hdl.filepath = None
                 hdl.fileprog = None
+                hdl.digest = None
+                hdl.resume_path = None
                 hdl.uuid = None
                 hdl.filetime = -1
                 hdl.starttime = -1
@@ -1065,7 +1284,8 @@ class TransportRequest(object):
             progclass=None, progtrack=None, sslcert=None, sslkey=None,
             repourl=None, compressible=False, progfunc=None, uuid=None,
             read_fobj=None, read_filepath=None, failonerror=False, proxy=None,
-            runtime_proxy=None, system=False):
+            runtime_proxy=None, system=False, hash_func=None,
+            hash_decompressed=False, resume_path=None):
                 """Create a TransportRequest with the following parameters:
 
                 url - The url that the transport engine should retrieve
@@ -1147,6 +1367,18 @@ class TransportRequest(object):
                 resources served by the system-repository, we use this to
                 prevent $http_proxy environment variables from being used.
 
+                hash_func - If the request is downloading a file to filepath,
+                a function that returns an object used to compute the digest
+                of the file as it is written.
+
+                hash_decompressed - If True, the file is gzip-compressed and
+                the digest is computed over its decompressed content.
+
+                resume_path - If the request is downloading a file to
+                filepath, the path where partial content is kept if the
+                transfer fails.  If content exists at this path, the
+                transfer resumes from the end of it using a range request.
+
                 A TransportRequest must contain enough information to uniquely
                 identify any pkg.client.publisher.TransportRepoURI - in
                 particular, it must contain all fields used by
@@ -1175,3 +1407,67 @@ class TransportRequest(object):
                 self.proxy = proxy
                 self.runtime_proxy = runtime_proxy
                 self.system = system
+                self.hash_func = hash_func
+                self.hash_decompressed = hash_decompressed
+                self.resume_path = resume_path
+
+
+class _TransferDigest(object):
+        """Computes the digest of a file as it is written by the transport
+        engine, so that its content does not have to be read again to be
+        verified once the transfer completes."""
+
+        READ_SIZE = 128 * 1024
+
+        def __init__(self, hash_func, decompress=False):
+                self.__hash = hash_func()
+                self.__dcobj = None
+                self.__failed = False
+                if decompress:
+                        # Let zlib parse the gzip header.
+                        self.__dcobj = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+        def writer(self, fobj):
+                """Returns a write callback that writes data to 'fobj' and
+                adds it to the digest."""
+
+                def write(data):
+                        fobj.write(data)
+                        self.update(data)
+                return write
+
+        def update_from(self, fobj):
+                """Adds the remaining content of 'fobj' to the digest."""
+
+                while True:
+                        data = fobj.read(self.READ_SIZE)
+                        if not data:
+                                break
+                        self.update(data)
+
+        def update(self, data):
+                if self.__failed:
+                        return
+                if not self.__dcobj:
+                        self.__hash.update(data)
+                        return
+                try:
+                        self.__hash.update(self.__dcobj.decompress(data))
+                except zlib.error:
+                        # Leave it to the caller to verify the content the
+                        # slow way and report the error.
+                        self.__failed = True
+
+        def hexdigest(self):
+                """Returns the digest of the data written, or None if it
+                could not be computed."""
+
+                if self.__failed:
+                        return None
+                if self.__dcobj:
+                        try:
+                                self.__hash.update(self.__dcobj.flush())
+                        except zlib.error:
+                                return None
+                        self.__dcobj = None
+                return self.__hash.hexdigest()
@@ -31,7 +31,8 @@ from functools import total_ordering
 from six.moves import http_client
 
 retryable_http_errors = set((http_client.REQUEST_TIMEOUT, http_client.BAD_GATEWAY,
-        http_client.GATEWAY_TIMEOUT, http_client.NOT_FOUND))
+        http_client.GATEWAY_TIMEOUT, http_client.NOT_FOUND,
+        http_client.REQUESTED_RANGE_NOT_SATISFIABLE))
 retryable_file_errors = set((pycurl.E_FILE_COULDNT_READ_FILE, errno.EAGAIN,
     errno.ENOENT))
 
@@ -67,7 +68,8 @@ proto_code_map = {
 retryable_pycurl_errors = set((pycurl.E_COULDNT_CONNECT, pycurl.E_PARTIAL_FILE,
     pycurl.E_OPERATION_TIMEOUTED, pycurl.E_GOT_NOTHING, pycurl.E_SEND_ERROR,
     pycurl.E_RECV_ERROR, pycurl.E_COULDNT_RESOLVE_HOST,
-    pycurl.E_TOO_MANY_REDIRECTS, pycurl.E_BAD_CONTENT_ENCODING))
+    pycurl.E_TOO_MANY_REDIRECTS, pycurl.E_BAD_CONTENT_ENCODING,
+    pycurl.E_RANGE_ERROR, pycurl.E_BAD_DOWNLOAD_RESUME))
 
 class TransportException(api_errors.TransportError):
         """Base class for various exceptions thrown by code in transport
@@ -31,6 +31,7 @@ import shutil
 import simplejson as json
 import six
 import sys
+import tarfile
 import tempfile
 
 from email.utils import formatdate
@@ -83,11 +84,24 @@ class TransportRepo(object):
 
                 raise NotImplementedError
 
-        def get_files(self, filelist, dest, progtrack, version, header=None, pub=None):
+        def get_files(self, filelist, dest, progtrack, version, header=None,
+            pub=None, hashes=None, resume_dir=None):
                 """Get multiple files from the repo at once.
                 The files are named by hash and supplied in filelist.
                 If dest is specified, download to the destination
-                directory that is given. Progtrack is a ProgressTracker"""
+                directory that is given. Progtrack is a ProgressTracker.
+
+                'hashes' is an optional dictionary mapping the names of
+                files in filelist to a tuple of (hash_func, decompressed)
+                describing the digest that the transport engine should
+                compute while each file is downloaded.
+
+                'resume_dir' is an optional directory where the partially
+                downloaded content of each file is kept if its transfer
+                fails, so that a later attempt can resume it.
+
+                Repositories that do not download files through the engine
+                ignore 'hashes' and 'resume_dir'."""
 
                 raise NotImplementedError
 
@@ -98,11 +112,17 @@ class TransportRepo(object):
 
                 raise NotImplementedError
 
-        def get_manifests(self, mfstlist, dest, progtrack=None, pub=None):
+        def get_manifests(self, mfstlist, dest, progtrack=None, pub=None,
+            hash_func=None):
                 """Get manifests named in list.  The mfstlist argument contains
                 tuples (fmri, header).  This is so that each manifest may have
                 unique header information.  The destination directory is spec-
-                ified in the dest argument."""
+                ified in the dest argument.
+
+                'hash_func' is an optional hash constructor; if provided, the
+                transport engine computes the digest of each manifest while
+                it is downloaded.  Repositories that do not download
+                manifests through the engine ignore it."""
 
                 raise NotImplementedError
 
@@ -391,12 +411,15 @@ class HTTPRepo(TransportRepo):
                     self._repouri)
 
         def _add_file_url(self, url, filepath=None, progclass=None,
-            progtrack=None, header=None, compress=False):
+            progtrack=None, header=None, compress=False, hash_func=None,
+            hash_decompressed=False, resume_path=None):
                 self._engine.add_url(url, filepath=filepath,
                     progclass=progclass, progtrack=progtrack, repourl=self._url,
                     header=header, compressible=compress,
                     runtime_proxy=self._repouri.runtime_proxy,
-                    proxy=self._repouri.proxy)
+                    proxy=self._repouri.proxy, hash_func=hash_func,
+                    hash_decompressed=hash_decompressed,
+                    resume_path=resume_path)
 
         def _fetch_url(self, url, header=None, compress=False, ccancel=None,
             failonerror=True, system=False):
@@ -634,11 +657,13 @@ class HTTPRepo(TransportRepo):
                 return self._fetch_url(requesturl, header, compress=True,
                     ccancel=ccancel)
 
-        def get_manifests(self, mfstlist, dest, progtrack=None, pub=None):
+        def get_manifests(self, mfstlist, dest, progtrack=None, pub=None,
+            hash_func=None):
                 """Get manifests named in list.  The mfstlist argument contains
                 tuples (fmri, header).  This is so that each manifest may have
                 unique header information.  The destination directory is spec-
-                ified in the dest argument."""
+                ified in the dest argument.  If hash_func is not None, the
+                digest of each manifest is computed while it is downloaded."""
 
                 baseurl = self.__get_request_url("manifest/0/", pub=pub)
                 urlmapping = {}
@@ -654,7 +679,7 @@ class HTTPRepo(TransportRepo):
                         fn = os.path.join(dest, f)
                         self._add_file_url(url, filepath=fn, header=h,
                             compress=True, progtrack=progtrack,
-                            progclass=progclass)
+                            progclass=progclass, hash_func=hash_func)
 
                 # Compute urllist from keys in mapping
                 urllist = urlmapping.keys()
@@ -689,13 +714,29 @@ class HTTPRepo(TransportRepo):
 
                 return self._annotate_exceptions(errors, urlmapping)
 
-        def get_files(self, filelist, dest, progtrack, version, header=None, pub=None):
+        def get_files(self, filelist, dest, progtrack, version, header=None,
+            pub=None, hashes=None, resume_dir=None):
                 """Get multiple files from the repo at once.
                 The files are named by hash and supplied in filelist.
                 If dest is specified, download to the destination
                 directory that is given.  If progtrack is not None,
                 it contains a ProgressTracker object for the
-                downloads."""
+                downloads.  If hashes is not None, it maps file names
+                to the (hash_func, decompressed) tuple of the digest to
+                compute while downloading them.  If resume_dir is not None,
+                partially downloaded files are kept there so that their
+                transfer can be resumed.
+
+                If the repository supports it, the files are first requested
+                all at once; any that aren't retrieved that way are then
+                requested individually."""
+
+                if len(filelist) > 1 and \
+                    self.supports_version("files", [0]) > -1:
+                        filelist = self.__get_files_bundle(filelist, dest,
+                            progtrack, header=header, pub=pub)
+                        if not filelist:
+                                return []
 
                 baseurl = self.__get_request_url("file/{0}/".format(version),
                     pub=pub)
@@ -709,9 +750,16 @@ class HTTPRepo(TransportRepo):
                         url = urljoin(baseurl, f)
                         urllist.append(url)
                         fn = os.path.join(dest, f)
+                        hash_func, decompressed = (hashes or {}).get(f,
+                            (None, False))
+                        resume_path = None
+                        if resume_dir:
+                                resume_path = os.path.join(resume_dir, f)
                         self._add_file_url(url, filepath=fn,
                             progclass=progclass, progtrack=progtrack,
-                            header=header)
+                            header=header, hash_func=hash_func,
+                            hash_decompressed=decompressed,
+                            resume_path=resume_path)
 
                 try:
                         while self._engine.pending:
@@ -743,6 +791,51 @@ class HTTPRepo(TransportRepo):
 
                 return self._annotate_exceptions(errors)
 
+        def __get_files_bundle(self, filelist, dest, progtrack, header=None,
+            pub=None):
+                """Retrieve the files in filelist to the dest directory using
+                a single files/0 request, which returns them as a tar stream.
+                Returns the list of files that were not retrieved, either
+                because the repository omitted them or because the request
+                failed; the caller should retrieve those individually."""
+
+                requesturl = self.__get_request_url("files/0/", pub=pub)
+                # Ensure the list isn't mistaken for form data.
+                header = dict(header or {})
+                header["Content-Type"] = "text/plain"
+                pending = set(filelist)
+
+                fobj = self._post_url(requesturl, data="\n".join(filelist),
+                    header=header,
+                    ccancel=getattr(progtrack, "check_cancelation", None))
+                fpath = None
+                try:
+                        tar_stream = tarfile.open(mode="r|", fileobj=fobj)
+                        for ti in tar_stream:
+                                if not ti.isfile() or ti.name not in pending:
+                                        continue
+                                path = os.path.join(dest, ti.name)
+                                with open(path, "wb") as f:
+                                        fpath = path
+                                        shutil.copyfileobj(
+                                            tar_stream.extractfile(ti), f)
+                                fpath = None
+                                pending.remove(ti.name)
+                                if progtrack:
+                                        progtrack.download_add_progress(1,
+                                            ti.size)
+                except (tx.TransportException, tarfile.TarError):
+                        # Fall back to retrieving the remaining files
+                        # individually.
+                        pass
+                finally:
+                        fobj.close()
+                        if fpath:
+                                # Discard the incomplete file.
+                                os.remove(fpath)
+
+                return [f for f in filelist if f in pending]
+
         def get_url(self):
                 """Returns the repo's url."""
 
@@ -1192,14 +1285,17 @@ class HTTPSRepo(HTTPRepo):
 
         # override the download functions to use ssl cert/key
         def _add_file_url(self, url, filepath=None, progclass=None,
-            progtrack=None, header=None, compress=False):
+            progtrack=None, header=None, compress=False, hash_func=None,
+            hash_decompressed=False, resume_path=None):
                 self._engine.add_url(url, filepath=filepath,
                     progclass=progclass, progtrack=progtrack,
                     sslcert=self._repouri.ssl_cert,
                     sslkey=self._repouri.ssl_key, repourl=self._url,
                     header=header, compressible=compress,
                     runtime_proxy=self._repouri.runtime_proxy,
-                    proxy=self._repouri.proxy)
+                    proxy=self._repouri.proxy, hash_func=hash_func,
+                    hash_decompressed=hash_decompressed,
+                    resume_path=resume_path)
 
         def _fetch_url(self, url, header=None, compress=False, ccancel=None,
             failonerror=True):
@@ -1291,10 +1387,13 @@ class _FilesystemRepo(TransportRepo):
                         self._frepo = None
 
         def _add_file_url(self, url, filepath=None, progclass=None,
-            progtrack=None, header=None, compress=False):
+            progtrack=None, header=None, compress=False, hash_func=None,
+            hash_decompressed=False, resume_path=None):
                 self._engine.add_url(url, filepath=filepath,
                     progclass=progclass, progtrack=progtrack, repourl=self._url,
-                    header=header, compressible=False)
+                    header=header, compressible=False, hash_func=hash_func,
+                    hash_decompressed=hash_decompressed,
+                    resume_path=resume_path)
 
         def _fetch_url(self, url, header=None, compress=False, ccancel=None,
             failonerror=True):
@@ -1520,11 +1619,13 @@ class _FilesystemRepo(TransportRepo):
 
                 return self._fetch_url(requesturl, header, ccancel=ccancel)
 
-        def get_manifests(self, mfstlist, dest, progtrack=None, pub=None):
+        def get_manifests(self, mfstlist, dest, progtrack=None, pub=None,
+            hash_func=None):
                 """Get manifests named in list.  The mfstlist argument contains
                 tuples (fmri, header).  This is so that each manifest may have
                 unique header information.  The destination directory is spec-
-                ified in the dest argument."""
+                ified in the dest argument.  If hash_func is not None, the
+                digest of each manifest is computed while it is downloaded."""
 
                 urlmapping = {}
                 progclass = None
@@ -1552,7 +1653,8 @@ class _FilesystemRepo(TransportRepo):
                         urlmapping[url] = fmri
                         fn = os.path.join(dest, fmri.get_url_path())
                         self._add_file_url(url, filepath=fn, header=h,
-                            progtrack=progtrack, progclass=progclass)
+                            progtrack=progtrack, progclass=progclass,
+                            hash_func=hash_func)
 
                 urllist = urlmapping.keys()
 
@@ -1588,13 +1690,18 @@ class _FilesystemRepo(TransportRepo):
 
                 return errors + pre_exec_errors
 
-        def get_files(self, filelist, dest, progtrack, version, header=None, pub=None):
+        def get_files(self, filelist, dest, progtrack, version, header=None,
+            pub=None, hashes=None, resume_dir=None):
                 """Get multiple files from the repo at once.
                 The files are named by hash and supplied in filelist.
                 If dest is specified, download to the destination
                 directory that is given.  If progtrack is not None,
                 it contains a ProgressTracker object for the
-                downloads."""
+                downloads.  If hashes is not None, it maps file names
+                to the (hash_func, decompressed) tuple of the digest to
+                compute while downloading them.  If resume_dir is not None,
+                partially downloaded files are kept there so that their
+                transfer can be resumed."""
 
                 urllist = []
                 progclass = None
@@ -1628,9 +1735,16 @@ class _FilesystemRepo(TransportRepo):
                                 continue
                         urllist.append(url)
                         fn = os.path.join(dest, f)
+                        hash_func, decompressed = (hashes or {}).get(f,
+                            (None, False))
+                        resume_path = None
+                        if resume_dir:
+                                resume_path = os.path.join(resume_dir, f)
                         self._add_file_url(url, filepath=fn,
                             progclass=progclass, progtrack=progtrack,
-                            header=header)
+                            header=header, hash_func=hash_func,
+                            hash_decompressed=decompressed,
+                            resume_path=resume_path)
 
                 try:
                         while self._engine.pending:
@@ -1950,11 +2064,11 @@ class _FilesystemRepo(TransportRepo):
 
                 try:
                         # see if repository has file
-                        fpath = self._frepo.file(fhash, pub=pfx)
                         if hashes:
-                                csize, chashes = compute_compressed_attrs(fhash,
-                                    file_path=fpath)
+                                fpath, csize, chashes = \
+                                    self._frepo.file_attrs(fhash, pub=pfx)
                         else:
+                                fpath = self._frepo.file(fhash, pub=pfx)
                                 csize = os.stat(fpath).st_size
                                 chashes = EmptyDict
                         return (csize, chashes)
@@ -2167,11 +2281,12 @@ class _ArchiveRepo(TransportRepo):
                         self.__record_proto_error(ex)
                         raise ex
 
-        def get_manifests(self, mfstlist, dest, progtrack=None, pub=None):
+        def get_manifests(self, mfstlist, dest, progtrack=None, pub=None,
+            hash_func=None):
                 """Get manifests named in list.  The mfstlist argument contains
                 tuples (fmri, header).  This is so that each manifest may have
                 unique header information.  The destination directory is spec-
-                ified in the dest argument."""
+                ified in the dest argument.  hash_func is ignored."""
 
                 errors = []
                 for fmri, h in mfstlist:
@@ -2199,13 +2314,15 @@ class _ArchiveRepo(TransportRepo):
                                 continue
                 return errors
 
-        def get_files(self, filelist, dest, progtrack, version, header=None, pub=None):
+        def get_files(self, filelist, dest, progtrack, version, header=None,
+            pub=None, hashes=None, resume_dir=None):
                 """Get multiple files from the repo at once.
                 The files are named by hash and supplied in filelist.
                 If dest is specified, download to the destination
                 directory that is given.  If progtrack is not None,
                 it contains a ProgressTracker object for the
-                downloads."""
+                downloads.  Files are extracted from the archive, so
+                hashes and resume_dir are ignored."""
 
                 pub_prefix = getattr(pub, "prefix", None)
                 errors = []
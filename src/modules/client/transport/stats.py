@@ -28,9 +28,15 @@ from __future__ import division
 
 import os
 import datetime
+import math
 import random
+import simplejson as json
+import tempfile
+import threading
+import time
 from six.moves.urllib.parse import urlsplit
 import pkg.misc as misc
+import pkg.portable as portable
 
 
 class RepoChooser(object):
@@ -42,16 +48,119 @@ class RepoChooser(object):
         It's used to return the RepoStats in an ordered list, which
         helps the transport pick the best performing destination."""
 
+        # Version of the format of the file written by save().
+        __STATS_VERSION = 1
+
+        # Statistics saved by an earlier invocation count for half as much
+        # for every __HALF_LIFE seconds since they were saved, and are
+        # forgotten once they count for less than __MIN_WEIGHT.
+        __HALF_LIFE = 24 * 60 * 60
+        __MIN_WEIGHT = 0.01
+
         def __init__(self):
                 # A dictionary containing the RepoStats objects. The dictionary
                 # uses TransportRepoURI.key() values as its key.
                 self.__rsobj = {}
+                # The most recent values chosen by get_transfer_params().
+                self.__transfer_params = None
+                # Statistics loaded by load() for repositories that haven't
+                # been used yet, as a dictionary of (time saved, state)
+                # tuples keyed by TransportRepoURI.key() values.
+                self.__saved = {}
+                # Transports cloned for use by other threads share this
+                # object, so the above are only accessed with this held.
+                self.__lock = threading.RLock()
 
         def __getitem__(self, key):
-                return self.__rsobj[key]
+                with self.__lock:
+                        return self.__rsobj[key]
+
+        def __new_repostats(self, ruri):
+                """Create a RepoStats object for the TransportRepoURI 'ruri',
+                starting from any statistics previously saved for it.  The
+                caller must hold the lock."""
+
+                rs = RepoStats(ruri)
+                key = ruri.key()
+                if key in self.__saved:
+                        saved, state = self.__saved.pop(key)
+                        # old-division; pylint: disable=W1619
+                        age = max(0, time.time() - saved)
+                        rs.set_state(state, 0.5 ** (age / self.__HALF_LIFE))
+                self.__rsobj[key] = rs
+                return rs
+
+        def load(self, path):
+                """Load the statistics written by save() to the file at
+                'path', so that they're used as the starting point for the
+                repositories they were recorded for.  Older statistics count
+                for less.  Statistics that can't be loaded are ignored."""
+
+                now = time.time()
+                saved_stats = {}
+                try:
+                        with open(path) as f:
+                                version, entries = json.load(f)
+                        if version != self.__STATS_VERSION:
+                                return
+                        for url, proxy, saved, state in entries:
+                                # old-division; pylint: disable=W1619
+                                if 0.5 ** (max(0, now - saved) /
+                                    self.__HALF_LIFE) < self.__MIN_WEIGHT:
+                                        continue
+                                saved_stats[(url, proxy)] = (saved,
+                                    dict(state))
+                except (EnvironmentError, ValueError, TypeError):
+                        return
+
+                with self.__lock:
+                        for key, val in saved_stats.items():
+                                if key not in self.__rsobj:
+                                        # Current statistics are better.
+                                        self.__saved[key] = val
+
+        def save(self, path):
+                """Write the statistics of the repositories that have been
+                used to the file at 'path' so that a later invocation can
+                load() them.  Failure to write the file is ignored, as the
+                statistics are only an optimization."""
+
+                now = time.time()
+                with self.__lock:
+                        entries = [
+                            (url, proxy, saved, state)
+                            for (url, proxy), (saved, state)
+                            in self.__saved.items()
+                        ]
+                        for (url, proxy), rs in self.__rsobj.items():
+                                if not rs.used or (proxy and "@" in proxy):
+                                        # Don't save proxy credentials.
+                                        continue
+                                entries.append((url, proxy, now,
+                                    rs.get_state()))
+                if not entries:
+                        return
+
+                dirname = os.path.dirname(path)
+                tmp_file = None
+                try:
+                        fd, tmp_file = tempfile.mkstemp(dir=dirname,
+                            prefix="repostats.")
+                        with os.fdopen(fd, "w") as f:
+                                json.dump((self.__STATS_VERSION, entries), f)
+                        os.chmod(tmp_file, misc.PKG_FILE_MODE)
+                        portable.rename(tmp_file, path)
+                except EnvironmentError:
+                        # Most likely an unprivileged user.
+                        if tmp_file:
+                                try:
+                                        portable.remove(tmp_file)
+                                except EnvironmentError:
+                                        pass
 
         def __contains__(self, key):
-                return key in self.__rsobj
+                with self.__lock:
+                        return key in self.__rsobj
 
         def __get_proxy(self, ds):
                 """Gets the proxy that was used at runtime for a given
@@ -80,7 +189,10 @@ class RepoChooser(object):
                 misc.msg(hfmt.format("URL", "Proxy", "Good", "Err", "Conn",
                     "Speed", "Size", "Used", "CSpeed", "Qual"))
 
-                for ds in self.__rsobj.values():
+                with self.__lock:
+                        rsobjs = list(self.__rsobj.values())
+
+                for ds in rsobjs:
 
                         speedstr = misc.bytes_to_str(ds.transfer_speed,
                             "{num:>.0f} {unit}/s")
@@ -91,6 +203,10 @@ class RepoChooser(object):
                             ds.failures, ds.num_connect, speedstr, sizestr,
                             ds.used, ds.connect_time, ds.quality))
 
+                if self.__transfer_params:
+                        misc.msg("Chunk size: {0:d} Connections: {1:d}".format(
+                            *self.__transfer_params))
+
         def get_num_visited(self, repouri_list):
                 """Walk a list of TransportRepoURIs and return the number
                 that have been visited as an integer.  If a repository
@@ -100,22 +216,117 @@ class RepoChooser(object):
 
                 found_rs = []
 
-                for ruri in repouri_list:
-                        key = ruri.key()
-                        if key in self.__rsobj:
-                                rs = self.__rsobj[key]
-                        else:
-                                rs = RepoStats(ruri)
-                                self.__rsobj[key] = rs
-                        found_rs.append((rs, ruri))
+                with self.__lock:
+                        for ruri in repouri_list:
+                                key = ruri.key()
+                                if key in self.__rsobj:
+                                        rs = self.__rsobj[key]
+                                else:
+                                        rs = self.__new_repostats(ruri)
+                                found_rs.append((rs, ruri))
 
                 return len([x for x in found_rs if x[0].used])
 
+        def get_transfer_params(self, repouri_list, chunk_bounds,
+            conn_bounds):
+                """Walk a list of TransportRepoURIs and return a tuple of
+                (chunk_size, connections), where chunk_size is the number of
+                requests the transport should make before choosing a
+                repository again and connections is the number of requests
+                it should perform concurrently.
+
+                'chunk_bounds' and 'conn_bounds' are tuples of (minimum,
+                maximum) that the values are limited to."""
+
+                # The number of seconds the requests in a chunk should take
+                # to complete when there is a choice of repositories.
+                Cchunk_seconds = 10
+                # The number of requests in a chunk when there is a choice
+                # of repositories, but nothing is known about them yet.
+                Cchunk_default = 100
+                # The number of concurrent requests per request that can be
+                # waiting for a connection while another is transferring.
+                Cconn_factor = 2
+
+                chunk_min, chunk_max = chunk_bounds
+                conn_min, conn_max = conn_bounds
+
+                n = len(repouri_list)
+                with self.__lock:
+                        m = self.get_num_visited(repouri_list)
+                        used = [
+                            self.__rsobj[ruri.key()]
+                            for ruri in repouri_list
+                            if self.__rsobj[ruri.key()].used
+                        ]
+                ntx = sum(rs.success + rs.failures for rs in used)
+                seconds = sum(rs.seconds_xfr for rs in used)
+
+                if m < n or ntx == 0 or seconds == 0:
+                        # Nothing is known yet about the performance of
+                        # some of the repositories, so use as many
+                        # connections as allowed.
+                        conn = conn_max
+                        xfr_time = None
+                else:
+                        # old-division; pylint: disable=W1619
+                        xfr_time = seconds / ntx
+                        latency = sum(rs.request_connect_time
+                            for rs in used) / len(used)
+                        error_rate = min(1.0,
+                            sum(rs.failures for rs in used) / ntx)
+
+                        # When requests spend most of their time waiting for
+                        # a connection, as is the case for small files on a
+                        # fast network, more concurrent requests are needed
+                        # to keep the network busy.  When the transfer of
+                        # data dominates, a few are enough.  Back off if the
+                        # repositories are failing requests.
+                        conn = Cconn_factor * (1 + latency / xfr_time) * \
+                            (1 - error_rate)
+
+                if n == 1:
+                        # There is no other repository to choose, so make
+                        # the largest requests possible, whether or not the
+                        # repository has been visited.
+                        chunk = chunk_max
+                elif m < n:
+                        # If not all repositories have been visited, choose
+                        # a small chunk so that if the repository chosen is
+                        # a poor choice, the client doesn't transfer too
+                        # much data from it.
+                        chunk = chunk_min
+                elif xfr_time is None:
+                        chunk = Cchunk_default
+                else:
+                        # Otherwise, make requests that take about the same
+                        # time to complete whatever the repository's
+                        # performance, so that the choice of repository is
+                        # revisited regularly.  Revisit sooner if requests
+                        # are failing.
+                        conn = max(conn_min, min(conn_max,
+                            int(math.ceil(conn))))
+                        # old-division; pylint: disable=W1619
+                        chunk = conn * Cchunk_seconds / \
+                            (latency + xfr_time) * (1 - error_rate)
+
+                chunk = max(chunk_min, min(chunk_max, int(math.ceil(chunk))))
+                conn = max(conn_min, min(conn_max, int(math.ceil(conn))))
+                self.__transfer_params = (chunk, conn)
+                return chunk, conn
+
         def get_repostats(self, repouri_list, origin_list=misc.EmptyI):
                 """Walk a list of TransportRepoURIs and return a sorted list of
                 status objects.  The better choices should be at the
                 beginning of the list."""
 
+                with self.__lock:
+                        return self.__get_repostats(repouri_list, origin_list)
+
+        def __get_repostats(self, repouri_list, origin_list):
+                """Implementation of get_repostats(); the caller must hold
+                the statistics lock."""
+
                 found_rs = []
                 origin_speed = 0
                 origin_count = 0
@@ -140,8 +351,7 @@ class RepoChooser(object):
                                         origin_cspeed += rs.connect_time
                                         origin_ccount += 1
                         else:
-                                rs = RepoStats(ouri)
-                                self.__rsobj[key] = rs
+                                self.__new_repostats(ouri)
 
                 if origin_count > 0:
                         origin_avg_speed = origin_speed // origin_count
@@ -161,8 +371,7 @@ class RepoChooser(object):
                         if key in self.__rsobj:
                                 rs = self.__rsobj[key]
                         else:
-                                rs = RepoStats(ruri)
-                                self.__rsobj[key] = rs
+                                rs = self.__new_repostats(ruri)
                         found_rs.append((rs, ruri))
                         if ruri in origin_list:
                                 n = num_origins - o_idx
@@ -196,12 +405,16 @@ class RepoChooser(object):
         def clear(self):
                 """Clear all statistics count."""
 
-                self.__rsobj = {}
+                with self.__lock:
+                        self.__rsobj = {}
+                        self.__saved = {}
 
         def reset(self):
                 """reset each stats object"""
 
-                for v in self.__rsobj.values():
+                with self.__lock:
+                        rsobjs = list(self.__rsobj.values())
+                for v in rsobjs:
                         v.reset()
 
 
@@ -236,6 +449,9 @@ class RepoStats(object):
 
                 self.__connections = 0
                 self.__connect_time = 0.0
+                # Requests multiplexed over a connection that was already
+                # established.
+                self.__multiplexed = 0
 
                 self.__used = False
 
@@ -247,6 +463,10 @@ class RepoStats(object):
                 self.origin_factor = 1
                 self.origin_decay = 1
 
+                # Statistics carried over from an earlier invocation; see
+                # set_state().
+                self.__prior = None
+
         def clear_consecutive_errors(self):
                 """Set the count of consecutive errors to zero.  This is
                 done once we know a transaction has been successfully
@@ -254,12 +474,77 @@ class RepoStats(object):
 
                 self.__consecutive_errors = 0
 
-        def record_connection(self, time):
-                """Record amount of time spent connecting."""
+        def get_state(self):
+                """Return the statistics worth keeping across client
+                invocations as a dictionary that can be passed to
+                set_state()."""
+
+                return {
+                    "connections": self.__connections,
+                    "connect_time": self.__connect_time,
+                    "multiplexed": self.__multiplexed,
+                    "bytes_xfr": self.__bytes_xfr,
+                    "seconds_xfr": self.__seconds_xfr,
+                    "total_tx": self.__total_tx,
+                    "failed_tx": self.__failed_tx,
+                    "content_err": self.__content_err,
+                    "err_decay": self._err_decay,
+                }
+
+        def set_state(self, state, weight=1.0):
+                """Start from the statistics in 'state', as returned by
+                get_state(), scaled by 'weight' (between 0 and 1) so that
+                older observations count for less.  The statistics are kept
+                when the object is reset()."""
+
+                def count(name):
+                        return int(round(state.get(name, 0) * weight))
+
+                self.__prior = {
+                    "bytes_xfr": state.get("bytes_xfr", 0.0) * weight,
+                    "seconds_xfr": state.get("seconds_xfr", 0.0) * weight,
+                    "total_tx": count("total_tx"),
+                    "failed_tx": count("failed_tx"),
+                    "content_err": count("content_err"),
+                    "err_decay": state.get("err_decay", 0) * weight,
+                }
+                self.__connections = count("connections")
+                self.__multiplexed = count("multiplexed")
+                if self.__connections:
+                        # Keep the average connection time.
+                        self.__connect_time = \
+                            state.get("connect_time", 0.0) * \
+                            self.__connections / state["connections"]
+                self.__restore_prior()
+                if self.__connections or self.__total_tx:
+                        self.__used = True
+
+        def __restore_prior(self):
+                """Apply the statistics carried over by set_state()."""
+
+                prior = self.__prior
+                self.__bytes_xfr = prior["bytes_xfr"]
+                self.__seconds_xfr = prior["seconds_xfr"]
+                self.__total_tx = prior["total_tx"]
+                self.__failed_tx = prior["failed_tx"]
+                self.__content_err = prior["content_err"]
+                self._err_decay = prior["err_decay"]
+
+        def record_connection(self, time, multiplexed=False):
+                """Record amount of time spent connecting.
+
+                If 'multiplexed' is true, the request was multiplexed over a
+                connection that had already been established, so no time was
+                spent connecting.  Such requests are counted separately so
+                that they don't lower the average connection time."""
 
                 if not self.__used:
                         self.__used = True
 
+                if multiplexed:
+                        self.__multiplexed += 1
+                        return
+
                 self.__connections += 1
                 self.__connect_time += time
 
@@ -328,6 +613,8 @@ class RepoStats(object):
                 self.__total_tx = 0
                 self.__consecutive_errors = 0
                 self.origin_speed = 0.0
+                if self.__prior:
+                        self.__restore_prior()
 
         @property
         def bytes_xfr(self):
@@ -348,6 +635,19 @@ class RepoStats(object):
                 # old-division; pylint: disable=W1619
                 return self.__connect_time / self.__connections
 
+        @property
+        def request_connect_time(self):
+                """The average time a request to this host spent waiting
+                for a connection to be established; requests multiplexed
+                over an existing connection didn't wait at all."""
+
+                if self.__multiplexed == 0:
+                        return self.connect_time
+
+                # old-division; pylint: disable=W1619
+                return self.connect_time * self.__connections / \
+                    (self.__connections + self.__multiplexed)
+
         @property
         def consecutive_errors(self):
                 """Return the number of successive errors this endpoint
@@ -379,6 +679,14 @@ class RepoStats(object):
 
                 return self.__connections
 
+        @property
+        def num_multiplexed(self):
+                """Return the number of requests to the host that were
+                multiplexed over a connection that was already
+                established."""
+
+                return self.__multiplexed
+
         @property
         def priority(self):
                 """Return the priority of the URI, if one is assigned."""
@@ -28,6 +28,7 @@ from __future__ import  print_function
 import copy
 import datetime as dt
 import errno
+import hashlib
 import os
 import simplejson as json
 import six
@@ -197,6 +198,29 @@ class TransportCfg(object):
                     if readonly or not cache.readonly
                 ]
 
+        def index_caches(self):
+                """Build an in-memory index of the content present in each
+                writeable cache so that checking whether content is cached
+                doesn't require probing the file system.  Readonly caches,
+                such as filesystem-based repositories, aren't indexed since
+                they can be much larger than the content an operation needs
+                from them."""
+
+                if not self.__caches_set:
+                        self.reset_caches(shared=True)
+
+                for pub_caches in self.__caches.values():
+                        for cache in pub_caches:
+                                if not cache.readonly and not cache.indexed:
+                                        cache.build_index()
+
+        def drop_cache_indexes(self):
+                """Discard any indexes built by index_caches()."""
+
+                for pub_caches in self.__caches.values():
+                        for cache in pub_caches:
+                                cache.drop_index()
+
         def get_policy(self, policy_name):
                 raise NotImplementedError
 
@@ -247,6 +271,13 @@ class TransportCfg(object):
         def get_publisher(self, publisher_name):
                 raise NotImplementedError
 
+        def share_content(self, hashval, path):
+                """Make the cached content for 'hashval' found at 'path'
+                available to other images that share a content cache with
+                this one.  The default implementation does nothing."""
+
+                pass
+
         def clear_caches(self, shared=False):
                 """Discard any cache information.
 
@@ -339,9 +370,17 @@ class TransportCfg(object):
         incoming_root = property(doc="The absolute pathname of the "
             "directory where in-progress downloads should be stored.")
 
+        partial_root = property(doc="The absolute pathname of the directory "
+            "where interrupted downloads are kept so that they can be "
+            "resumed, or None if they should be discarded.")
+
         pkg_root = property(doc="The absolute pathname of the directory "
             "where manifest files should be stored to and loaded from.")
 
+        stats_path = property(doc="The absolute pathname of the file that "
+            "repository statistics are kept in between invocations, or None "
+            "if they should be discarded.")
+
         user_agent = property(doc="A string that identifies the user agent for "
             "the transport.")
 
@@ -415,6 +454,9 @@ class ImageTransportCfg(TransportCfg):
         def get_publisher(self, publisher_name):
                 return self.__img.get_publisher(publisher_name)
 
+        def share_content(self, hashval, path):
+                self.__img.share_cached_content(hashval, path)
+
         def reset_caches(self, shared=True):
                 """Discard any publisher specific cache information and
                 reconfigure based on current publisher configuration data.
@@ -440,6 +482,14 @@ class ImageTransportCfg(TransportCfg):
             doc="The absolute pathname of the directory where in-progress "
             "downloads should be stored.")
 
+        partial_root = property(lambda self: self.__img._partial_cache_dir,
+            doc="The absolute pathname of the directory where interrupted "
+            "downloads are kept so that they can be resumed.")
+
+        stats_path = property(lambda self: os.path.join(self.__img._statedir,
+            "repostats"), doc="The absolute pathname of the file that "
+            "repository statistics are kept in between invocations.")
+
         user_agent = property(__get_user_agent, doc="A string that identifies "
             "the user agent for the transport.")
 
@@ -508,10 +558,18 @@ class GenericTransportCfg(TransportCfg):
             lambda self: self.__incoming_root, __set_inc_root,
             doc="Absolute pathname to directory of in-progress downloads.")
 
+        partial_root = property(lambda self: None,
+            doc="Interrupted downloads are not kept for clients without an "
+            "image.")
+
         pkg_root = property(lambda self: self.__pkg_root, __set_pkg_root,
             doc="The absolute pathname of the directory where in-progress "
             "downloads should be stored.")
 
+        stats_path = property(lambda self: None,
+            doc="Repository statistics are not kept for clients without an "
+            "image.")
+
         user_agent = property(__get_user_agent,
             doc="A string that identifies the user agent for the transport.")
 
@@ -567,7 +625,12 @@ class Transport(object):
                 self._lock = nrlock.NRLock()
                 self.cfg = tcfg
                 self.stats = tstats.RepoChooser()
+                # Set for transports created by clone(), which share the
+                # statistics that this one loads and saves.
+                self.__is_clone = False
                 self.repo_status = {}
+                # Protects repo_status, which is shared with clones.
+                self._status_lock = nrlock.NRLock()
                 self.__tmp_crls = {}
                 # Used to record those actions that will have their payload
                 # transferred.
@@ -584,6 +647,11 @@ class Transport(object):
 
                 self.__repo_cache = trepo.RepoCache(self.__engine)
 
+                # Start from the statistics observed by earlier invocations
+                # so that the best repositories are preferred straight away.
+                if self.cfg.stats_path and not self.__is_clone:
+                        self.stats.load(self.cfg.stats_path)
+
                 if self.cfg.get_policy(imageconfig.MIRROR_DISCOVERY):
                         self.__dynamic_mirrors = mdetect.MirrorDetector()
                         try:
@@ -627,6 +695,8 @@ class Transport(object):
 
                 self._lock.acquire()
                 try:
+                        if self.cfg.stats_path and not self.__is_clone:
+                                self.stats.save(self.cfg.stats_path)
                         self.__engine.shutdown()
                         self.__engine = None
                         if self.__repo_cache:
@@ -636,6 +706,46 @@ class Transport(object):
                 finally:
                         self._lock.release()
 
+        def index_caches(self):
+                """Index the content of the transport's writeable caches so
+                that checks for cached content made for the rest of the
+                current operation are set lookups.  Callers should call
+                drop_cache_indexes() once the operation is done."""
+
+                self._lock.acquire()
+                try:
+                        self.cfg.index_caches()
+                finally:
+                        self._lock.release()
+
+        def drop_cache_indexes(self):
+                """Discard the indexes built by index_caches()."""
+
+                self._lock.acquire()
+                try:
+                        self.cfg.drop_cache_indexes()
+                finally:
+                        self._lock.release()
+
+        def clone(self):
+                """Returns a new Transport object that shares this transport's
+                configuration, repository statistics, and repository status,
+                but that has its own engine.  The new object can be used
+                concurrently with this one (e.g. from another thread); the
+                caller is responsible for shutting it down once done.
+
+                Versions are only checked on demand for the new object, as
+                the repositories of interest have usually already been
+                checked by this one."""
+
+                xport = Transport(self.cfg)
+                xport.stats = self.stats
+                xport.repo_status = self.repo_status
+                xport._status_lock = self._status_lock
+                xport.__version_check_executed = True
+                xport.__is_clone = True
+                return xport
+
         @LockedTransport()
         def do_search(self, pub, data, ccancel=None, alt_repo=None):
                 """Perform a search request.  Returns a file-like object or an
@@ -845,7 +955,11 @@ class Transport(object):
                         completed_dir = path
                 else:
                         completed_dir = pub.catalog_root
-                download_dir = self.cfg.incoming_root
+                # Catalog files have the same names for every publisher, so
+                # each publisher's files are downloaded to a separate
+                # directory in case several are being refreshed at once.
+                download_dir = os.path.join(self.cfg.incoming_root,
+                    "catalog", pub.prefix)
 
                 # Call setup if the transport isn't configured or was shutdown.
                 if not self.__engine:
@@ -1556,7 +1670,8 @@ class Transport(object):
                         # unless we want to suppress a permanent failure.
                         try:
                                 errlist = d.get_manifests(mfstlist,
-                                    download_dir, progtrack=progtrack, pub=pub)
+                                    download_dir, progtrack=progtrack, pub=pub,
+                                    hash_func=hashlib.sha1)
                         except tx.ExcessiveTransientFailure as ex:
                                 # If an endpoint experienced so many failures
                                 # that we just gave up, record this for later
@@ -1600,10 +1715,14 @@ class Transport(object):
                                     s.get_url_path())
 
                                 try:
-                                        # Verify manifest content.
+                                        # Verify manifest content using the
+                                        # digest computed while it was
+                                        # downloaded, if there is one.
                                         fmri = mxfr[s][1]
-                                        verified = self._verify_manifest(fmri,
+                                        mhash = self.__engine.get_digest(
                                             dl_path)
+                                        verified = self._verify_manifest(fmri,
+                                            dl_path, mhash=mhash)
                                 except tx.InvalidContentException as e:
                                         e.request = s
                                         repostats.record_error(content=True)
@@ -1611,12 +1730,13 @@ class Transport(object):
                                         continue
 
                                 try:
-                                        mf = open(dl_path)
-                                        mcontent = mf.read()
-                                        mf.close()
+                                        # Parse the manifest from the file
+                                        # as it is read so that the whole
+                                        # content isn't held in memory.
                                         manifest.FactoredManifest(fmri,
                                             self.cfg.get_pkg_dir(fmri),
-                                            contents=mcontent, excludes=excludes,
+                                            content_path=dl_path,
+                                            excludes=excludes,
                                             pathname=self.cfg.get_pkg_pathname(fmri))
                                 except (apx.InvalidPackageErrors,
                                     ActionError) as e:
@@ -1650,7 +1770,8 @@ class Transport(object):
                         else:
                                 return
 
-        def _verify_manifest(self, fmri, mfstpath=None, content=None, pub=None):
+        def _verify_manifest(self, fmri, mfstpath=None, content=None, pub=None,
+            mhash=None):
                 """Verify a manifest.  The caller must supply the FMRI
                 for the package in 'fmri', as well as the path to the
                 manifest file that will be verified.  If signature information
@@ -1662,7 +1783,10 @@ class Transport(object):
                 The caller may either specify a pathname to a file that
                 contains the manifest in 'mfstpath' or a string that contains
                 the manifest content in 'content'.  One of these arguments
-                must be used."""
+                must be used.  If the SHA-1 digest of the manifest content was
+                already computed, for example while the manifest was being
+                downloaded, it may be supplied in 'mhash' so that 'mfstpath'
+                does not have to be read."""
 
                 # Bail if manifest validation has been turned off for
                 # debugging/testing purposes.
@@ -1700,17 +1824,20 @@ class Transport(object):
                                     "Did not validate manifest; no sha-1 sig."
                         return False
 
-                if mfstpath:
-                        mf = open(mfstpath)
-                        mcontent = mf.read()
-                        mf.close()
-                elif content is not None:
-                        mcontent = content
+                if mhash and mfstpath:
+                        newhash = mhash
                 else:
-                        raise ValueError("Caller must supply either mfstpath "
-                            "or content arguments.")
+                        if mfstpath:
+                                mf = open(mfstpath)
+                                mcontent = mf.read()
+                                mf.close()
+                        elif content is not None:
+                                mcontent = content
+                        else:
+                                raise ValueError("Caller must supply either "
+                                    "mfstpath or content arguments.")
 
-                newhash = manifest.Manifest.hash_create(mcontent)
+                        newhash = manifest.Manifest.hash_create(mcontent)
 
                 if chash != newhash:
                         if mfstpath:
@@ -1790,6 +1917,9 @@ class Transport(object):
 
                 # download_dir is temporary download path.
                 download_dir = self.cfg.incoming_root
+                # Interrupted downloads are kept in resume_dir, by hash, so
+                # that later attempts only retrieve the rest of the file.
+                resume_dir = self.cfg.partial_root
 
                 cache = self.cfg.get_caches(pub, readonly=False)
                 if cache:
@@ -1799,6 +1929,15 @@ class Transport(object):
                 else:
                         cache = None
 
+                # Have the engine compute the digest used to verify each
+                # file while it is downloaded, so that the file doesn't
+                # have to be read again once the transfer completes.
+                hashes = {}
+                for s in filelist:
+                        hash_val, hash_func, decompressed = \
+                            self.__get_content_hash(mfile[s][0], s)
+                        hashes[s] = (hash_func, decompressed)
+
                 for d, retries, v in self.__gen_repo(pub, retry_count,
                     operation="file", versions=[0, 1],
                     alt_repo=mfile.get_alt_repo()):
@@ -1816,7 +1955,8 @@ class Transport(object):
                         # unless we want to supress a permanant failure.
                         try:
                                 errlist = d.get_files(filelist, download_dir,
-                                    progtrack, v, header, pub=pub)
+                                    progtrack, v, header, pub=pub,
+                                    hashes=hashes, resume_dir=resume_dir)
                         except tx.ExcessiveTransientFailure as ex:
                                 # If an endpoint experienced so many failures
                                 # that we just gave up, record this for later
@@ -1864,7 +2004,8 @@ class Transport(object):
 
                                 try:
                                         self._verify_content(mfile[s][0],
-                                            dl_path)
+                                            dl_path, fhash=
+                                            self.__engine.get_digest(dl_path))
                                 except tx.InvalidContentException as e:
                                         mfile.subtract_progress(e.size)
                                         e.request = s
@@ -1916,6 +2057,8 @@ class Transport(object):
                 # Check if the download_dir exists.  If it doesn't create
                 # the directories.
                 self._makedirs(download_dir)
+                if self.cfg.partial_root:
+                        self._makedirs(self.cfg.partial_root)
 
                 # Call statvfs to find the blocksize of download_dir's
                 # filesystem.
@@ -2396,16 +2539,27 @@ class Transport(object):
                                 raise apx.UnsupportedRepositoryOperation(pub,
                                     "{0}/{1:d}".format(operation, versions[-1]))
 
+        def __get_bounds(self, min_prop, max_prop):
+                """Return a tuple of (minimum, maximum) from the values of
+                the image properties named 'min_prop' and 'max_prop', or
+                their defaults if the transport isn't used by an image."""
+
+                bounds = []
+                for prop in (min_prop, max_prop):
+                        try:
+                                bounds.append(int(self.cfg.get_property(prop)))
+                        except KeyError:
+                                bounds.append(
+                                    imageconfig.default_properties[prop])
+                return tuple(bounds)
+
         def __chunk_size(self, pub, alt_repo=None, origin_only=False):
-                """Determine the chunk size based upon how many of the known
-                mirrors have been visited.  If not all mirrors have been
-                visited, choose a small size so that if it ends up being
+                """Determine the chunk size, and the number of requests the
+                engine performs concurrently, from the statistics observed
+                for the known origins and mirrors.  If not all mirrors have
+                been visited, choose a small size so that if it ends up being
                 a poor choice, the client doesn't transfer too much data."""
 
-                CHUNK_SMALL = 10
-                CHUNK_LARGE = 100
-                CHUNK_HUGE = 1024
-
                 # Call setup if the transport isn't configured or was shutdown.
                 if not self.__engine:
                         self.__setup()
@@ -2427,13 +2581,13 @@ class Transport(object):
                         repolist = [pub]
 
                 repolist = _convert_repouris(repolist)
-                n = len(repolist)
-                m = self.stats.get_num_visited(repolist)
-                if n == 1:
-                        return CHUNK_HUGE
-                if m < n:
-                        return CHUNK_SMALL
-                return CHUNK_LARGE
+                chunksz, conns = self.stats.get_transfer_params(repolist,
+                    self.__get_bounds(imageconfig.TRANSPORT_CHUNK_MIN,
+                    imageconfig.TRANSPORT_CHUNK_MAX),
+                    self.__get_bounds(imageconfig.TRANSPORT_CONN_MIN,
+                    imageconfig.TRANSPORT_CONN_MAX))
+                self.__engine.set_max_connections(conns)
+                return chunksz
 
         @LockedTransport()
         def valid_publisher_test(self, pub, ccancel=None):
@@ -2510,10 +2664,9 @@ class Transport(object):
                 fail = tx.TransportFailures()
                 vd = None
 
-                if "total" in self.repo_status.setdefault(pub.prefix, {}):
-                        self.repo_status[pub.prefix]["total"] += 1
-                else:
-                        self.repo_status[pub.prefix]["total"] = 1
+                with self._status_lock:
+                        status = self.repo_status.setdefault(pub.prefix, {})
+                        status["total"] = status.get("total", 0) + 1
 
                 try:
                         vd = self._get_versions(pub, ccancel=ccancel)
@@ -2528,10 +2681,12 @@ class Transport(object):
                 if not vd or not self._valid_versions_test(vd):
                         exc = apx.InvalidDepotResponseException(
                             pub.repository.origins[0].uri, fail)
-                        # Publisher names can't start with _ so this is safe.
-                        self.repo_status["_failures"] = None
-                        self.repo_status[pub.prefix].setdefault(
-                            "errors", set([])).add(exc)
+                        with self._status_lock:
+                                # Publisher names can't start with _ so this
+                                # is safe.
+                                self.repo_status["_failures"] = None
+                                self.repo_status.setdefault(pub.prefix,
+                                    {}).setdefault("errors", set([])).add(exc)
                         raise exc
 
         @staticmethod
@@ -2660,6 +2815,7 @@ class Transport(object):
                         try:
                                 if verify:
                                         self._verify_content(action, cache_path)
+                                self.cfg.share_content(hash_val, cache_path)
                                 return cache_path
                         except tx.InvalidContentException:
                                 # If the content in the cache doesn't match the
@@ -2702,11 +2858,13 @@ class Transport(object):
                 return self._make_opener(self._action_cached(action, pub,
                     verify=False))
 
-        def _verify_content(self, action, filepath):
-                """If action contains an attribute that has the compressed
-                hash, read the file specified in filepath and verify
-                that the hash values match.  If the values do not match,
-                remove the file and raise an InvalidContentException."""
+        @staticmethod
+        def __get_content_hash(action, name):
+                """Returns a tuple of (hash_val, hash_func, decompressed)
+                describing the hash that the file named 'name', delivering
+                the payload of 'action', must match.  If 'decompressed' is
+                True, the hash is of the decompressed content of the file;
+                otherwise, it is of the compressed file itself."""
 
                 chash_attr, chash, chash_func = digest.get_preferred_hash(
                     action, hash_type=digest.CHASH)
@@ -2729,7 +2887,6 @@ class Transport(object):
                         # and we're looking at file "b.b" then we must compare
                         # our computed value against the "BB" chash.
                         #
-                        name = os.path.basename(filepath)
                         found = False
                         assert len(action.get_chain_certs(
                             least_preferred=True)) == \
@@ -2741,29 +2898,50 @@ class Transport(object):
                                         found = True
                                         chash = c
                                         break
+                if chash:
+                        return chash, chash_func, False
+
+                # Compressed hash doesn't exist; use the hash of the
+                # uncompressed content.
+                hash_attr, hash_val, hash_func = digest.get_preferred_hash(
+                    action, hash_type=digest.HASH)
+                return hash_val, hash_func, True
+
+        def _verify_content(self, action, filepath, fhash=None):
+                """If action contains an attribute that has the compressed
+                hash, read the file specified in filepath and verify
+                that the hash values match.  If the values do not match,
+                remove the file and raise an InvalidContentException.
+
+                If 'fhash' is provided, it is the digest of the file that
+                was computed while it was downloaded, and the file is not
+                read again."""
+
+                chash, chash_func, decompressed = self.__get_content_hash(
+                    action, os.path.basename(filepath))
                 path = action.attrs.get("path", None)
-                if not chash:
+                if decompressed:
                         # Compressed hash doesn't exist.  Decompress and
-                        # generate hash of uncompressed content.
-                        ifile = open(filepath, "rb")
-                        ofile = open(os.devnull, "wb")
-
-                        try:
-                                hash_attr, hash_val, hash_func = \
-                                    digest.get_preferred_hash(action,
-                                        hash_type=digest.HASH)
-                                fhash = misc.gunzip_from_stream(ifile, ofile,
-                                    hash_func=hash_func)
-                        except zlib.error as e:
-                                s = os.stat(filepath)
-                                portable.remove(filepath)
-                                raise tx.InvalidContentException(path,
-                                    "zlib.error:{0}".format(
-                                    " ".join([str(a) for a in e.args])),
-                                    size=s.st_size)
+                        # generate hash of uncompressed content, unless
+                        # that was done during the download.
+                        hash_val, hash_func = chash, chash_func
+                        if fhash is None:
+                                ifile = open(filepath, "rb")
+                                ofile = open(os.devnull, "wb")
 
-                        ifile.close()
-                        ofile.close()
+                                try:
+                                        fhash = misc.gunzip_from_stream(ifile,
+                                            ofile, hash_func=hash_func)
+                                except zlib.error as e:
+                                        s = os.stat(filepath)
+                                        portable.remove(filepath)
+                                        raise tx.InvalidContentException(path,
+                                            "zlib.error:{0}".format(
+                                            " ".join([str(a) for a in e.args])),
+                                            size=s.st_size)
+
+                                ifile.close()
+                                ofile.close()
 
                         if hash_val != fhash:
                                 s = os.stat(filepath)
@@ -2774,8 +2952,10 @@ class Transport(object):
                                     size=s.st_size)
                         return
 
-                newhash = misc.get_data_digest(filepath,
-                    hash_func=chash_func)[0]
+                newhash = fhash
+                if newhash is None:
+                        newhash = misc.get_data_digest(filepath,
+                            hash_func=chash_func)[0]
                 if chash != newhash:
                         s = os.stat(filepath)
                         # Check whether we're using the path as a part of the
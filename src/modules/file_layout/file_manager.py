@@ -37,7 +37,9 @@ present but not located according to where it should be located according to
 the first layout and the FileManager has permission to move the file, it
 wil be moved to that location.  When a file is removed, the layouts are
 checked in turn until a file is found and removed.  The FileManager also
-provides a way to generate all hashes stored by the FileManager."""
+provides a way to generate all hashes stored by the FileManager, and can
+keep an index of them in memory so that lookups of files that aren't
+present don't need to probe the file system."""
 
 import collections
 import errno
@@ -109,6 +111,22 @@ class UnrecognizedFilePaths(apx.ApiException):
                     "\n".join(self.fps))
 
 
+def _link_or_copy(src, dst):
+        """Hard link 'src' to 'dst', falling back to a copy if 'dst' is on a
+        different filesystem or links aren't permitted there."""
+
+        try:
+                os.link(src, dst)
+        except EnvironmentError as e:
+                if e.errno == errno.EEXIST:
+                        # Files are named by their content, so whatever is
+                        # already in place is the same content.
+                        return
+                if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                        raise
+                portable.copyfile(src, dst)
+
+
 class FileManager(object):
         """The FileManager class handles the insertion and removal of files
         within its directory according to a strategy for organizing the
@@ -132,11 +150,39 @@ class FileManager(object):
                         self.layouts = layouts
                 else:
                         self.layouts = layout.get_default_layouts()
+                # The set of hashes known to be present, if an index has been
+                # built; otherwise None.
+                self.__index = None
 
         def set_read_only(self):
                 """Make the FileManager read only."""
                 self.readonly = True
 
+        def build_index(self):
+                """Record the hashes of all of the files currently present so
+                that lookups of files that aren't present can be answered
+                without probing the file system.  The index is kept current
+                as files are inserted and removed through this FileManager,
+                but not if the files are changed by other means, so it should
+                only be kept for the duration of an operation."""
+
+                index = set()
+                try:
+                        for hashval in self.walk():
+                                index.add(hashval)
+                except UnrecognizedFilePaths:
+                        # Files that no layout accounts for can't be looked
+                        # up either, so they don't belong in the index.
+                        pass
+                self.__index = index
+
+        def drop_index(self):
+                """Discard the index built by build_index()."""
+                self.__index = None
+
+        indexed = property(lambda self: self.__index is not None,
+            doc="Whether an index of the files present has been built.")
+
         def __select_path(self, hashval, check_existence):
                 """Find the path to the file with name hashval.
 
@@ -169,6 +215,10 @@ class FileManager(object):
                 The "opener" parameter determines whether the function will
                 return a path or an open file handle."""
 
+                if check_existence and self.__index is not None and \
+                    hashval not in self.__index:
+                        return None
+
                 cur_full_path, dest_full_path = self.__select_path(hashval,
                     check_existence)
                 if not cur_full_path:
@@ -242,6 +292,12 @@ class FileManager(object):
                 "hashval".  Returns the path to the copied file."""
                 return self.__place(hashval, src_path, portable.copyfile)
 
+        def link(self, hashval, src_path):
+                """Hard link the content at "src_path" to the files under the
+                name "hashval", or copy it if it can't be linked.  Returns the
+                path to the linked file."""
+                return self.__place(hashval, src_path, _link_or_copy)
+
         def insert(self, hashval, src_path):
                 """Add the content at "src_path" to the files under the name
                 "hashval".  Returns the path to the inserted file."""
@@ -253,6 +309,8 @@ class FileManager(object):
 
                 if self.readonly:
                         raise NeedToModifyReadOnlyFileManager(hashval)
+                if self.__index is not None:
+                        self.__index.add(hashval)
                 cur_full_path, dest_full_path = \
                     self.__select_path(hashval, True)
 
@@ -344,6 +402,8 @@ class FileManager(object):
                 if self.readonly:
                         raise NeedToModifyReadOnlyFileManager(hashval,
                             "remove")
+                if self.__index is not None:
+                        self.__index.discard(hashval)
                 for l in self.layouts:
                         cur_path = l.lookup(hashval)
                         cur_full_path = os.path.join(self.root, cur_path)
@@ -1003,6 +1003,9 @@ class Manifest(object):
 
                 set name=pkg.summary value="foo"
                 set name=pkg.description value="foo " "bar baz"
+
+                'content' may be a string or an iterable of lines, such as
+                a file object; any line terminators are ignored.
                 """
 
                 accumulate = ""
@@ -1015,7 +1018,7 @@ class Manifest(object):
 
                 for l in content:
                         lineno += 1
-                        l = l.lstrip()
+                        l = l.lstrip().rstrip("\r\n")
                         if l.endswith("\\"):          # allow continuation chars
                                 accumulate += l[0:-1] # elide backslash
                                 continue
@@ -1075,7 +1078,19 @@ class Manifest(object):
                 # can't be in a manifest twice.  (The problem of having the same
                 # action more than once in packages that can be installed
                 # together has to be solved somewhere else, though.)
-                if pathname:
+                if pathname and not signatures:
+                        # Parse the manifest as it is read so that its
+                        # content doesn't have to be held in memory.
+                        try:
+                                with open(pathname, "r") as mfile:
+                                        for action in \
+                                            self.__content_to_actions(mfile):
+                                                self.add_action(action,
+                                                    excludes)
+                        except EnvironmentError as e:
+                                raise apx._convert_error(e)
+                        content = EmptyI
+                elif pathname:
                         try:
                                 with open(pathname, "r") as mfile:
                                         content = mfile.read()
@@ -1544,7 +1559,7 @@ class FactoredManifest(Manifest):
         the appropriate variants/facets."""
 
         def __init__(self, fmri, cache_root, contents=None, excludes=EmptyI,
-            pathname=None):
+            pathname=None, content_path=None):
                 """Raises KeyError exception if factored manifest is not present
                 and contents are None; delays reading of manifest until required
                 if cache file is present.
@@ -1568,6 +1583,10 @@ class FactoredManifest(Manifest):
                 'cache_root'.  If provided, and contents is also provided, then
                 'contents' will be stored in 'pathname' if it does not already
                 exist.
+
+                'content_path' is an optional pathname of a file containing
+                the manifest to use instead of 'contents'; it is parsed as it
+                is read rather than being read into memory first.
                 """
 
                 Manifest.__init__(self, fmri)
@@ -1580,12 +1599,13 @@ class FactoredManifest(Manifest):
 
                 # Do we have a cached copy?
                 if not os.path.exists(self.pathname):
-                        if contents is None:
+                        if contents is None and content_path is None:
                                 raise KeyError(fmri)
                         # we have no cached copy; save one
                         # don't specify excludes so on-disk copy has
                         # all variants
-                        self.set_content(content=contents)
+                        self.set_content(content=contents,
+                            pathname=content_path)
                         self.__finiload()
                         if self.__storeback():
                                 self.__unload()
@@ -28,6 +28,7 @@ from __future__ import division
 
 import cherrypy
 from cherrypy._cptools import HandlerTool
+from cherrypy.lib import cptools
 from cherrypy.lib.static import serve_file
 from email.utils import formatdate
 from cherrypy.process.plugins import SimplePlugin
@@ -42,7 +43,9 @@ else:
 
 import atexit
 import ast
+import collections
 import errno
+import hashlib
 import inspect
 import itertools
 import math
@@ -99,6 +102,11 @@ class DepotHTTP(_Depot):
         application object and represents the set of operations that a
         pkg.depotd server provides to HTTP-based clients."""
 
+        # The hex digests of the hash algorithms used to name files: SHA-1,
+        # SHA-256, SHA-384 and SHA-512.
+        FILE_HASH_RE = re.compile(
+            r"^(?:[0-9a-f]{40}|[0-9a-f]{64}|[0-9a-f]{96}|[0-9a-f]{128})$")
+
         REPO_OPS_DEFAULT = [
             "versions",
             "search",
@@ -106,6 +114,7 @@ class DepotHTTP(_Depot):
             "info",
             "manifest",
             "file",
+            "files",
             "open",
             "append",
             "close",
@@ -125,6 +134,7 @@ class DepotHTTP(_Depot):
             "info",
             "manifest",
             "file",
+            "files",
             "p5i",
             "publisher",
             "status",
@@ -133,6 +143,7 @@ class DepotHTTP(_Depot):
         REPO_OPS_MIRROR = [
             "versions",
             "file",
+            "files",
             "publisher",
             "status",
         ]
@@ -140,6 +151,9 @@ class DepotHTTP(_Depot):
         content_root = None
         web_root = None
 
+        # The maximum number of responses kept by the response cache.
+        RESPONSE_CACHE_SIZE = 4096
+
         def __init__(self, repo, dconf, request_pub_func=None):
                 """Initialize and map the valid operations for the depot.  While
                 doing so, ensure that the operations have been explicitly
@@ -154,6 +168,12 @@ class DepotHTTP(_Depot):
                 # threads modifying data structures at the same time.
                 self._lock = pkg.nrlock.NRLock()
 
+                # Responses for operations whose results only change when the
+                # repository does, keyed by request, in least to most recently
+                # used order; see __get_cached().
+                self.__response_cache = collections.OrderedDict()
+                self.__response_cache_lock = pkg.nrlock.NRLock()
+
                 self.cfg = dconf
                 self.repo = repo
                 self.request_pub_func = request_pub_func
@@ -373,6 +393,67 @@ class DepotHTTP(_Depot):
                         max_age)
                 headers["Expires"] = formatdate(timeval=expires, usegmt=True)
 
+        def __get_cached(self, key, build, hit=None):
+                """Returns the value for the request identified by the tuple
+                'key', calling 'build' to produce it only if it isn't cached or
+                the repository has changed since it was.  Exceptions raised by
+                'build' are not cached.  'hit' is an optional function to call
+                when the cached value is used instead."""
+
+                gen = self.repo.generation
+                with self.__response_cache_lock:
+                        entry = self.__response_cache.pop(key, None)
+                        if entry and entry[0] == gen:
+                                # Mark as most recently used.
+                                self.__response_cache[key] = entry
+                        else:
+                                entry = None
+                if entry:
+                        if hit:
+                                hit()
+                        return entry[1]
+
+                # If the repository changes while building the value, it is
+                # cached with the old generation and discarded on next use.
+                val = build()
+                with self.__response_cache_lock:
+                        self.__response_cache[key] = (gen, val)
+                        while len(self.__response_cache) > \
+                            self.RESPONSE_CACHE_SIZE:
+                                self.__response_cache.popitem(last=False)
+                return val
+
+        @staticmethod
+        def __validate_etag(etag):
+                """Sets the strong entity tag 'etag' for the response and
+                raises an HTTP 304 (or 412) if the request's conditional
+                headers show that the client already has it."""
+
+                cherrypy.response.headers["ETag"] = etag
+                cptools.validate_etags()
+
+        @staticmethod
+        def __etag_for_body(body):
+                """Returns a strong entity tag for the response 'body'."""
+
+                return '"{0}"'.format(hashlib.sha1(
+                    misc.force_bytes(body)).hexdigest())
+
+        def __serve_cached_file(self, fpath, content_type):
+                """Serves the file at 'fpath' with an entity tag derived from
+                its identity, size, and modification time, so that it changes
+                even if the file is replaced by another process."""
+
+                try:
+                        st = os.stat(fpath)
+                except EnvironmentError:
+                        # Let serve_file report the error.
+                        pass
+                else:
+                        self.__validate_etag('"{0:x}-{1:x}-{2!r}"'.format(
+                            st.st_ino, st.st_size, st.st_mtime))
+                return serve_file(fpath, content_type)
+
         def refresh(self):
                 """Catch SIGUSR1 and reload the depot information."""
                 old_pubs = self.repo.publishers
@@ -480,11 +561,18 @@ class DepotHTTP(_Depot):
                 versions, supported by the repository."""
 
                 self.__set_response_expires("versions", 5*60, 5*60)
-                versions = "pkg-server {0}\n".format(pkg.VERSION)
-                versions += "\n".join(
-                    "{0} {1}".format(op, " ".join(str(v) for v in vers))
-                    for op, vers in six.iteritems(self.vops)
-                ) + "\n"
+
+                def build():
+                        versions = "pkg-server {0}\n".format(pkg.VERSION)
+                        versions += "\n".join(
+                            "{0} {1}".format(op, " ".join(str(v)
+                                for v in vers))
+                            for op, vers in six.iteritems(self.vops)
+                        ) + "\n"
+                        return self.__etag_for_body(versions), versions
+
+                etag, versions = self.__get_cached(("versions", 0), build)
+                self.__validate_etag(etag)
                 return versions
 
         def search_1(self, *args, **params):
@@ -578,9 +666,12 @@ class DepotHTTP(_Depot):
                         raise cherrypy.HTTPError(http_client.FORBIDDEN,
                             _("Directory listing not allowed."))
 
+                pub = self._get_req_pub()
+                key = ("catalog", 1, pub, name)
                 try:
-                        fpath = self.repo.catalog_1(name,
-                            pub=self._get_req_pub())
+                        fpath = self.__get_cached(key,
+                            lambda: self.repo.catalog_1(name, pub=pub),
+                            hit=self.repo.inc_catalog)
                 except srepo.RepositoryError as e:
                         # Treat any remaining repository error as a 404, but
                         # log the error and include the real failure
@@ -589,7 +680,8 @@ class DepotHTTP(_Depot):
                         raise cherrypy.HTTPError(http_client.NOT_FOUND, str(e))
 
                 self.__set_response_expires("catalog", 86400, 86400)
-                return serve_file(fpath, "text/plain; charset=utf-8")
+                return self.__serve_cached_file(fpath,
+                    "text/plain; charset=utf-8")
 
         catalog_1._cp_config = { "response.stream": True }
 
@@ -616,16 +708,18 @@ class DepotHTTP(_Depot):
                         # Only one slash here as another will be added below.
                         comps[0] += "/"
 
+                # If more than one token (request path component) was
+                # specified, assume that the extra components are part of the
+                # fmri and have been split out because of bad proxy behaviour.
+                pfmri = "/".join(comps)
+                pub = self._get_req_pub()
+
                 # Parse request into FMRI component and decode.
                 try:
-                        # If more than one token (request path component) was
-                        # specified, assume that the extra components are part
-                        # of the fmri and have been split out because of bad
-                        # proxy behaviour.
-                        pfmri = "/".join(comps)
-                        pfmri = fmri.PkgFmri(pfmri, None)
-                        fpath = self.repo.manifest(pfmri,
-                            pub=self._get_req_pub())
+                        fpath = self.__get_cached(("manifest", 0, pub, pfmri),
+                            lambda: self.repo.manifest(
+                            fmri.PkgFmri(pfmri, None), pub=pub),
+                            hit=self.repo.inc_manifest)
                 except (IndexError, fmri.FmriError) as e:
                         raise cherrypy.HTTPError(http_client.BAD_REQUEST, str(e))
                 except srepo.RepositoryError as e:
@@ -637,7 +731,8 @@ class DepotHTTP(_Depot):
 
                 # Send manifest
                 self.__set_response_expires("manifest", 86400*365, 86400*365)
-                return serve_file(fpath, "text/plain; charset=utf-8")
+                return self.__serve_cached_file(fpath,
+                    "text/plain; charset=utf-8")
 
         manifest_0._cp_config = { "response.stream": True }
 
@@ -692,7 +787,9 @@ class DepotHTTP(_Depot):
 
         def file_0(self, *tokens):
                 """Outputs the contents of the file, named by the SHA-1 hash
-                name in the request path, directly to the client."""
+                name in the request path, directly to the client.  Byte range
+                requests are honored so that clients can resume interrupted
+                downloads."""
 
                 try:
                         fhash = tokens[0]
@@ -749,8 +846,8 @@ class DepotHTTP(_Depot):
                                 fhash = None
 
                         try:
-                                fpath = self.repo.file(fhash,
-                                    pub=self._get_req_pub())
+                                fpath, csize, chashes = self.repo.file_attrs(
+                                    fhash, pub=self._get_req_pub())
                         except srepo.RepositoryFileNotFoundError as e:
                                 raise cherrypy.HTTPError(http_client.NOT_FOUND,
                                     str(e))
@@ -763,8 +860,6 @@ class DepotHTTP(_Depot):
                                 raise cherrypy.HTTPError(http_client.NOT_FOUND,
                                     str(e))
 
-                        csize, chashes = misc.compute_compressed_attrs(fhash,
-                            file_path=fpath)
                         response = cherrypy.response
                         for i, attr in enumerate(chashes):
                                 response.headers["X-Ipkg-Attr-{0}".format(i)] = \
@@ -779,6 +874,96 @@ class DepotHTTP(_Depot):
 
         file_2._cp_config = { "response.stream": True }
 
+        def files_0(self, *tokens):
+                """Outputs a tar stream of the files named by the SHA hashes
+                listed, one per line, in the request body.  Files that can't
+                be found are omitted from the stream; the client retrieves
+                those individually using the file operation."""
+
+                request = cherrypy.request
+                if request.method != "POST":
+                        raise cherrypy.HTTPError(
+                            http_client.METHOD_NOT_ALLOWED,
+                            "{0} is not allowed".format(request.method))
+
+                try:
+                        size = int(request.headers.get("Content-Length", 0))
+                except ValueError:
+                        size = 0
+                if size <= 0:
+                        raise cherrypy.HTTPError(http_client.BAD_REQUEST,
+                            "files/0 must be sent a list of files.")
+
+                hashes = misc.force_str(request.rfile.read(size)).split()
+                for fhash in hashes:
+                        # The hashes are used to find files in the
+                        # repository, so anything other than a digest is
+                        # rejected rather than looked up.
+                        if not self.FILE_HASH_RE.match(fhash):
+                                raise cherrypy.HTTPError(
+                                    http_client.BAD_REQUEST,
+                                    "Invalid file hash: {0}".format(fhash))
+
+                pub = self._get_req_pub()
+                files = []
+                for fhash in hashes:
+                        try:
+                                files.append((fhash,
+                                    self.repo.file(fhash, pub=pub)))
+                        except srepo.RepositoryError:
+                                continue
+
+                cherrypy.response.headers["Content-Type"] = "application/x-tar"
+                return self._tar_stream_files(files)
+
+        # The request body is read by files_0 itself.
+        files_0._cp_config = {
+            "request.process_request_body": False,
+            "response.timeout": 3600,
+            "response.stream": True
+        }
+
+        @staticmethod
+        def _tar_stream_files(files):
+                """A generator that yields a tar stream containing the given
+                list of (name, path) files.  The content of each file is read
+                and written a piece at a time so that the size of the files
+                doesn't affect the memory used to serve the request."""
+
+                bufsz = 128 * 1024
+                for name, fpath in files:
+                        try:
+                                f = open(fpath, "rb")
+                        except EnvironmentError:
+                                # Files that can't be read are retrieved
+                                # individually by the client.
+                                continue
+
+                        with f:
+                                st = os.fstat(f.fileno())
+                                ti = tarfile.TarInfo(name)
+                                ti.size = st.st_size
+                                ti.mtime = st.st_mtime
+                                ti.mode = misc.PKG_FILE_MODE
+                                yield ti.tobuf(format=tarfile.USTAR_FORMAT)
+
+                                remaining = ti.size
+                                while remaining > 0:
+                                        data = f.read(min(bufsz, remaining))
+                                        if not data:
+                                                break
+                                        remaining -= len(data)
+                                        yield data
+                                # Should the file have been truncated, the
+                                # client will detect the corrupt content.
+                                pad = remaining + \
+                                    -ti.size % tarfile.BLOCKSIZE
+                                if pad:
+                                        yield b"\0" * pad
+
+                # End-of-archive marker.
+                yield b"\0" * (tarfile.BLOCKSIZE * 2)
+
         @cherrypy.tools.response_headers(headers=[("Pragma", "no-cache"),
             ("Cache-Control", "no-cache, no-transform, must-revalidate"),
             ("Expires", 0)])
@@ -1297,28 +1482,38 @@ License:
                 repository configuration's publisher information."""
 
                 prefix = self._get_req_pub()
-                pubs = [
-                   pub for pub in self.repo.get_publishers()
-                   if not prefix or pub.prefix == prefix
-                ]
-                if prefix and not pubs:
-                        # Publisher specified in request is unknown.
-                        e = srepo.RepositoryUnknownPublisher(prefix)
-                        cherrypy.log("Request failed: {0}".format(str(e)))
-                        raise cherrypy.HTTPError(http_client.NOT_FOUND, str(e))
 
-                buf = cStringIO()
-                try:
-                        p5i.write(buf, pubs)
-                except Exception as e:
-                        # Treat any remaining error as a 404, but log it and
-                        # include the real failure information.
-                        cherrypy.log("Request failed: {0}".format(str(e)))
-                        raise cherrypy.HTTPError(http_client.NOT_FOUND, str(e))
-                buf.seek(0)
+                def build():
+                        pubs = [
+                           pub for pub in self.repo.get_publishers()
+                           if not prefix or pub.prefix == prefix
+                        ]
+                        if prefix and not pubs:
+                                # Publisher specified in request is unknown.
+                                e = srepo.RepositoryUnknownPublisher(prefix)
+                                cherrypy.log("Request failed: {0}".format(
+                                    str(e)))
+                                raise cherrypy.HTTPError(
+                                    http_client.NOT_FOUND, str(e))
+
+                        buf = cStringIO()
+                        try:
+                                p5i.write(buf, pubs)
+                        except Exception as e:
+                                # Treat any remaining error as a 404, but log
+                                # it and include the real failure information.
+                                cherrypy.log("Request failed: {0}".format(
+                                    str(e)))
+                                raise cherrypy.HTTPError(
+                                    http_client.NOT_FOUND, str(e))
+                        # Page handlers MUST return bytes.
+                        out = misc.force_bytes(buf.getvalue())
+                        return self.__etag_for_body(out), out
+
+                etag, out = self.__get_cached(("publisher", 0, prefix), build)
                 self.__set_response_expires("publisher", 86400*365, 86400*365)
-                # Page handlers MUST return bytes.
-                return misc.force_bytes(buf.getvalue())
+                self.__validate_etag(etag)
+                return out
 
         @cherrypy.tools.response_headers(headers=[(
             "Content-Type", p5i.MIME_TYPE)])
@@ -1328,33 +1523,42 @@ License:
 
                 prefix = self._get_req_pub()
 
-                pubs = []
-                if not prefix:
-                        pubs = self.repo.get_publishers()
-                else:
+                def build():
+                        pubs = []
+                        if not prefix:
+                                pubs = self.repo.get_publishers()
+                        else:
+                                try:
+                                        pub = self.repo.get_publisher(prefix)
+                                        pubs.append(pub)
+                                except Exception as e:
+                                        # If the Publisher object creation
+                                        # fails, return a not found error to the
+                                        # client so it will treat it as an
+                                        # unsupported operation.
+                                        cherrypy.log("Request failed: "
+                                            "{0}".format(str(e)))
+                                        raise cherrypy.HTTPError(
+                                            http_client.NOT_FOUND, str(e))
+
+                        buf = cStringIO()
                         try:
-                                pub = self.repo.get_publisher(prefix)
-                                pubs.append(pub)
+                                p5i.write(buf, pubs)
                         except Exception as e:
-                                # If the Publisher object creation fails, return
-                                # a not found error to the client so it will
-                                # treat it as an unsupported operation.
+                                # Treat any remaining error as a 404, but log
+                                # it and include the real failure information.
                                 cherrypy.log("Request failed: {0}".format(
                                     str(e)))
-                                raise cherrypy.HTTPError(http_client.NOT_FOUND,
-                                    str(e))
+                                raise cherrypy.HTTPError(
+                                    http_client.NOT_FOUND, str(e))
+                        # Page handlers MUST return bytes.
+                        out = misc.force_bytes(buf.getvalue())
+                        return self.__etag_for_body(out), out
 
-                buf = cStringIO()
-                try:
-                        p5i.write(buf, pubs)
-                except Exception as e:
-                        # Treat any remaining error as a 404, but log it and
-                        # include the real failure information.
-                        cherrypy.log("Request failed: {0}".format(str(e)))
-                        raise cherrypy.HTTPError(http_client.NOT_FOUND, str(e))
-                buf.seek(0)
+                etag, out = self.__get_cached(("publisher", 1, prefix), build)
                 self.__set_response_expires("publisher", 86400*365, 86400*365)
-                return buf.getvalue()
+                self.__validate_etag(etag)
+                return out
 
         def __get_matching_p5i_data(self, rstore, pfmri):
                 # Attempt to find matching entries in the catalog.
@@ -1474,7 +1678,12 @@ License:
                 except Exception as e:
                         raise cherrypy.HTTPError(http_client.NOT_FOUND, _("Unable "
                             "to generate statistics."))
-                return misc.force_bytes(out + "\n")
+                out = misc.force_bytes(out + "\n")
+                # The status includes the lock state and request counts of the
+                # repository, so it can't be cached, but clients can still be
+                # told when it hasn't changed.
+                self.__validate_etag(self.__etag_for_body(out))
+                return out
 
 def nasty_before_handler(nasty_depot, maxroll=100):
         """Cherrypy Tool callable which generates various problems prior to a
@@ -24,10 +24,14 @@
 from __future__ import print_function
 
 import codecs
+import collections
 import datetime
 import errno
 import hashlib
+import itertools
 import logging
+import multiprocessing
+import multiprocessing.pool
 import os
 import os.path
 import shutil
@@ -35,6 +39,7 @@ import six
 import stat
 import sys
 import tempfile
+import threading
 import zlib
 
 from cryptography import x509
@@ -64,6 +69,7 @@ import pkg.query_parser as qp
 import pkg.server.query_parser as sqp
 import pkg.server.transaction as trans
 import pkg.pkgsubprocess as subprocess
+import pkg.search_storage as ss
 import pkg.version
 
 from pkg.pkggzip import PkgGzipFile
@@ -72,6 +78,10 @@ CURRENT_REPO_VERSION = 4
 
 REPO_QUARANTINE_DIR = "pkg5-quarantine"
 
+# The number of stale entries the file attribute index may accumulate
+# before it is rewritten, unless it has more current entries than this.
+FILE_ATTRS_MIN_STALE = 1000
+
 REPO_VERIFY_BADHASH = 0
 REPO_VERIFY_BADMANIFEST = 1
 REPO_VERIFY_BADGZIP = 2
@@ -86,6 +96,12 @@ REPO_VERIFY_UNKNOWN = 99
 REPO_FIX_ITEM = 0
 REPO_FIX_FAILED = 1
 
+# The maximum number of queries whose results are cached by each repository
+# store, and the maximum number of results a query may return for them to be
+# cached.
+SEARCH_CACHE_SIZE = 64
+SEARCH_CACHE_MAX_RESULTS = 10000
+
 VERIFY_DEPENDENCY = "dependency"
 verify_default_checks = frozenset([
       VERIFY_DEPENDENCY,
@@ -374,6 +390,55 @@ class RepositorySigNoTrustAnchorDirError(RepositoryError):
                 return _("Unable to find trust anchor directory {0}").format(
                     self.data)
 
+
+def _load_catalog_manifest(args):
+        """Load the manifest of the package with the FMRI string 'pfmri' from
+        'mpath' and return what is needed to add the package to a catalog: a
+        tuple of the manifest's signatures and the string form of its depend
+        and set actions, in manifest order.  If the manifest is invalid, a
+        string describing the error is returned instead.  This is run in a
+        separate process during parallel rebuilds, so it only deals in objects
+        that can be pickled."""
+
+        mpath, pfmri = args
+        m = pkg.manifest.Manifest(fmri.PkgFmri(pfmri))
+        try:
+                m.set_content(pathname=mpath, signatures=True)
+        except EnvironmentError as e:
+                if e.errno == errno.ENOENT:
+                        raise RepositoryManifestNotFoundError(e.filename)
+                raise
+        except (apx.InvalidPackageErrors, actions.ActionError,
+            fmri.FmriError, pkg.version.VersionError) as e:
+                return str(e)
+
+        return m.signatures, [
+            str(a)
+            for atype in ("depend", "set")
+            for a in m.gen_actions_by_type(atype)
+        ]
+
+
+# Building the query lexer and parser is expensive, so a single instance is
+# shared; it is built when first needed.  The parser isn't reentrant, so its
+# use is serialized.
+_query_parser = None
+_query_parser_lock = threading.Lock()
+
+def _parse_query(text):
+        """Parse the query string 'text' into an AST of server query
+        objects."""
+
+        global _query_parser
+
+        with _query_parser_lock:
+                if not _query_parser:
+                        l = sqp.QueryLexer()
+                        l.build()
+                        _query_parser = sqp.QueryParser(l)
+                return _query_parser.parse(text)
+
+
 class _RepoStore(object):
         """The _RepoStore object provides an interface for performing operations
         on a set of package data contained within a repository.  This class is
@@ -388,6 +453,24 @@ class _RepoStore(object):
 
                 self.__catalog = None
                 self.__catalog_root = None
+                # The compressed size and hashes of stored files, keyed by
+                # file hash; loaded when first needed.
+                self.__file_attrs = None
+                self.__file_attrs_lock = pkg.nrlock.NRLock()
+                self.__file_attrs_path = None
+                # The number of entries in the on-disk file attribute index
+                # that have been superseded by later ones.
+                self.__file_attrs_stale = 0
+                self.__verify_ledger_path = None
+                # The results of recent queries, keyed by query string, in
+                # least to most recently used order, and the state of the
+                # index and catalog they were computed from.
+                self.__search_cache = collections.OrderedDict()
+                self.__search_cache_lock = pkg.nrlock.NRLock()
+                self.__search_cache_sig = None
+                # Incremented whenever the catalog or publisher configuration
+                # changes.
+                self.__generation = 0
                 # FileManager supports multiple layouts, but realistically, it
                 # is desirable to only support one per repository format
                 # version.
@@ -532,6 +615,7 @@ class _RepoStore(object):
                 """Destroy the catalog."""
 
                 self.__catalog = None
+                self.__generation += 1
                 if self.catalog_root and os.path.exists(self.catalog_root):
                         shutil.rmtree(self.catalog_root)
 
@@ -707,6 +791,134 @@ class _RepoStore(object):
                         self.log_obj.log(msg=msg, context=context,
                             severity=severity)
 
+        def __file_attrs_writable(self):
+                """Returns whether the file attribute index can be saved."""
+
+                return bool(self.__file_attrs_path and
+                    (not self.read_only or self.writable_root))
+
+        def __load_file_attrs(self):
+                """Load the file attribute index if it hasn't been already;
+                caller responsible for holding the file attribute lock.
+
+                The index is a text file with one entry per line; each entry
+                is either 'hash size mtime csize attr=value ...', recording
+                the on-disk size and modification time, compressed size, and
+                compressed hashes of a file, or 'hash -', recording that the
+                file's attributes are no longer known.  Later entries take
+                precedence."""
+
+                if self.__file_attrs is not None:
+                        return self.__file_attrs
+
+                attrs = {}
+                self.__file_attrs = attrs
+                self.__file_attrs_stale = 0
+                if not self.__file_attrs_path:
+                        return attrs
+                nentries = 0
+                try:
+                        with open(self.__file_attrs_path, "r") as f:
+                                for l in f:
+                                        nentries += 1
+                                        fields = l.split()
+                                        if len(fields) == 2 and \
+                                            fields[1] == "-":
+                                                attrs.pop(fields[0], None)
+                                                continue
+                                        try:
+                                                attrs[fields[0]] = (
+                                                    int(fields[1]),
+                                                    int(fields[2]), fields[3],
+                                                    dict(
+                                                    a.split("=", 1)
+                                                    for a in fields[4:]))
+                                        except (IndexError, ValueError):
+                                                # Ignore partial or damaged
+                                                # entries; the attributes
+                                                # will be computed again.
+                                                pass
+                        self.__file_attrs_stale = nentries - len(attrs)
+                except EnvironmentError as e:
+                        if e.errno != errno.ENOENT:
+                                self.__log(_("Unable to read file attribute "
+                                    "index {path}: {err}").format(
+                                    path=self.__file_attrs_path, err=e),
+                                    severity=logging.WARNING)
+                return attrs
+
+        def __append_file_attrs(self, lines, stale=0):
+                """Append the given entries to the on-disk file attribute
+                index, if it can be written; caller responsible for holding
+                the file attribute lock.  'stale' is the number of entries
+                in the index that the new ones supersede.  Once more than
+                half of the index is stale, it is rewritten with only the
+                current entries."""
+
+                if not lines or not self.__file_attrs_writable():
+                        return
+                self.__file_attrs_stale += stale
+                try:
+                        if self.__file_attrs_stale > max(FILE_ATTRS_MIN_STALE,
+                            len(self.__file_attrs)):
+                                self.__write_file_attrs(self.__file_attrs)
+                                return
+                        with open(self.__file_attrs_path, "a") as f:
+                                f.write("".join(lines))
+                except EnvironmentError as e:
+                        # The index is only an optimisation; the attributes
+                        # will be computed again when needed.
+                        self.__log(_("Unable to update file attribute "
+                            "index {path}: {err}").format(
+                            path=self.__file_attrs_path, err=e),
+                            severity=logging.WARNING)
+
+        def __write_file_attrs(self, attrs):
+                """Replace the on-disk file attribute index with the entries
+                in 'attrs' and use them from now on; caller responsible for
+                holding the file attribute lock."""
+
+                # Replace the index as a whole so that consumers never see
+                # a partial one.
+                tmp_path = self.__file_attrs_path + ".new"
+                with open(tmp_path, "w") as f:
+                        f.write("".join(
+                            self.__fmt_file_attrs(fhash, *entry)
+                            for fhash, entry in six.iteritems(attrs)
+                        ))
+                portable.rename(tmp_path, self.__file_attrs_path)
+                self.__file_attrs = attrs
+                self.__file_attrs_stale = 0
+
+        @staticmethod
+        def __fmt_file_attrs(fhash, size, mtime, csize, chashes):
+                return "{0} {1} {2} {3} {4}\n".format(fhash, size, mtime,
+                    csize, " ".join(
+                        "{0}={1}".format(a, v)
+                        for a, v in sorted(chashes.items())
+                    ))
+
+        @staticmethod
+        def __file_attrs_stat(st):
+                """Returns the (size, mtime) of a file as recorded in the file
+                attribute index, given the result of stat() on it."""
+
+                return st.st_size, int(st.st_mtime)
+
+        def __forget_file_attrs(self, hashes):
+                """Discard the recorded attributes of the named files."""
+
+                with self.__file_attrs_lock:
+                        attrs = self.__load_file_attrs()
+                        lines = [
+                            "{0} -\n".format(h)
+                            for h in hashes
+                            if attrs.pop(h, None) is not None
+                        ]
+                        # Both the forgotten entries and the entries that
+                        # forget them are stale.
+                        self.__append_file_attrs(lines, stale=2 * len(lines))
+
         def __purge_search_index(self):
                 """Private helper function to dump repository search data."""
 
@@ -745,10 +957,79 @@ class _RepoStore(object):
                 # Discard in-memory search data.
                 self.reset_search()
 
+        def __gen_rebuild_manifests(self, jobs=1):
+                """Generate a tuple of (pathname, pfmri, manifest) for each
+                package manifest in the repository, in the order found.
+                'pfmri' is the FMRI derived from the manifest's pathname, or
+                the error raised while deriving it.  If 'jobs' is greater
+                than one, the manifests are loaded by that many processes and
+                'manifest' is a Manifest containing only the signatures and
+                actions needed for cataloging, or a string describing why
+                the manifest is invalid; otherwise 'manifest' is None and
+                callers must load it."""
+
+                paths = []
+                # XXX eschew os.walk in favor of another os.listdir here?
+                for pkgpath in os.walk(self.manifest_root):
+                        if pkgpath[0] == self.manifest_root:
+                                continue
+                        for fname in os.listdir(pkgpath[0]):
+                                paths.append((pkgpath[0], fname))
+
+                def gen_fmris():
+                        for pkgdir, fname in paths:
+                                name = os.path.join(pkgdir, fname)
+                                try:
+                                        yield name, self.__fmri_from_path(
+                                            pkgdir, fname)
+                                except (fmri.FmriError,
+                                    pkg.version.VersionError) as e:
+                                        yield name, e
+
+                if jobs <= 1 or len(paths) <= 1:
+                        for name, f in gen_fmris():
+                                if isinstance(f, Exception):
+                                        yield name, None, str(f)
+                                else:
+                                        yield name, f, None
+                        return
+
+                pfmris = list(gen_fmris())
+                pool = multiprocessing.Pool(processes=jobs)
+                try:
+                        # Results are returned in the order the manifests
+                        # were found so that the catalog is built exactly as
+                        # it would be by a single process.
+                        results = pool.imap(_load_catalog_manifest, (
+                            (name, str(f))
+                            for name, f in pfmris
+                            if not isinstance(f, Exception)
+                        ), chunksize=max(1, min(64, len(paths) // (jobs * 4))))
+                        for name, f in pfmris:
+                                if isinstance(f, Exception):
+                                        yield name, None, str(f)
+                                        continue
+                                res = next(results)
+                                if isinstance(res, six.string_types):
+                                        yield name, f, res
+                                        continue
+                                sigs, lines = res
+                                m = pkg.manifest.Manifest(f)
+                                m.set_content(content="\n".join(lines))
+                                m.signatures = sigs
+                                yield name, f, m
+                        pool.close()
+                finally:
+                        pool.terminate()
+                        pool.join()
+
         def __rebuild(self, build_catalog=True, build_index=False, lm=None,
-            incremental=False):
+            incremental=False, jobs=1):
                 """Private version; caller responsible for repository
-                locking."""
+                locking.
+
+                'jobs' is the number of processes to use to load package
+                manifests when building the catalog."""
 
                 if not (build_catalog or build_index) or not self.manifest_root:
                         # Nothing to do.
@@ -771,8 +1052,7 @@ class _RepoStore(object):
                         # rebuild.
                         self.catalog.log_updates = incremental
 
-                        def add_package(f):
-                                m = self._get_manifest(f, sig=True)
+                        def add_package(f, m):
                                 if "pkg.fmri" in m:
                                         f = fmri.PkgFmri(m["pkg.fmri"])
                                 if default_pub and not f.publisher:
@@ -780,35 +1060,32 @@ class _RepoStore(object):
                                 self.__add_package(f, manifest=m)
                                 self.__log(str(f))
 
-                        # XXX eschew os.walk in favor of another os.listdir
-                        # here?
-                        for pkgpath in os.walk(self.manifest_root):
-                                if pkgpath[0] == self.manifest_root:
-                                        continue
+                        def skip_package(name, e):
+                                # Don't add packages with corrupt manifests to
+                                # the catalog.
+                                self.__log(_("Skipping {name}; invalid "
+                                    "manifest: {error}").format(name=name,
+                                    error=e))
 
-                                for fname in os.listdir(pkgpath[0]):
-                                        try:
-                                                f = self.__fmri_from_path(
-                                                    pkgpath[0], fname)
-                                                add_package(f)
-                                        except (apx.InvalidPackageErrors,
-                                            actions.ActionError,
-                                            fmri.FmriError,
-                                            pkg.version.VersionError) as e:
-                                                # Don't add packages with
-                                                # corrupt manifests to the
-                                                # catalog.
-                                                name = os.path.join(pkgpath[0],
-                                                    fname)
-                                                self.__log(_("Skipping "
-                                                    "{name}; invalid "
-                                                    "manifest: {error}").format(
-                                                    name=name, error=e))
-                                        except apx.DuplicateCatalogEntry as e:
-                                                # Raise dups if not in
-                                                # incremental mode.
-                                                if not incremental:
-                                                        raise
+                        for name, f, m in self.__gen_rebuild_manifests(jobs):
+                                try:
+                                        if isinstance(m, six.string_types):
+                                                skip_package(name, m)
+                                                continue
+                                        if m is None:
+                                                m = self._get_manifest(f,
+                                                    sig=True)
+                                        add_package(f, m)
+                                except (apx.InvalidPackageErrors,
+                                    actions.ActionError,
+                                    fmri.FmriError,
+                                    pkg.version.VersionError) as e:
+                                        skip_package(name, e)
+                                except apx.DuplicateCatalogEntry as e:
+                                        # Raise dups if not in incremental
+                                        # mode.
+                                        if not incremental:
+                                                raise
 
                         # Private add_package doesn't automatically save catalog
                         # so that operations can be batched (there is
@@ -866,6 +1143,7 @@ class _RepoStore(object):
                 # Discard current catalog information (it will be re-loaded
                 # when needed).
                 self.__catalog = None
+                self.__generation += 1
 
                 # Determine location and version of catalog data.
                 self.__init_catalog(allow_invalid=allow_invalid)
@@ -1015,6 +1293,7 @@ class _RepoStore(object):
                 if lm:
                         self.catalog.last_modified = lm
                 self.catalog.save()
+                self.__generation += 1
 
                 orig_cat_root = None
                 if os.path.exists(old_cat_root):
@@ -1073,14 +1352,26 @@ class _RepoStore(object):
                         root = os.path.abspath(root)
                         self.__tmp_root = os.path.join(root, "tmp")
                         self.index_root = os.path.join(root, "index")
+                        self.__file_attrs_path = os.path.join(root,
+                            "file_attrs")
+                        self.__verify_ledger_path = os.path.join(root,
+                            "verify_ledger")
                 elif self.root:
                         self.__tmp_root = os.path.join(self.root, "tmp")
                         self.index_root = os.path.join(self.root,
                             "index")
+                        self.__file_attrs_path = os.path.join(self.root,
+                            "file_attrs")
+                        self.__verify_ledger_path = os.path.join(self.root,
+                            "verify_ledger")
                 else:
                         self.__tmp_root = None
                         self.index_root = None
+                        self.__file_attrs_path = None
+                        self.__verify_ledger_path = None
                 self.__writable_root = root
+                self.__file_attrs = None
+                self.__file_attrs_stale = 0
 
         def __unlock_rstore(self):
                 """Unlocks the repository so other consumers may modify it."""
@@ -1103,6 +1394,7 @@ class _RepoStore(object):
                             log=self.__index_log,
                             sort_file_max_size=self.__sort_file_max_size)
                         index_inst.server_update_index(fmris)
+                        self.__clear_search_cache()
                         if not self.__search_available:
                                 self.__index_log("Search Available")
                         self.__search_available = True
@@ -1283,6 +1575,7 @@ class _RepoStore(object):
                 """Discards currenty loaded search data so that it will be
                 reloaded the next a search is performed.
                 """
+                self.__clear_search_cache()
                 if not self.index_root:
                         # Nothing to do.
                         return
@@ -1322,6 +1615,9 @@ class _RepoStore(object):
                 if fhash is None:
                         raise RepositoryFileNotFoundError(fhash)
 
+                # The content may be compressed differently than what was
+                # there before.
+                self.__forget_file_attrs([fhash])
                 fp = self.cache_store.insert(fhash, src_path)
                 if fp is not None:
                         return fp
@@ -1337,6 +1633,7 @@ class _RepoStore(object):
                 if fhash is None:
                         raise RepositoryFileNotFoundError(fhash)
 
+                self.__forget_file_attrs([fhash])
                 fp = self.cache_store.copy(fhash, src_path)
                 if fp is not None:
                         return fp
@@ -1361,6 +1658,104 @@ class _RepoStore(object):
                         return fp
                 raise RepositoryFileNotFoundError(fhash)
 
+        def file_attrs(self, fhash):
+                """Returns a tuple of (pathname, csize, chashes) for the file
+                specified by the provided SHA-n hash name, where 'csize' is
+                the size of the compressed file as a string and 'chashes' is
+                a dictionary of the compressed hash attributes of the file.
+
+                The attributes are served from the repository's file
+                attribute index and are only computed, and then recorded,
+                if the index doesn't have them for the file as it is now."""
+
+                fpath = self.file(fhash)
+                try:
+                        st = os.stat(fpath)
+                except EnvironmentError as e:
+                        if e.errno == errno.ENOENT:
+                                raise RepositoryFileNotFoundError(fhash)
+                        raise apx._convert_error(e)
+
+                with self.__file_attrs_lock:
+                        entry = self.__load_file_attrs().get(fhash)
+                if entry and entry[:2] == self.__file_attrs_stat(st):
+                        return fpath, entry[2], dict(entry[3])
+
+                csize, chashes = misc.compute_compressed_attrs(fhash,
+                    file_path=fpath)
+                # Record the file as it was before its attributes were
+                # computed, so that any change made meanwhile is noticed.
+                self.__record_file_attrs(fhash, st, csize, chashes)
+                return fpath, csize, chashes
+
+        def record_file_attrs(self, fhash, csize, chashes, path=None):
+                """Record the compressed size and hash attributes of the file
+                specified by the provided SHA-n hash name in the file
+                attribute index.  'path' is the location of the file as it
+                will be stored in the repository, if it isn't there yet."""
+
+                try:
+                        st = os.stat(path or self.file(fhash))
+                except (EnvironmentError, RepositoryError):
+                        # The attributes will be computed when needed.
+                        return
+                self.__record_file_attrs(fhash, st, csize, chashes)
+
+        def __record_file_attrs(self, fhash, st, csize, chashes):
+                """Record the attributes of the file specified by the provided
+                SHA-n hash name, where 'st' is the result of stat() on it."""
+
+                size, mtime = self.__file_attrs_stat(st)
+                with self.__file_attrs_lock:
+                        attrs = self.__load_file_attrs()
+                        entry = (size, mtime, csize, dict(chashes))
+                        old = attrs.get(fhash)
+                        if old == entry:
+                                return
+                        attrs[fhash] = entry
+                        self.__append_file_attrs([self.__fmt_file_attrs(
+                            fhash, *entry)], stale=int(old is not None))
+
+        def rebuild_file_attrs(self):
+                """Discard the file attribute index and compute the
+                attributes of every file in the repository again."""
+
+                if self.read_only and not self.writable_root:
+                        raise RepositoryReadOnlyError()
+                if not self.file_root or not self.__file_attrs_path:
+                        raise RepositoryUnsupportedOperationError()
+
+                # The files are read without the repository locked, as that
+                # can take a long time; entries for files that change
+                # meanwhile won't match them and are ignored.
+                attrs = {}
+                for fhash in self.cache_store.walk():
+                        fpath = self.cache_store.lookup(fhash)
+                        if not fpath:
+                                continue
+                        try:
+                                st = os.stat(fpath)
+                                csize, chashes = \
+                                    misc.compute_compressed_attrs(fhash,
+                                    file_path=fpath)
+                        except EnvironmentError as e:
+                                if e.errno == errno.ENOENT:
+                                        # Removed meanwhile.
+                                        continue
+                                raise apx._convert_error(e)
+                        attrs[fhash] = self.__file_attrs_stat(st) + \
+                            (csize, chashes)
+
+                self.__lock_rstore()
+                try:
+                        with self.__file_attrs_lock:
+                                try:
+                                        self.__write_file_attrs(attrs)
+                                except EnvironmentError as e:
+                                        raise apx._convert_error(e)
+                finally:
+                        self.__unlock_rstore()
+
         def get_publisher(self):
                 """Return the Publisher object for this storage object or None
                 if not available.
@@ -1582,6 +1977,7 @@ class _RepoStore(object):
                                 # package had to be removed from it.
                                 c.finalize(pfmris=packages)
                                 c.save()
+                                self.__generation += 1
 
                         progtrack.job_done(progtrack.JOB_REPO_UPDATE_CAT)
 
@@ -1694,6 +2090,7 @@ class _RepoStore(object):
                                         portable.remove(fpath)
                                         progtrack.job_add_progress(
                                             progtrack.JOB_REPO_RM_FILES)
+                        self.__forget_file_attrs(pfiles)
                         progtrack.job_done(progtrack.JOB_REPO_RM_FILES)
 
                         # Finally, tidy up repository structure by discarding
@@ -1730,7 +2127,7 @@ class _RepoStore(object):
                         c.batch_mode = False
                         self.__unlock_rstore()
 
-        def rebuild(self, build_catalog=True, build_index=False):
+        def rebuild(self, build_catalog=True, build_index=False, jobs=1):
                 """Rebuilds the repository catalog and search indexes using the
                 package manifests currently in the repository.
 
@@ -1740,6 +2137,10 @@ class _RepoStore(object):
 
                 'build_index' is an optional boolean value indicating whether
                 search indexes should be built.
+
+                'jobs' is an optional integer value indicating how many
+                processes should be used to load package manifests when
+                rebuilding package catalogs.
                 """
 
                 if self.mirror:
@@ -1752,7 +2153,7 @@ class _RepoStore(object):
                 self.__lock_rstore()
                 try:
                         self.__rebuild(build_catalog=build_catalog,
-                            build_index=build_index)
+                            build_index=build_index, jobs=jobs)
                 finally:
                         self.__unlock_rstore()
 
@@ -1803,10 +2204,13 @@ class _RepoStore(object):
 
                 def _search(q):
                         assert self.index_root
-                        l = sqp.QueryLexer()
-                        l.build()
-                        qqp = sqp.QueryParser(l)
-                        query = qqp.parse(q.text)
+                        key = str(q)
+                        sig = self.__get_search_cache_sig()
+                        res = self.__get_cached_search(key, sig)
+                        if res is not None:
+                                return iter(res)
+
+                        query = _parse_query(q.text)
                         query.set_info(num_to_return=q.num_to_return,
                             start_point=q.start_point,
                             index_dir=self.index_root,
@@ -1814,7 +2218,16 @@ class _RepoStore(object):
                             case_sensitive=q.case_sensitive)
                         if q.return_type == sqp.Query.RETURN_PACKAGES:
                                 query.propagate_pkg_return()
-                        return query.search(self.catalog.fmris)
+                        it = query.search(self.catalog.fmris)
+
+                        # Only cache results small enough to be kept in
+                        # memory; larger ones are returned as they are found.
+                        res = list(itertools.islice(it,
+                            SEARCH_CACHE_MAX_RESULTS + 1))
+                        if len(res) > SEARCH_CACHE_MAX_RESULTS:
+                                return itertools.chain(res, it)
+                        self.__cache_search(key, sig, res)
+                        return iter(res)
 
                 query_lst = []
                 try:
@@ -1828,6 +2241,60 @@ class _RepoStore(object):
                         raise RepositoryError(e)
                 return [_search(q) for q in query_lst]
 
+        def __get_search_cache_sig(self):
+                """Returns an object describing the current state of the
+                search index and catalog; cached query results are only valid
+                while it remains the same.  This allows changes made by other
+                processes to be noticed."""
+
+                sig = [self.catalog.last_modified]
+                for name in (ss.MAIN_FILE, ss.FAST_ADD, ss.FAST_REMOVE,
+                    ss.FULL_FMRI_FILE):
+                        try:
+                                st = os.stat(os.path.join(self.index_root,
+                                    name))
+                                sig.append((st.st_ino, st.st_size,
+                                    st.st_mtime))
+                        except EnvironmentError:
+                                sig.append(None)
+                return tuple(sig)
+
+        def __get_cached_search(self, key, sig):
+                """Returns the cached list of results for the query string
+                'key' if they were computed when the index and catalog were
+                in the state described by 'sig', or None."""
+
+                with self.__search_cache_lock:
+                        if sig != self.__search_cache_sig:
+                                self.__search_cache.clear()
+                                self.__search_cache_sig = sig
+                                return None
+                        res = self.__search_cache.pop(key, None)
+                        if res is not None:
+                                # Mark as most recently used.
+                                self.__search_cache[key] = res
+                        return res
+
+        def __cache_search(self, key, sig, res):
+                """Cache the list of results 'res' for the query string 'key'
+                computed when the index and catalog were in the state described
+                by 'sig'."""
+
+                with self.__search_cache_lock:
+                        if sig != self.__search_cache_sig:
+                                # The index changed while searching.
+                                return
+                        self.__search_cache[key] = res
+                        while len(self.__search_cache) > SEARCH_CACHE_SIZE:
+                                self.__search_cache.popitem(last=False)
+
+        def __clear_search_cache(self):
+                """Discard all cached query results."""
+
+                with self.__search_cache_lock:
+                        self.__search_cache.clear()
+                        self.__search_cache_sig = None
+
         @property
         def search_available(self):
                 return (self.__search_available and self.index_root and
@@ -1881,6 +2348,7 @@ class _RepoStore(object):
                                 with open(fd, "w", encoding="utf-8") as fp:
                                         p5i.write(fp, [pub])
                         portable.rename(fn, p5ipath)
+                        self.__generation += 1
                 except EnvironmentError as e:
                         if e.errno == errno.EACCES:
                                 raise apx.PermissionsException(e.filename)
@@ -2188,10 +2656,107 @@ class _RepoStore(object):
                                         return False, pth
                 return True, None
 
+        def __load_verify_ledger(self):
+                """Returns a dictionary of the files whose content was found
+                to match a hash by a previous verification, keyed by tuples of
+                (file name, hash value), with values of the (size, mtime,
+                inode) of the file when it was verified."""
+
+                ledger = {}
+                if not self.__verify_ledger_path:
+                        return ledger
+                try:
+                        with open(self.__verify_ledger_path, "r") as f:
+                                for l in f:
+                                        try:
+                                                fname, h, size, mtime, ino = \
+                                                    l.split()
+                                                ledger[(fname, h)] = (
+                                                    int(size), float(mtime),
+                                                    int(ino))
+                                        except ValueError:
+                                                # Ignore damaged entries; the
+                                                # files will be hashed again.
+                                                pass
+                except EnvironmentError as e:
+                        if e.errno != errno.ENOENT:
+                                raise apx._convert_error(e)
+                return ledger
+
+        def __save_verify_ledger(self, ledger):
+                """Replace the on-disk verification ledger with 'ledger', if
+                the repository can be written to."""
+
+                if not self.__verify_ledger_path or \
+                    (self.read_only and not self.writable_root):
+                        return
+
+                tmp_path = self.__verify_ledger_path + ".new"
+                try:
+                        with open(tmp_path, "w") as f:
+                                for (fname, h), (size, mtime, ino) in \
+                                    sorted(ledger.items()):
+                                        f.write("{0} {1} {2:d} {3!r} "
+                                            "{4:d}\n".format(fname, h, size,
+                                            mtime, ino))
+                        portable.rename(tmp_path, self.__verify_ledger_path)
+                except EnvironmentError as e:
+                        # The ledger only saves work; the next verification
+                        # will hash the files again.
+                        self.__log(_("Unable to save verification ledger "
+                            "{path}: {err}").format(
+                            path=self.__verify_ledger_path, err=e),
+                            severity=logging.WARNING)
+
+        def __verify_file(self, pfmri, fname, h, alg, ledger, full):
+                """Verify the file named 'fname' delivered by 'pfmri' against
+                the hash 'h' computed using 'alg'.  Returns a tuple of (error,
+                entry) where 'error' is None if the file is valid, and 'entry'
+                is the ledger entry to record for it, if any.  Unless 'full'
+                is True, the file isn't hashed if 'ledger' shows it was
+                already verified and it hasn't changed since."""
+
+                try:
+                        path = self.cache_store.lookup(fname,
+                             check_existence=False)
+                except apx.PermissionsException as e:
+                        # if we can't even get the path within the
+                        # repository, then we'll do the best we can to
+                        # report the problem.
+                        return (REPO_VERIFY_PERM, pfmri, {"hash": fname,
+                            "err": _("Permission denied.", "path", h)}), None
+
+                err = self.__verify_perm(path, pfmri, h)
+                if err:
+                        # For backward compatibility, store the SHA1 file name
+                        # for file retrieval.
+                        err[2]["fname"] = fname
+                        return err, None
+
+                try:
+                        st = os.stat(path)
+                        entry = (st.st_size, st.st_mtime, st.st_ino)
+                except EnvironmentError:
+                        # Let the hash verification report the problem.
+                        entry = None
+                if not full and entry and ledger.get((fname, h)) == entry:
+                        return None, entry
+
+                err = self.__verify_hash(path, pfmri, h, alg=alg)
+                if err:
+                        err[2]["fname"] = fname
+                        return err, None
+                return None, entry
+
         def __gen_verify(self, progtrack, pub, trust_anchors,
-            sig_required_names, use_crls):
+            sig_required_names, use_crls, full=False, jobs=1):
                 """A generator that produces verify errors, each a tuple
-                of the form (error_code, path, message, details)"""
+                of the form (error_code, path, message, details)
+
+                Files that a previous verification found to be valid, and
+                that haven't changed since, aren't hashed again unless 'full'
+                is True.  If 'jobs' is greater than one, files are hashed by
+                that many threads."""
                 # We may not have a manifest_root directory if no
                 # packages have ever been published for this publisher.
                 if not os.path.exists(self.manifest_root):
@@ -2238,25 +2803,104 @@ class _RepoStore(object):
                             {"permissionspath": path, "pub": pub.prefix})
                 progtrack.repo_verify_end_pkg(None)
 
+                ledger = self.__load_verify_ledger()
+                # The ledger entries confirmed by this verification.
+                confirmed = {}
+                pool = None
+                if jobs > 1:
+                        pool = multiprocessing.pool.ThreadPool(jobs)
+
+                # Packages whose files are being verified, in the order they
+                # are reported; each is a tuple of (pfmri, progress, errors,
+                # file results, end_pfmri).  If 'progress' is False, the
+                # entry only holds errors and isn't reported as a package.
+                pending = collections.deque()
+
+                def report(entry):
+                        pfmri, progress, errors, results, end_pfmri = entry
+                        if progress:
+                                progtrack.repo_verify_start_pkg(pfmri)
+                                if progress == "unknown":
+                                        progtrack.repo_verify_add_progress(
+                                            None)
+                        for err in errors:
+                                yield self.__build_verify_error(*err)
+                        if results is not None:
+                                files, results = results
+                                if pool:
+                                        results = results.get()
+                                for (fname, h, alg), (err, lentry) in zip(
+                                    files, results):
+                                        if err:
+                                                yield \
+                                                    self.__build_verify_error(
+                                                    *err)
+                                                ledger.pop((fname, h), None)
+                                        elif lentry:
+                                                confirmed[(fname, h)] = lentry
+                                                ledger[(fname, h)] = lentry
+                        if progress:
+                                progtrack.repo_verify_end_pkg(end_pfmri)
+
+                def queue(entry):
+                        pending.append(entry)
+                        # Keep enough packages in flight for every thread to
+                        # have work, but report the rest in order as soon as
+                        # possible.
+                        while len(pending) > (jobs * 4 if pool else 0):
+                                for err in report(pending.popleft()):
+                                        yield err
+
+                completed = False
+                try:
+                        for err in self.__gen_verify_pkgs(mflist, pub,
+                            trust_anchors, sig_required_names, use_crls,
+                            pool, ledger, full, queue):
+                                yield err
+                        while pending:
+                                for err in report(pending.popleft()):
+                                        yield err
+                        completed = True
+                finally:
+                        if pool:
+                                pool.terminate()
+                                pool.join()
+                        # Only keep entries for files that are still in the
+                        # repository if all of them were verified; otherwise
+                        # keep what has been learned so far so that an
+                        # interrupted verification can be resumed.
+                        self.__save_verify_ledger(
+                            confirmed if completed else ledger)
+                progtrack.job_done(progtrack.JOB_REPO_VERIFY_REPO)
+
+        def __gen_verify_pkgs(self, mflist, pub, trust_anchors,
+            sig_required_names, use_crls, pool, ledger, full, queue):
+                """Verify the manifests of the packages named in 'mflist' and
+                start verifying the files each delivers.  The results for
+                each package are passed to 'queue', a generator function,
+                which yields the verify errors that are ready to be
+                reported."""
+
                 for name in mflist:
                         pdir = os.path.join(self.manifest_root, name)
                         err = self.__verify_perm(pdir, None, None)
                         if err:
-                                yield self.__build_verify_error(*err)
+                                for verr in queue((None, False, [err], None,
+                                    None)):
+                                        yield verr
                                 continue
 
                         # Stem must be decoded before use.
                         try:
                                 pname = unquote(name)
-                        except Exception:
+                        except Exception as e:
                                 # Assume error is result of an
                                 # unexpected file in the directory. We
                                 # don't know the FMRI here, so use None.
-                                progtrack.repo_verify_start_pkg(None)
-                                progtrack.repo_verify_add_progress(None)
-                                yield self.__build_verify_error(
-                                    REPO_VERIFY_UNKNOWN, pdir, {"err": str(e)})
-                                progtrack.repo_verify_end_pkg(None)
+                                for verr in queue((None, "unknown",
+                                    [(REPO_VERIFY_UNKNOWN, pdir,
+                                    {"err": str(e)})], None, None)):
+                                        yield verr
                                 continue
 
                         for ver in os.listdir(pdir):
@@ -2276,78 +2920,63 @@ class _RepoStore(object):
                                         # Assume the error is result of an
                                         # unexpected file in the directory. We
                                         # don't know the FMRI here, so use None.
-                                        progtrack.repo_verify_start_pkg(None)
-                                        progtrack.repo_verify_add_progress(None)
-                                        yield self.__build_verify_error(
-                                            REPO_VERIFY_UNKNOWN, path,
-                                            {"err": str(e)})
-                                        progtrack.repo_verify_end_pkg(None)
+                                        for verr in queue((None, "unknown",
+                                            [(REPO_VERIFY_UNKNOWN, path,
+                                            {"err": str(e)})], None, None)):
+                                                yield verr
                                         continue
 
-                                progtrack.repo_verify_start_pkg(pfmri)
                                 err = self.__verify_manifest(path, pfmri)
                                 if err:
                                         # with a bad manifest, we can go no
                                         # further
-                                        yield self.__build_verify_error(*err)
-                                        progtrack.repo_verify_end_pkg(None)
+                                        for verr in queue((pfmri, True, [err],
+                                            None, None)):
+                                                yield verr
                                         continue
 
                                 hashes, errors = self.__get_hashes(path, pfmri)
-                                for err in errors:
-                                        yield self.__build_verify_error(*err)
 
                                 # verify manifest signatures
-                                errs = self.__verify_signature(path, pfmri, pub,
-                                    trust_anchors, sig_required_names, use_crls)
-                                for err in errs:
-                                        yield self.__build_verify_error(*err)
+                                errors.extend(self.__verify_signature(path,
+                                    pfmri, pub, trust_anchors,
+                                    sig_required_names, use_crls))
 
                                 # verify payload delivered by this pkg
-                                errors = []
-                                for fname, h, alg in hashes:
-                                        try:
-                                                path = self.cache_store.lookup(
-                                                     fname,
-                                                     check_existence=False)
-                                        except apx.PermissionsException as e:
-                                                # if we can't even get the path
-                                                # within the repository, then
-                                                # we'll do the best we can to
-                                                # report the problem.
-                                                errors.append((REPO_VERIFY_PERM,
-                                                    pfmri, {"hash": fname,
-                                                    "err": _("Permission "
-                                                    "denied.", "path", h)}))
-                                                continue
-
-                                        err = self.__verify_perm(path, pfmri, h)
-                                        if err:
-                                                # For backward compatibility,
-                                                # store the SHA1 file name for
-                                                # file retrieval.
-                                                err[2]["fname"] = fname
-                                                errors.append(err)
-                                                continue
-                                        err = self.__verify_hash(path, pfmri, h,
-                                            alg=alg)
-                                        if err:
-                                                err[2]["fname"] = fname
-                                                errors.append(err)
-                                for err in errors:
-                                        yield self.__build_verify_error(*err)
-
-                                progtrack.repo_verify_end_pkg(fmri)
-                progtrack.job_done(progtrack.JOB_REPO_VERIFY_REPO)
+                                files = sorted(hashes, key=lambda t: t[:2])
+                                args = [
+                                    (pfmri, fname, h, alg, ledger, full)
+                                    for fname, h, alg in files
+                                ]
+                                if pool:
+                                        results = pool.map_async(
+                                            lambda a: self.__verify_file(*a),
+                                            args)
+                                else:
+                                        results = [
+                                            self.__verify_file(*a)
+                                            for a in args
+                                        ]
+                                for verr in queue((pfmri, True, errors,
+                                    (files, results), pfmri)):
+                                        yield verr
 
         def verify(self, pub=None, progtrack=None,
-            trust_anchor_dir=None, sig_required_names=None, use_crls=False):
+            trust_anchor_dir=None, sig_required_names=None, use_crls=False,
+            full=False, jobs=1):
                 """A generator which verifies the contents of the repository
                 store, checking for several different types of errors.
                 No modifying operations may be performed until complete.
 
                 'progtrack' is an optional ProgressTracker object.
 
+                'full' is an optional boolean indicating whether all files
+                should be hashed, even those that were found to be valid by
+                a previous verification and haven't changed since.
+
+                'jobs' is an optional number of threads to use to verify
+                files.
+
                 'trust_anchor_dir' is set in the repository configuration and
                 corresponds to the image property of the same name.
 
@@ -2410,7 +3039,8 @@ class _RepoStore(object):
                 self.__lock_rstore()
                 try:
                         for err in self.__gen_verify(progtrack, pub,
-                            trust_anchors, sig_required_names, use_crls):
+                            trust_anchors, sig_required_names, use_crls,
+                            full=full, jobs=jobs):
                                 yield err
                 except (Exception, EnvironmentError) as e:
                         import traceback
@@ -2583,6 +3213,7 @@ class _RepoStore(object):
         catalog_root = property(lambda self: self.__catalog_root)
         file_layout = property(lambda self: self.__file_layout)
         file_root = property(lambda self: self.__file_root)
+        generation = property(lambda self: self.__generation)
         read_only = property(lambda self: self.__read_only, __set_read_only)
         root = property(lambda self: self.__root)
         writable_root = property(lambda self: self.__writable_root)
@@ -2625,6 +3256,7 @@ class Repository(object):
                 # Initialize.
                 self.__cfgpathname = cfgpathname
                 self.__cfg = None
+                self.__generation = 0
                 self.__mirror = mirror
                 self.__read_only = read_only
                 self.__rstores = None
@@ -2831,7 +3463,10 @@ class Repository(object):
             properties=misc.EmptyDict):
                 """Private helper function to initialize state."""
 
-                # Discard current repository storage state data.
+                # Discard current repository storage state data; their
+                # generations are retained so that the repository's never
+                # repeats.
+                self.__generation = self.generation + 1
                 self.__rstores = {}
 
                 # Determine format, configuration location, and validity.
@@ -2912,6 +3547,7 @@ class Repository(object):
                         return
 
                 # Save a new configuration (or refresh existing).
+                self.__generation += 1
                 try:
                         self.cfg.write()
                 except EnvironmentError as e:
@@ -2995,6 +3631,7 @@ class Repository(object):
 
                 # Create the new repository storage area.
                 rstore = self.__new_rstore(pub.prefix)
+                self.__generation += 1
 
                 if skip_config:
                         return
@@ -3053,6 +3690,7 @@ class Repository(object):
                                     e.filename)
                         raise
                 finally:
+                        self.__generation += 1
                         self.__unlock_repository()
 
                 nullf = open(os.devnull, "w")
@@ -3177,6 +3815,30 @@ class Repository(object):
                 # Not found in any repository store.
                 raise RepositoryFileNotFoundError(fhash)
 
+        def file_attrs(self, fhash, pub=None):
+                """Returns a tuple of (pathname, csize, chashes) for the file
+                specified by the provided SHA1-hash name; see
+                _RepoStore.file_attrs() for details.
+
+                'pub' is the prefix of the publisher the file belongs to.  If
+                not specified, every repository store will be tried.
+                """
+
+                self.inc_file()
+                if pub:
+                        rstore = self.get_pub_rstore(pub)
+                        return rstore.file_attrs(fhash)
+
+                for rstore in self.rstores:
+                        try:
+                                return rstore.file_attrs(fhash)
+                        except RepositoryFileNotFoundError:
+                                # Ignore and try next repository store.
+                                pass
+
+                # Not found in any repository store.
+                raise RepositoryFileNotFoundError(fhash)
+
         def get_catalog(self, pub=None):
                 """Return the catalog object for the given publisher.
 
@@ -3260,6 +3922,22 @@ class Repository(object):
                         raise RepositoryUnknownPublisher(pub)
                 return rstore.get_publisher()
 
+        @property
+        def generation(self):
+                """An integer that is incremented whenever the catalog or
+                publisher configuration of the repository changes.  It never
+                decreases for the life of the object, so it can be used to
+                determine whether data derived from the repository is still
+                current."""
+
+                gen = self.__generation
+                if self.__rstores:
+                        gen += sum(
+                            rstore.generation
+                            for rstore in list(self.rstores)
+                        )
+                return gen
+
         def get_status(self):
                 """Return a dictionary of status information about the
                 repository.
@@ -3588,7 +4266,8 @@ class Repository(object):
                 rstore = self.get_trans_rstore(trans_id)
                 return rstore.add_manifest(trans_id, data=data)
 
-        def rebuild(self, build_catalog=True, build_index=False, pub=None):
+        def rebuild(self, build_catalog=True, build_index=False, pub=None,
+            jobs=1):
                 """Rebuilds the repository catalog and search indexes using the
                 package manifests currently in the repository.
 
@@ -3598,6 +4277,10 @@ class Repository(object):
 
                 'build_index' is an optional boolean value indicating whether
                 search indexes should be built.
+
+                'jobs' is an optional integer value indicating how many
+                processes should be used to load package manifests when
+                rebuilding package catalogs.
                 """
 
                 for rstore in self.rstores:
@@ -3606,7 +4289,23 @@ class Repository(object):
                         if pub and rstore.publisher and rstore.publisher != pub:
                                 continue
                         rstore.rebuild(build_catalog=build_catalog,
-                            build_index=build_index)
+                            build_index=build_index, jobs=jobs)
+
+        def rebuild_file_attrs(self, pub=None):
+                """Rebuilds the index of the compressed size and hashes of
+                the files in the repository that is used to answer requests
+                for file attributes.
+
+                'pub' is the optional prefix of the publisher to rebuild the
+                index for; by default, it is rebuilt for all publishers.
+                """
+
+                for rstore in self.rstores:
+                        if not rstore.publisher:
+                                continue
+                        if pub and rstore.publisher != pub:
+                                continue
+                        rstore.rebuild_file_attrs()
 
         def reload(self):
                 """Reloads the repository state information."""
@@ -3677,12 +4376,20 @@ class Repository(object):
                 rstore.update_publisher(pub)
 
         def verify(self, pubs=[], allowed_checks=[],
-            force_dep_check=False, ignored_dep_files=[], progtrack=None):
+            force_dep_check=False, ignored_dep_files=[], progtrack=None,
+            full=False, jobs=1):
                 """A generator that verifies that repository content matches
                 expected state for all or specified publishers.
 
                 'progtrack' is an optional ProgressTracker object.
 
+                'full' is an optional boolean indicating whether all files
+                should be hashed, even those that were found to be valid by
+                a previous verification and haven't changed since.
+
+                'jobs' is an optional number of threads to use to verify
+                files.
+
                 'pubs' is an optional publisher list to limit the
                 operation to.
 
@@ -3722,7 +4429,7 @@ class Repository(object):
                         for verify_tuple in rstore.verify(progtrack=progtrack,
                             pub=pub, trust_anchor_dir=trust_anchor_dir,
                             sig_required_names=sig_required_names,
-                            use_crls=use_crls):
+                            use_crls=use_crls, full=full, jobs=jobs):
                                 yield verify_tuple
 
                 if VERIFY_DEPENDENCY in allowed_checks:
@@ -539,6 +539,8 @@ class Transaction(object):
 
                         csize, chashes = misc.compute_compressed_attrs(
                             fname, dst_path, data, size, self.dir)
+                        self.rstore.record_file_attrs(fname, csize, chashes,
+                            path=self.__stored_path(fname, dst_path))
                         for attr in chashes:
                                 action.attrs[attr] = chashes[attr]
                         action.attrs["pkg.csize"] = csize
@@ -656,13 +658,29 @@ class Transaction(object):
                                 raise
                         dst_path = None
 
-                misc.compute_compressed_attrs(fname, dst_path,
-                    data, size, self.dir,
+                csize, chashes = misc.compute_compressed_attrs(fname,
+                    dst_path, data, size, self.dir,
                     chash_attrs=digest.DEFAULT_CHASH_ATTRS,
                     chash_algs=digest.CHASH_ALGS)
+                # Record what was just computed so that requests for the
+                # file's attributes don't need to compute them again.
+                self.rstore.record_file_attrs(fname, csize, chashes,
+                    path=self.__stored_path(fname, dst_path))
 
                 self.remaining_payload_cnt -= 1
 
+        def __stored_path(self, fname, dst_path):
+                """Returns the path of the compressed file 'fname' that will
+                be stored in the repository once the transaction is closed:
+                either the one compute_compressed_attrs() wrote into the
+                transaction directory, or the one already stored at
+                'dst_path'."""
+
+                fpath = os.path.join(self.dir, fname)
+                if os.path.exists(fpath):
+                        return fpath
+                return dst_path
+
         def add_manifest(self, f):
                 """Adds the manifest to the Transaction."""
 
@@ -462,6 +462,96 @@ msat_add_clause(msat_solver *self, PyObject *args)
 	Py_RETURN_NONE;
 }
 
+/*ARGSUSED*/
+static PyObject *
+msat_add_clauses(msat_solver *self, PyObject *args)
+{
+	int *ls;
+	int *is;
+	int i;
+	int j;
+	int n;
+	int start;
+	PyObject *list;
+
+	if (self->msat_needs_reset)
+		RETURN_NEEDS_RESET;
+
+	if (!PyArg_ParseTuple(args, "O", &list))
+		return (NULL);
+
+	if (!PyList_Check(list))
+		RETURN_NEEDS_INTLIST;
+
+	/*
+	 * The clauses are given as a single list of integers in which each
+	 * clause is terminated by a zero.  Validate all of them before any
+	 * are added so that a bad list doesn't leave the solver with only
+	 * some of its clauses.
+	 */
+	n = PyList_Size(list);
+	if ((ls = (int *) malloc((n + 1) * sizeof (int))) == NULL) {
+		PyErr_NoMemory();
+		return (NULL);
+	}
+
+	for (i = 0; i < n; i++) {
+		long l;
+
+		if ((l = PyInt_AsLong(PyList_GetItem(list, i))) == -1 &&
+		    PyErr_Occurred()) {
+			free(ls);
+			RETURN_NEEDS_INTLIST;
+		}
+		if (l == 0 && (i == 0 || ls[i - 1] == 0)) {
+			/* empty clause */
+			free(ls);
+			RETURN_NEEDS_INTLIST;
+		}
+		ls[i] = l;
+	}
+
+	if (n > 0 && ls[n - 1] != 0) {
+		free(ls);
+		RETURN_NEEDS_INTLIST;
+	}
+
+	for (start = i = 0; i < n; i++) {
+		if (ls[i] != 0)
+			continue;
+
+		if ((is = (int *) alloc_refcntptr((i - start) *
+		    sizeof (int))) == NULL) {
+			free(ls);
+			PyErr_NoMemory();
+			return (NULL);
+		}
+
+		for (j = start; j < i; j++) {
+			int v = abs(ls[j]) - 1;
+			is[j - start] = (ls[j] > 0) ? toLit(v) : lit_neg(toLit(v));
+		}
+
+		con_addptr(self->msat_clauses, is);
+		if (!solver_addclause(self->msat_instance, is,
+		    &(is[i - start]))) {
+			/*
+			 * As for msat_add_clause(), the clauses can no longer
+			 * be satisfied, so the remainder needn't be added.
+			 */
+			self->msat_needs_reset = 1;
+			break;
+		}
+		start = i + 1;
+	}
+
+	free(ls);
+
+	if (self->msat_needs_reset)
+		Py_RETURN_FALSE;
+	Py_RETURN_TRUE;
+}
+
 static PyObject *
 msat_solve(msat_solver *self, PyObject *args, PyObject *keywds)
 {
@@ -485,6 +575,21 @@ msat_solve(msat_solver *self, PyObject *args, PyObject *keywds)
 		return (NULL);
 
 	if (n > 0) {
+		/*
+		 * Assumptions can only be made once any pending top-level
+		 * assignments have been propagated, but solver_addclause()
+		 * leaves the literals of unit clauses queued.  Propagate them
+		 * with solver_simplify(), which solver_search() would call
+		 * first at the top level anyway, so the outcome is unchanged;
+		 * a conflict found while doing so means the clauses can never
+		 * be satisfied.  Without assumptions, solver_solve() goes
+		 * straight to solver_search().
+		 */
+		if (!solver_simplify(self->msat_instance)) {
+			dec_refcntptr(as);
+			self->msat_needs_reset = 1;
+			Py_RETURN_FALSE;
+		}
 		as_top = &(as[n]);
 	} else {
 		dec_refcntptr(as);
@@ -499,10 +604,15 @@ msat_solve(msat_solver *self, PyObject *args, PyObject *keywds)
 
 	if (ret)
 		Py_RETURN_TRUE;
-	else {
+
+	/*
+	 * Failure to satisfy the clauses under a set of assumptions leaves
+	 * the clause database intact, so the solver may be used again with
+	 * different (or no) assumptions.
+	 */
+	if (n == 0)
 		self->msat_needs_reset = 1;
-		Py_RETURN_FALSE;
-	}
+	Py_RETURN_FALSE;
 }
 
 static PyObject *
@@ -522,6 +632,43 @@ msat_dereference(msat_solver *self, PyObject *args)
 	Py_RETURN_FALSE;
 }
 
+static PyObject *
+msat_get_solution(msat_solver *self, PyObject *args)
+{
+	int i;
+	int n;
+	int limit = -1;
+	PyObject *list;
+	PyObject *v;
+
+	if (self->msat_needs_reset)
+		RETURN_NEEDS_RESET;
+
+	if (!PyArg_ParseTuple(args, "|i", &limit))
+		return (NULL);
+
+	n = veci_size(&self->msat_instance->model);
+	if (limit >= 0 && limit < n)
+		n = limit;
+
+	if ((list = PyList_New(0)) == NULL)
+		return (NULL);
+
+	for (i = 0; i < n; i++) {
+		if (self->msat_instance->model.ptr[i] != l_True)
+			continue;
+		if ((v = Py_BuildValue("i", i + 1)) == NULL ||
+		    PyList_Append(list, v) != 0) {
+			Py_XDECREF(v);
+			Py_DECREF(list);
+			return (NULL);
+		}
+		Py_DECREF(v);
+	}
+
+	return (list);
+}
+
 /*
  * Should we provide enough Python to allow the use of a higher level function
  * to build clauses, or should we just leave that to the caller?
@@ -543,13 +690,23 @@ PyMethodDef msat_methods[] = {
 	{ "add_clause", (PyCFunction) msat_add_clause,
 		METH_VARARGS,
 		"Add another clause (as list of integers) to solution space"},
+	{ "add_clauses", (PyCFunction) msat_add_clauses,
+		METH_VARARGS,
+		"Add clauses (as a single list of integers in which each clause "
+		"is terminated by 0) to solution space"},
 	{ "solve", (PyCFunction) msat_solve,
 		METH_VARARGS | METH_KEYWORDS,
-		"Attempt to satisfy current clauses and assumptions."},
+		"Attempt to satisfy current clauses and assumptions (as list of "
+		"integers); the solver only needs to be reset after failure if "
+		"no assumptions were given."},
 	{ "dereference", (PyCFunction) msat_dereference,
 		METH_VARARGS,
 		"Retrieve literal value in solution, if available after solve "
 		"attempt."},
+	{ "get_solution", (PyCFunction) msat_get_solution,
+		METH_VARARGS,
+		"Retrieve list of variables (numbered from 1) that are true in "
+		"solution, optionally limited to the given number of variables."},
 	{ NULL, NULL, 0, NULL}
 };
 
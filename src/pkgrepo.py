@@ -166,11 +166,13 @@ Subcommands:
          [--key ssl_key ... --cert ssl_cert ...] [pkg_fmri_pattern ...]
 
      pkgrepo rebuild [-p publisher ...] -s repo_uri_or_path [--key ssl_key ...
-         --cert ssl_cert ...] [--no-catalog] [--no-index]
+         --cert ssl_cert ...] [--no-catalog] [--no-index] [--jobs n]
 
      pkgrepo refresh [-p publisher ...] -s repo_uri_or_path [--key ssl_key ...
          --cert ssl_cert ...] [--no-catalog] [--no-index]
 
+     pkgrepo rebuild-file-attrs [-p publisher ...] -s repo_uri_or_path
+
      pkgrepo remove [-n] [-p publisher ...] -s repo_uri_or_path
          pkg_fmri_pattern ...
 
@@ -179,7 +181,8 @@ Subcommands:
          section/property[+|-]=([value]) ...
 
      pkgrepo verify [-d] [-p publisher ...] [-i ignored_dep_file ...]
-         [--disable verification ...] -s repo_uri_or_path
+         [--disable verification ...] [--full] [--jobs n]
+         -s repo_uri_or_path
 
      pkgrepo fix [-v] [-p publisher ...] -s repo_uri_or_path
 
@@ -1180,7 +1183,8 @@ were found in the repository."""))
         return rval
 
 
-def __rebuild_local(subcommand, conf, pubs, build_catalog, build_index):
+def __rebuild_local(subcommand, conf, pubs, build_catalog, build_index,
+    jobs=1):
         """In an attempt to allow operations on potentially corrupt
         repositories, 'local' repositories (filesystem-basd ones) are handled
         separately."""
@@ -1205,7 +1209,7 @@ def __rebuild_local(subcommand, conf, pubs, build_catalog, build_index):
         logger.info("Initiating repository rebuild.")
         for pfx in found:
                 repo.rebuild(build_catalog=build_catalog,
-                    build_index=build_index, pub=pfx)
+                    build_index=build_index, pub=pfx, jobs=jobs)
 
         return rval
 
@@ -1243,9 +1247,10 @@ def subcmd_rebuild(conf, args):
         build_index = True
         key = None
         cert = None
+        jobs = None
 
         opts, pargs = getopt.getopt(args, "p:s:", ["no-catalog", "no-index",
-            "key=", "cert="])
+            "key=", "cert=", "jobs="])
         pubs = set()
         for opt, arg in opts:
                 if opt == "-p":
@@ -1263,6 +1268,14 @@ def subcmd_rebuild(conf, args):
                         key = arg
                 elif opt == "--cert":
                         cert = arg
+                elif opt == "--jobs":
+                        try:
+                                jobs = int(arg)
+                                if jobs < 1:
+                                        raise ValueError(jobs)
+                        except ValueError:
+                                usage(_("--jobs requires a positive integer "
+                                    "value"), cmd=subcommand)
 
         if pargs:
                 usage(_("command does not take operands"), cmd=subcommand)
@@ -1278,7 +1291,11 @@ def subcmd_rebuild(conf, args):
 
         if conf["repo_uri"].scheme == "file":
                 return __rebuild_local(subcommand, conf, pubs, build_catalog,
-                    build_index)
+                    build_index, jobs=jobs or 1)
+
+        if jobs is not None:
+                usage(_("--jobs can only be used with filesystem-based "
+                    "repositories."), cmd=subcommand)
 
         return __rebuild_remote(subcommand, conf, pubs, key, cert,
             build_catalog, build_index)
@@ -1348,6 +1365,53 @@ def subcmd_refresh(conf, args):
         return rval
 
 
+def subcmd_rebuild_file_attrs(conf, args):
+        """Rebuild the index of the compressed size and hashes of the files
+        in the repository."""
+
+        subcommand = "rebuild-file-attrs"
+
+        opts, pargs = getopt.getopt(args, "p:s:")
+        pubs = set()
+        for opt, arg in opts:
+                if opt == "-p":
+                        if not misc.valid_pub_prefix(arg):
+                                error(_("Invalid publisher prefix '{0}'").format(
+                                    arg), cmd=subcommand)
+                        pubs.add(arg)
+                elif opt == "-s":
+                        conf["repo_uri"] = parse_uri(arg)
+
+        if pargs:
+                usage(_("command does not take operands"), cmd=subcommand)
+
+        if not conf.get("repo_uri", None):
+                usage(_("A package repository location must be provided "
+                    "using -s."), cmd=subcommand)
+
+        repo = get_repo(conf, read_only=False, subcommand=subcommand)
+
+        rpubs = set(repo.publishers)
+        if not pubs:
+                found = rpubs
+        else:
+                found = rpubs & pubs
+        notfound = pubs - found
+
+        rval = EXIT_OK
+        if found and notfound:
+                rval = EXIT_PARTIAL
+        elif pubs and not found:
+                error(_("no matching publishers found"), cmd=subcommand)
+                return EXIT_OOPS
+
+        logger.info("Initiating file attribute index rebuild.")
+        for pfx in found:
+                repo.rebuild_file_attrs(pub=pfx)
+
+        return rval
+
+
 def subcmd_set(conf, args):
         """Set repository properties."""
 
@@ -1648,11 +1712,14 @@ def subcmd_verify(conf, args):
         subcommand = "verify"
         __load_verify_msgs()
 
-        opts, pargs = getopt.getopt(args, "dp:s:i:", ["disable="])
+        opts, pargs = getopt.getopt(args, "dp:s:i:", ["disable=", "full",
+            "jobs="])
         allowed_checks = set(sr.verify_default_checks)
         force_dep_check = False
         ignored_dep_files = []
         pubs = set()
+        full = False
+        jobs = 1
         for opt, arg in opts:
                 if opt == "-s":
                         conf["repo_uri"] = parse_uri(arg)
@@ -1674,6 +1741,16 @@ def subcmd_verify(conf, args):
                                     sr.verify_default_checks)), cmd=subcommand)
                 elif opt == "-i":
                         ignored_dep_files.append(arg)
+                elif opt == "--full":
+                        full = True
+                elif opt == "--jobs":
+                        try:
+                                jobs = int(arg)
+                                if jobs < 1:
+                                        raise ValueError(jobs)
+                        except ValueError:
+                                usage(_("--jobs requires a positive integer "
+                                    "value"), cmd=subcommand)
 
         if pargs:
                 usage(_("command does not take operands"), cmd=subcommand)
@@ -1724,7 +1801,8 @@ def subcmd_verify(conf, args):
 
         for verify_tuple in repo.verify(pubs=found_pubs,
             allowed_checks=allowed_checks, force_dep_check=force_dep_check,
-            ignored_dep_files=ignored_dep_files, progtrack=progtrack):
+            ignored_dep_files=ignored_dep_files, progtrack=progtrack,
+            full=full, jobs=jobs):
                 report_error(verify_tuple)
 
         if bad_fmris:
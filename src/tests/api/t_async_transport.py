@@ -0,0 +1,164 @@
+#!/usr/bin/python
+#
+# CDDL HEADER START
+#
+# The contents of this file are subject to the terms of the
+# Common Development and Distribution License (the "License").
+# You may not use this file except in compliance with the License.
+#
+# You can obtain a copy of the license at usr/src/OPENSOLARIS.LICENSE
+# or http://www.opensolaris.org/os/licensing.
+# See the License for the specific language governing permissions
+# and limitations under the License.
+#
+# When distributing Covered Code, include this CDDL HEADER in each
+# file and include the License file at usr/src/OPENSOLARIS.LICENSE.
+# If applicable, add the following below this CDDL HEADER, with the
+# fields enclosed by brackets "[]" replaced with your own identifying
+# information: Portions Copyright [yyyy] [name of copyright owner]
+#
+# CDDL HEADER END
+#
+
+#
+# Copyright (c) 2017, Oracle and/or its affiliates. All rights reserved.
+#
+
+from . import testutils
+if __name__ == "__main__":
+        testutils.setup_environment("../../../proto")
+import pkg5unittest
+
+import os
+import six
+import unittest
+
+import pkg.client.publisher as publisher
+import pkg.client.transport.exception as tx
+import pkg.fmri as fmri
+import pkg.manifest as manifest
+import pkg.misc as misc
+
+
+class TestAsyncTransport(pkg5unittest.SingleDepotTestCase):
+        """Tests for the asyncio facade over the transport engine."""
+
+        foo10 = """
+            open foo@1.0,5.11-0
+            add file tmp/foo mode=0444 owner=root group=bin path=etc/foo
+            close """
+
+        bar10 = """
+            open bar@1.0,5.11-0
+            add file tmp/bar mode=0444 owner=root group=bin path=etc/bar
+            close """
+
+        misc_files = {
+            "tmp/foo": "foo",
+            "tmp/bar": "bar",
+        }
+
+        def setUp(self):
+                if six.PY2:
+                        raise pkg5unittest.TestSkippedException(
+                            "asyncio is not available.")
+
+                pkg5unittest.SingleDepotTestCase.setUp(self)
+                self.make_misc_files(self.misc_files)
+                self.dc.start()
+                self.plist = self.pkgsend_bulk(self.durl, [self.foo10,
+                    self.bar10])
+                self.api_obj = self.image_create(self.durl)
+
+        def __engine(self):
+                import asyncio
+                import pkg.client.transport.asyncengine as asyncengine
+
+                loop = asyncio.new_event_loop()
+                self.addCleanup(loop.close)
+                aeng = asyncengine.AsyncTransportEngine(
+                    self.api_obj.img.transport, loop=loop)
+                self.addCleanup(aeng.shutdown)
+                return loop, aeng
+
+        def test_get_manifests(self):
+                """Verify that several manifests can be retrieved at once
+                and that errors are reported for the ones that fail."""
+
+                import asyncio
+
+                loop, aeng = self.__engine()
+                ruri = publisher.TransportRepoURI(self.durl)
+                repo = self.dc.get_repo()
+
+                pfmris = [fmri.PkgFmri(p) for p in self.plist]
+                futs = [aeng.get_manifest(ruri, f, pub="test")
+                    for f in pfmris]
+                missing = fmri.PkgFmri("pkg://test/missing@1.0,5.11-0")
+                futs.append(aeng.get_manifest(ruri, missing, pub="test"))
+                results = loop.run_until_complete(asyncio.gather(*futs,
+                    return_exceptions=True))
+                self.assertFalse(aeng.pending)
+
+                for f, content in zip(pfmris, results):
+                        with open(repo.manifest(f)) as mf:
+                                self.assertEqual(content, mf.read())
+                self.assertTrue(isinstance(results[-1],
+                    tx.TransportProtoError))
+
+                # The blocking transport can still be used.
+                self.api_obj.reset()
+                for pd in self.api_obj.gen_plan_install(["foo", "bar"]):
+                        continue
+                self.api_obj.prepare()
+                self.api_obj.execute_plan()
+
+        def test_get_files(self):
+                """Verify that files are retrieved into the destination
+                directory and that a cancelled request is abandoned."""
+
+                loop, aeng = self.__engine()
+                ruri = publisher.TransportRepoURI(self.durl)
+                repo = self.dc.get_repo()
+
+                hashes = []
+                for p in self.plist:
+                        m = manifest.Manifest()
+                        m.set_content(pathname=repo.manifest(
+                            fmri.PkgFmri(p)))
+                        hashes.extend(a.hash
+                            for a in m.gen_actions_by_type("file"))
+
+                dest = os.path.join(self.test_root, "files")
+                os.mkdir(dest)
+                errors = loop.run_until_complete(aeng.get_files(ruri,
+                    hashes, dest, pub="test"))
+                self.assertEqual(errors, [])
+                for h in hashes:
+                        with open(os.path.join(dest, h), "rb") as f, \
+                            open(repo.file(h), "rb") as rf:
+                                self.assertEqual(f.read(), rf.read())
+
+                # Content that is already being retrieved into one
+                # directory can't be retrieved into another at the same time.
+                other = os.path.join(self.test_root, "other")
+                os.mkdir(other)
+                fut = aeng.get_files(ruri, hashes, dest, pub="test")
+                ofut = aeng.get_files(ruri, hashes, other, pub="test")
+                self.assertEqual(loop.run_until_complete(fut), [])
+                self.assertRaises(tx.TransportOperationError,
+                    loop.run_until_complete, ofut)
+                self.assertFalse(aeng.pending)
+
+                cancelled = os.path.join(self.test_root, "cancelled")
+                os.mkdir(cancelled)
+                fut = aeng.get_files(ruri, hashes, cancelled, pub="test")
+                fut.cancel()
+                content = aeng.get_url(ruri, misc.force_str(
+                    self.durl).rstrip("/") + "/versions/0/")
+                self.assertTrue(b"file" in loop.run_until_complete(content))
+                self.assertFalse(aeng.pending)
+
+
+if __name__ == "__main__":
+        unittest.main()
@@ -35,6 +35,7 @@ import shutil
 import simplejson
 import six
 import stat
+import types
 import unittest
 from functools import cmp_to_key
 
@@ -1095,6 +1096,200 @@ class TestCatalog(pkg5unittest.Pkg5TestCase):
                         self.assertFalse(fname.startswith("catalog.") or \
                             fname.startswith("update."))
 
+        def test_11_binary_parts(self):
+                """Verify that binary catalog parts are generated on save,
+                match their JSON catalog parts, and are ignored once stale."""
+
+                cpath = self.create_test_dir("test-11")
+                nc = catalog.Catalog(meta_root=cpath, binary_parts=True)
+                for f in self.c.fmris():
+                        nc.add_package(f, manifest=self.__gen_manifest(f))
+                nc.save()
+
+                for name in nc.parts:
+                        bpath = os.path.join(cpath,
+                            name + catalog.BinaryCatalogPart.SUFFIX)
+                        self.assertTrue(os.path.isfile(bpath))
+
+                # Verify the binary part is used when the catalog is re-opened
+                # and that its content matches that of the JSON part.
+                nc = catalog.Catalog(meta_root=cpath, binary_parts=True)
+                base = nc.get_part("catalog.base.C", must_exist=True)
+                bpart = base.binary_part
+                self.assertTrue(bpart is not None)
+                self.assertFalse(base.loaded)
+                self.assertEqual(bpart.package_count, self.npkgs)
+                self.assertEqual(bpart.package_version_count, self.nversions)
+                self.assertEqual(list(bpart.publishers()),
+                    list(base.publishers()))
+
+                for f, entry in base.entries():
+                        self.assertEqual(bpart.get_entry(f.publisher,
+                            f.pkg_name, str(f.version)), entry)
+                self.assertEqual(bpart.get_entry("extra", "zpkg", "0.1"), None)
+                self.assertEqual(bpart.get_entry("extra", "nopkg", "0.1"), None)
+                self.assertEqual(
+                    [(pub, len(entries)) for pub, entries in
+                        bpart.stem_entries("zpkg")],
+                    [("contrib.opensolaris.org", 2), ("extra", 1)])
+                self.assertEqual(list(bpart.stem_entries("zpkg",
+                    pubs=["extra"]))[0][1][0]["version"],
+                    "1.0,5.11-1:20000101T120040Z")
+
+                # Verify that a binary part is ignored if the catalog part
+                # has changed since it was generated.
+                nc = catalog.Catalog(meta_root=cpath)
+                nc.add_package(fmri.PkgFmri("pkg://extra/"
+                    "zpkg@2.0,5.11-1:20000101T120040Z"))
+                nc.save()
+
+                nc = catalog.Catalog(meta_root=cpath, binary_parts=True)
+                base = nc.get_part("catalog.base.C", must_exist=True)
+                self.assertEqual(base.binary_part, None)
+
+                # Verify that a corrupt binary part is ignored.
+                bpath = base.binary_pathname
+                with open(bpath, "wb") as f:
+                        f.write(b"corrupt")
+                self.assertEqual(base.open_binary(), None)
+
+                # Verify that destroy removes binary parts.
+                nc.destroy()
+                self.assertFalse(os.path.exists(bpath))
+
+        def test_12_binary_lookups(self):
+                """Verify that lookups for individual packages are answered
+                from binary catalog parts without loading the catalog."""
+
+                cpath = self.create_test_dir("test-12")
+                nc = catalog.Catalog(meta_root=cpath, binary_parts=True)
+                for f in self.c.fmris():
+                        nc.add_package(f, manifest=self.__gen_manifest(f))
+                nc.save()
+
+                # Gather the expected results from a catalog that doesn't
+                # use binary parts.
+                jc = catalog.Catalog(meta_root=cpath)
+                nc = catalog.Catalog(meta_root=cpath, binary_parts=True)
+                for stem in ("apkg", "zpkg", "nopkg"):
+                        for pubs in ((), ["extra"]):
+                                self.assertEqual(
+                                    list(nc.fmris_by_version(stem, pubs=pubs)),
+                                    list(jc.fmris_by_version(stem, pubs=pubs)))
+                                self.assertEqual(
+                                    list(nc.entries_by_version(stem,
+                                    info_needed=[nc.DEPENDENCY,
+                                    nc.SUMMARY], pubs=pubs)),
+                                    list(jc.entries_by_version(stem,
+                                    info_needed=[nc.DEPENDENCY,
+                                    nc.SUMMARY], pubs=pubs)))
+
+                for f in jc.fmris():
+                        self.assertEqual(nc.get_entry(f,
+                            info_needed=[nc.DEPENDENCY, nc.SUMMARY]),
+                            jc.get_entry(f, info_needed=[nc.DEPENDENCY,
+                            nc.SUMMARY]))
+                self.assertEqual(nc.get_entry(fmri.PkgFmri(
+                    "pkg://extra/zpkg@0.1")), None)
+
+                for name in nc.parts:
+                        part = nc.get_part(name, must_exist=True)
+                        self.assertTrue(part.binary_part is not None)
+                        self.assertFalse(part.loaded)
+
+                # Verify that entries can still be updated.
+                f = next(jc.fmris())
+                nc.update_entry({ "states": [1] }, pfmri=f)
+                self.assertEqual(nc.get_entry(f)["metadata"], { "states": [1] })
+                nc.save()
+                nc = catalog.Catalog(meta_root=cpath, binary_parts=True)
+                self.assertEqual(nc.get_entry(f)["metadata"], { "states": [1] })
+
+                # Once a part has been loaded, its content is used instead.
+                base = nc.get_part("catalog.base.C", must_exist=True)
+                base.load()
+                f = fmri.PkgFmri("pkg://extra/zpkg@2.0,5.11-1:20000101T120040Z")
+                nc.add_package(f)
+                self.assertEqual(list(nc.fmris_by_version("zpkg",
+                    pubs=["extra"]))[-1][1], [f])
+                self.assertTrue(nc.get_entry(f) is not None)
+
+        def test_13_update_deltas(self):
+                """Verify that update logs are combined into deltas for
+                complete days and weeks and that clients use the fewest
+                update logs and deltas needed to be updated."""
+
+                clock = []
+                real_datetime = catalog.datetime
+
+                class FakeDatetime(real_datetime.datetime):
+                        @classmethod
+                        def utcnow(cls):
+                                return clock[-1]
+
+                fake = types.ModuleType("datetime")
+                fake.__dict__.update(real_datetime.__dict__)
+                fake.datetime = FakeDatetime
+                catalog.datetime = fake
+
+                cpath = self.create_test_dir("test-13-orig")
+                dup_path = os.path.join(self.test_root, "test-13-dup")
+
+                def publish(day, hour, add=None, remove=None):
+                        clock.append(FakeDatetime(2016, 1, day, hour))
+                        if add:
+                                orig.add_package(fmri.PkgFmri(
+                                    "pkg://test/{0}@1.0".format(add)))
+                        if remove:
+                                orig.remove_package(fmri.PkgFmri(
+                                    "pkg://test/{0}@1.0".format(remove)))
+                        orig.save()
+
+                try:
+                        # 2016-01-04 is a Monday.
+                        clock.append(FakeDatetime(2016, 1, 4, 10))
+                        orig = catalog.Catalog(meta_root=cpath,
+                            log_updates=True)
+                        publish(4, 10, add="a")
+                        shutil.copytree(cpath, dup_path)
+
+                        publish(4, 12, add="b")
+                        publish(4, 15, add="c")
+                        publish(5, 9, remove="b")
+                        publish(6, 11, add="d")
+                        # Only complete days are compacted.
+                        attrs = catalog.CatalogAttrs(meta_root=cpath)
+                        self.assertEqual(sorted(attrs.deltas),
+                            ["update.20160104T00Z-20160104T23Z.C"])
+
+                        publish(11, 8, add="b")
+                        publish(11, 14, remove="c")
+                        publish(12, 10, add="e")
+
+                        attrs = catalog.CatalogAttrs(meta_root=cpath)
+                        self.assertEqual(sorted(attrs.deltas), [
+                            "update.20160104T00Z-20160104T23Z.C",
+                            "update.20160104T00Z-20160110T23Z.C",
+                            "update.20160111T00Z-20160111T23Z.C",
+                        ])
+                        self.assertEqual(len(attrs.updates), 8)
+                        orig = catalog.Catalog(meta_root=cpath)
+                        orig.validate()
+
+                        dup = catalog.Catalog(meta_root=dup_path)
+                        self.assertEqual(dup.get_updates_needed(cpath), [
+                            "update.20160104T00Z-20160110T23Z.C",
+                            "update.20160111T00Z-20160111T23Z.C",
+                            "update.20160112T10Z.C",
+                        ])
+                        dup.apply_updates(cpath)
+                        self.assertEqual(
+                            [str(f) for f in dup.fmris(ordered=True)],
+                            [str(f) for f in orig.fmris(ordered=True)])
+                        self.assertEqual(dup.package_version_count, 4)
+                finally:
+                        catalog.datetime = real_datetime
+
         def test_legacy_description(self):
                 """Test that gen_packages does not traceback when a package
                 uses the legacy style of declaring package description metadata."""
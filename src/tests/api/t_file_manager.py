@@ -37,6 +37,7 @@ import tempfile
 import unittest
 
 import pkg.misc as misc
+import pkg.portable as portable
 import pkg.file_layout.file_manager as file_manager
 import pkg.file_layout.layout as layout
 
@@ -332,5 +333,71 @@ class TestFileManager(pkg5unittest.Pkg5TestCase):
                             "new-{0}".format(fhash)))
                         f.close()
 
+        def test_4_link(self):
+                """Verify that link places a hard link to the source file and
+                leaves the source in place."""
+
+                hash1 = "584b6ab7d7eb446938a02e57101c3a2fecbfb3cb"
+                src = os.path.join(self.test_root, hash1)
+                with open(src, "wb") as f:
+                        f.write(misc.force_bytes(hash1))
+
+                fm = file_manager.FileManager(self.base_dir, False,
+                    layouts=layout.V1Layout())
+                loc = fm.link(hash1, src)
+                self.assertEqual(loc, fm.lookup(hash1))
+                self.assertTrue(os.path.samefile(loc, src))
+
+                fm = file_manager.FileManager(self.base_dir, True)
+                self.check_exception(fm.link,
+                    file_manager.NeedToModifyReadOnlyFileManager,
+                    ["create", hash1], hash1, src)
+
+        def test_5_index(self):
+                """Verify that an index answers lookups of files that aren't
+                present and is kept current by insert and remove."""
+
+                hash1 = "584b6ab7d7eb446938a02e57101c3a2fecbfb3cb"
+                hash2 = "994b6ab7d7eb446938a02e57101c3a2fecbfb3cc"
+                l1 = layout.V1Layout()
+
+                # Content in an old layout is indexed and still migrated
+                # when looked up.
+                self.touch_old_file(hash1)
+                fm = file_manager.FileManager(self.base_dir, False)
+                self.assertFalse(fm.indexed)
+                fm.build_index()
+                self.assertTrue(fm.indexed)
+                self.assertEqual(fm.lookup(hash1),
+                    os.path.join(self.base_dir, l1.lookup(hash1)))
+
+                # Content placed behind the FileManager's back isn't found
+                # while the index is kept.
+                p2 = os.path.join(self.base_dir, l1.lookup(hash2))
+                os.makedirs(os.path.dirname(p2))
+                with open(p2, "wb") as f:
+                        f.write(misc.force_bytes(hash2))
+                self.assertEqual(fm.lookup(hash2), None)
+                self.assertEqual(fm.lookup(hash2, check_existence=False), p2)
+
+                # Removal and insertion update the index.
+                fm.remove(hash1)
+                self.assertEqual(fm.lookup(hash1), None)
+                src = os.path.join(self.test_root, hash1)
+                with open(src, "wb") as f:
+                        f.write(misc.force_bytes(hash1))
+                self.assertEqual(fm.insert(hash1, src), fm.lookup(hash1))
+
+                # Once dropped, lookups probe the file system again.
+                fm.drop_index()
+                self.assertFalse(fm.indexed)
+                self.assertEqual(fm.lookup(hash2), p2)
+
+                # Removing content behind the FileManager's back doesn't
+                # make a lookup return a path that no longer exists.
+                fm.build_index()
+                portable.remove(p2)
+                self.assertEqual(fm.lookup(hash2), None)
+
 if __name__ == "__main__":
         unittest.main()
@@ -697,6 +697,58 @@ packages known:
                 for i in range(3):
                         self.assertKnownPkgCount(api_objs, i, pl_init[i])
 
+        def test_shared_content_cache(self):
+                """Verify that content retrieved for a parent image is shared
+                with the children it recurses into instead of being retrieved
+                again for each of them."""
+
+                api_objs = self._imgs_create(3)
+                self._children_attach(0, [1, 2])
+
+                logpath = self.dcs[1].get_logpath()
+                with open(logpath) as f:
+                        logstart = len(f.read())
+
+                self._api_install(api_objs[0], [self.p_foo1_name[1]],
+                    li_erecurse=[self.i_lin[1], self.i_lin[2]])
+                for i in range(3):
+                        api_objs[i].reset()
+                        self._verify_pkg(api_objs, i, self.p_foo1_name[1])
+
+                # The package has a single file for the image variant; it
+                # should only have been retrieved once.
+                with open(logpath) as f:
+                        log = f.read()[logstart:]
+                self.assertEqual(len([
+                    l for l in log.splitlines()
+                    if "GET " in l and "/file/" in l
+                ]), 1, log)
+
+                # Once its children are done with the shared cache, the
+                # parent flushes it as its flush-content-cache-on-success
+                # policy says to.
+                shared = os.path.join(api_objs[0].img.imgdir, "cache",
+                    "shared")
+                self.assertFalse(os.path.exists(shared))
+
+                # If the parent keeps content, the shared cache is kept too.
+                api_objs[0].img.set_property("flush-content-cache-on-success",
+                    False)
+                self._api_uninstall(api_objs[0], [self.p_foo1_name[1]],
+                    li_erecurse=[self.i_lin[1], self.i_lin[2]])
+                self._api_install(api_objs[0], [self.p_foo1_name[1]],
+                    li_erecurse=[self.i_lin[1], self.i_lin[2]])
+                for i in range(3):
+                        api_objs[i].reset()
+                        self._verify_pkg(api_objs, i, self.p_foo1_name[1])
+                with open(logpath) as f:
+                        log = f.read()[logstart:]
+                self.assertEqual(len([
+                    l for l in log.splitlines()
+                    if "GET " in l and "/file/" in l
+                ]), 2, log)
+                self.assertTrue(os.path.isdir(shared))
+
         def test_err_toxic_pkg(self):
                 # create images
                 api_objs = self._imgs_create(2)
@@ -474,6 +474,31 @@ dir owner=root path=fm group=bin mode=0755 facet.multi=true \\
                     misc.get_data_digest(self.foo_content_p5m,
                     hash_func=digest.DEFAULT_HASH_FUNC))
 
+        def test_content_path(self):
+                """Verifies that a FactoredManifest created from a file
+                containing the manifest matches one created from the same
+                content and has its cache files written."""
+
+                m1 = manifest.FactoredManifest("foo-content@1.0",
+                    self.cache_dir, contents=self.foo_content)
+
+                cache_dir = tempfile.mkdtemp(dir=self.test_root)
+                m2 = manifest.FactoredManifest("foo-content@1.0", cache_dir,
+                    content_path=self.foo_content_p5m)
+                self.assertTrue(os.path.exists(self.foo_content_p5m))
+                self.assertEqualDiff(sorted(m1.as_lines()),
+                    sorted(m2.as_lines()))
+                for name in ("manifest", "manifest.set", "manifest.dir",
+                    "manifest.dircache"):
+                        self.assertTrue(os.path.isfile(os.path.join(cache_dir,
+                            name)))
+
+                # Content is only used if there's no cached copy.
+                m3 = manifest.FactoredManifest("foo-content@1.0", cache_dir,
+                    content_path=os.path.join(self.test_root, "nonexistent"))
+                self.assertEqualDiff(sorted(m1.as_lines()),
+                    sorted(m3.as_lines()))
+
         def test_get_directories(self):
                 """Verifies that get_directories() works as expected."""
 
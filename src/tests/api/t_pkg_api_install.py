@@ -29,13 +29,19 @@ if __name__ == "__main__":
         testutils.setup_environment("../../../proto")
 import pkg5unittest
 
+import gzip
 import os
+import simplejson as json
+import socket
+import subprocess
 import time
 import sys
 import unittest
 import pkg.client.api_errors as api_errors
+import pkg.client.plandesc as plandesc
 import pkg.client.progress as progress
 import pkg.client.publisher as publisher
+import pkg.client.transport.stats as tstats
 import pkg.fmri as fmri
 import pkg.manifest as manifest
 import pkg.misc as misc
@@ -43,9 +49,11 @@ import pkg.portable as portable
 import stat
 import shutil
 
+from pkg.client import global_settings
 from pkg.client.debugvalues import DebugValues
+from six.moves.urllib.error import HTTPError
 from six.moves.urllib.parse import urlunparse
-from six.moves.urllib.request import pathname2url
+from six.moves.urllib.request import Request, pathname2url, urlopen
 
 PKG_CLIENT_NAME = "pkg"
 
@@ -216,6 +224,13 @@ class TestPkgApiInstall(pkg5unittest.SingleDepotTestCase):
             add file tmp/motd mode=0644 owner=root group=bin path=etc/motd
             close"""
 
+        bundle10 = """
+            open bundle@1.0
+            add file tmp/libc.so.1 mode=0555 owner=root group=bin path=lib/libc.so.1
+            add file tmp/cat mode=0555 owner=root group=bin path=bin/cat
+            add file tmp/baz mode=0555 owner=root group=bin path=bin/baz
+            close """
+
         misc_files = [ "tmp/libc.so.1", "tmp/cat", "tmp/baz", "tmp/motd" ]
 
         def setUp(self):
@@ -1121,6 +1136,464 @@ class TestPkgApiInstall(pkg5unittest.SingleDepotTestCase):
                 assert not os.path.exists(mdir), \
                     "manifest directory '{0}' exists!".format(mdir)
 
+        def test_solver_profile(self):
+                """Verify that a profile of the work done by the solver is
+                available from the plan description."""
+
+                self.pkgsend_bulk(self.rurl, (self.foo10, self.foo11))
+                api_obj = self.image_create(self.rurl)
+
+                api_obj.reset()
+                for pd in api_obj.gen_plan_install(["foo@1.0"]):
+                        continue
+                pd = api_obj.describe()
+                profile = pd.get_solver_profile()
+                self.assertEqual(profile["state"], "Succeeded")
+                self.assertTrue(profile["variables"] > 0)
+                self.assertTrue(profile["clauses"] > 0)
+                self.assertTrue(profile["iterations"] > 0)
+                self.assertTrue(profile["solves"] > 0)
+                self.assertTrue(profile["timings"])
+                self.assertEqual(profile["trimmed"].get("proposed_ver"), 1)
+                self.assertEqual(sorted(profile["cache"]), ["hits", "misses"])
+
+                # The profile survives serialization of the plan.
+                pd2 = plandesc.PlanDescription.fromstate(
+                    json.loads(json.dumps(
+                    plandesc.PlanDescription.getstate(pd))))
+                self.assertEqual(pd2.get_solver_profile(), profile)
+                api_obj.reset()
+
+                self.pkg("-D solver_profile=1 install -n foo@1.0")
+                self.assertTrue("Solver profile:" in self.output)
+                self.assertTrue("\"trimmed\"" in self.output)
+                self.pkg("install -n foo@1.0")
+                self.assertTrue("Solver profile:" not in self.output)
+
+        def test_solver_cache(self):
+                """Verify that the setup of the solver for an operation is
+                reused when the same operation is planned again and that a
+                damaged or outdated solver cache doesn't affect planning."""
+
+                self.pkgsend_bulk(self.rurl, (self.foo10, self.foo11,
+                    self.bar10))
+                api_obj = self.image_create(self.rurl)
+                self.__do_install(api_obj, ["foo@1.0"])
+                cache_path = os.path.join(api_obj.img.imgdir, "cache",
+                    "solver")
+
+                def plan(gen_plan, pkgs):
+                        api_obj.reset()
+                        for pd in gen_plan(pkgs):
+                                continue
+                        pd = api_obj.describe()
+                        changes = sorted(
+                            str(dest.fmri)
+                            for src, dest in pd.get_changes()
+                        )
+                        # The trimming decisions are reported too.
+                        changes.extend(pd.get_solver_errors())
+                        return pd.get_solver_profile(), changes
+
+                def get_entries():
+                        with open(cache_path) as f:
+                                version, key, entries = json.load(f)
+                        self.assertEqual(version, 1)
+                        return entries
+
+                for gen_plan, pkgs, expected, ntrimmed in (
+                    (api_obj.gen_plan_install, ["bar", "foo@1.0"], "bar@1.0",
+                        1),
+                    (api_obj.gen_plan_update, [], "foo@1.1", 0)):
+                        profile, changes = plan(gen_plan, pkgs)
+                        self.assertEqual(profile["setup_cache"],
+                            {"hits": 0, "misses": 1})
+                        self.assertTrue(changes[0].startswith(
+                            "pkg://test/" + expected))
+                        self.assertEqual(
+                            sum(profile["trimmed"].values()), ntrimmed)
+
+                        # Planning the same operation again reuses the setup
+                        # and produces the same result.
+                        profile2, changes2 = plan(gen_plan, pkgs)
+                        self.assertEqual(profile2["setup_cache"],
+                            {"hits": 1, "misses": 0})
+                        self.assertEqual(changes2, changes)
+                        self.assertEqual(profile2["variables"],
+                            profile["variables"])
+                        self.assertEqual(profile2["clauses"],
+                            profile["clauses"])
+                        self.assertEqual(profile2["trimmed"],
+                            profile["trimmed"])
+                self.assertEqual(len(get_entries()), 2)
+
+                # A corrupt cache is replaced by the next operation.
+                with open(cache_path, "w") as f:
+                        f.write("corrupt")
+                profile, changes2 = plan(api_obj.gen_plan_update, [])
+                self.assertEqual(profile["setup_cache"],
+                    {"hits": 0, "misses": 1})
+                self.assertEqual(changes2, changes)
+                self.assertEqual(len(get_entries()), 1)
+
+                # Setups for an outdated catalog aren't used and are
+                # discarded.
+                self.pkgsend_bulk(self.rurl, self.foo12)
+                api_obj.refresh()
+                profile, changes = plan(api_obj.gen_plan_install,
+                    ["bar", "foo@1.0"])
+                self.assertEqual(profile["setup_cache"],
+                    {"hits": 0, "misses": 1})
+                profile, changes = plan(api_obj.gen_plan_update, [])
+                self.assertEqual(profile["setup_cache"],
+                    {"hits": 0, "misses": 1})
+                self.assertTrue(changes[0].startswith("pkg://test/foo@1.2"))
+                self.assertEqual(len(get_entries()), 2)
+                api_obj.reset()
+
+        def test_manifest_prefetch(self):
+                """Verify that manifests retrieved while the solver runs are
+                kept only for packages that are part of the solution."""
+
+                plist = self.pkgsend_bulk(self.rurl, (self.foo10, self.foo11,
+                    """
+                    open incorp@1.0,5.11-0
+                    add depend type=incorporate fmri=pkg:/foo@1.0
+                    close
+                    open incorp@2.0,5.11-0
+                    add depend type=incorporate fmri=pkg:/foo@1.1
+                    close """))
+                foo11, incorp1, incorp2 = [
+                    fmri.PkgFmri(p) for p in plist[1:]
+                ]
+                api_obj = self.image_create(self.rurl)
+                self.__do_install(api_obj, ["incorp@1.0", "foo"])
+
+                def has_manifest(pfmri):
+                        return os.path.exists(
+                            api_obj.img.get_manifest_path(pfmri))
+
+                # The newest version of the installed incorporation is
+                # retrieved while updating all packages, but discarded if
+                # it isn't part of the solution.
+                api_obj.freeze_pkgs(["incorp"])
+                api_obj.reset()
+                for pd in api_obj.gen_plan_update():
+                        continue
+                self.assertFalse(has_manifest(incorp2))
+                self.assertFalse(has_manifest(foo11))
+
+                api_obj.freeze_pkgs(["incorp"], unfreeze=True)
+                api_obj.reset()
+                for pd in api_obj.gen_plan_update():
+                        continue
+                self.assertTrue(has_manifest(incorp2))
+                self.assertTrue(has_manifest(foo11))
+                api_obj.reset()
+
+        def test_download_verify(self):
+                """Verify that content is verified as it is downloaded and
+                that corrupt content is rejected."""
+
+                self.dc.start()
+                plist = self.pkgsend_bulk(self.durl, self.foo11)
+                api_obj = self.image_create(self.durl)
+                self.__do_install(api_obj, ["foo"])
+                self.pkg("verify foo")
+                self.__do_uninstall(api_obj, ["foo"])
+
+                # Replace the payload in the repository with valid, but
+                # different, compressed content.
+                repo = self.dc.get_repo()
+                mfst = manifest.Manifest()
+                mfst.set_content(pathname=repo.manifest(
+                    fmri.PkgFmri(plist[0])))
+                hashval = [a.hash for a in mfst.gen_actions_by_type("file")][0]
+                fpath = repo.file(hashval)
+                os.chmod(fpath, misc.PKG_FILE_MODE)
+                with gzip.GzipFile(fpath, "wb") as f:
+                        f.write(b"corrupt")
+
+                self.pkg("install foo", exit=1)
+                self.assertTrue("chash failure" in self.errout)
+                self.pkg("list foo", exit=1)
+
+        def test_download_resume(self):
+                """Verify that interrupted downloads are resumed and that
+                partial content which can't be used is discarded."""
+
+                self.dc.start()
+                plist = self.pkgsend_bulk(self.durl, self.foo11)
+                api_obj = self.image_create(self.durl)
+
+                repo = self.dc.get_repo()
+                mfst = manifest.Manifest()
+                mfst.set_content(pathname=repo.manifest(
+                    fmri.PkgFmri(plist[0])))
+                hashval = [a.hash for a in mfst.gen_actions_by_type("file")][0]
+                with open(repo.file(hashval), "rb") as f:
+                        payload = f.read()
+
+                pdir = api_obj.img._partial_cache_dir
+                ppath = os.path.join(pdir, hashval)
+                for partial in (payload[:len(payload) // 2],
+                    b"corrupt" * 8, payload + b"trailing"):
+                        # Leave the partial content behind as an interrupted
+                        # transfer would; the remainder of the file should be
+                        # retrieved, or the whole file if the partial content
+                        # is unusable.
+                        os.makedirs(pdir)
+                        with open(ppath, "wb") as f:
+                                f.write(partial)
+                        self.__do_install(api_obj, ["foo"])
+                        self.pkg("verify foo")
+                        self.assertFalse(os.path.exists(pdir))
+                        self.__do_uninstall(api_obj, ["foo"])
+
+                # The first attempt should have been satisfied with a partial
+                # response.
+                with open(self.dc.get_logpath()) as f:
+                        self.assertTrue(" 206 " in f.read())
+
+        def test_download_bundle(self):
+                """Verify that a package's files are retrieved using a single
+                request if the repository supports it, and individually if
+                it doesn't."""
+
+                self.dc.start()
+                self.pkgsend_bulk(self.durl, self.bundle10)
+                api_obj = self.image_create(self.durl)
+                self.__do_install(api_obj, ["bundle"])
+                self.pkg("verify bundle")
+                with open(self.dc.get_logpath()) as f:
+                        log = f.read()
+                self.assertTrue('"POST /test/files/0/ HTTP/1.1" 200' in log)
+                self.assertTrue('"GET /test/file/' not in log)
+
+                # Anything other than a file hash is refused rather than
+                # looked up in the repository.
+                for token in ("../../cfg_cache", "0" * 39, "A" * 40):
+                        req = Request("{0}/test/files/0/".format(self.durl),
+                            data=misc.force_bytes(token))
+                        with self.assertRaises(HTTPError) as cm:
+                                urlopen(req)
+                        self.assertEqual(cm.exception.code, 400)
+
+                self.dc.stop()
+                self.dc.set_disable_ops(["files"])
+                self.dc.start()
+                api_obj = self.image_create(self.durl)
+                self.__do_install(api_obj, ["bundle"])
+                self.pkg("verify bundle")
+                with open(self.dc.get_logpath()) as f:
+                        log = f.read()
+                self.assertEqual(log.count('"GET /test/file/1/'), 3)
+
+        def test_shared_content_cache(self):
+                """Verify that content retrieved for an image that shares its
+                content cache is used by the images it's shared with, which
+                only read from it, and that the image that owns the cache
+                flushes it according to its flush-content-cache-on-success
+                policy."""
+
+                self.dc.start()
+                self.pkgsend_bulk(self.durl, self.bundle10)
+
+                def install_shared(api_obj, fmris):
+                        # A parent image enables the shared cache while
+                        # planning an operation that recurses into children.
+                        api_obj.reset()
+                        api_obj.img.enable_shared_cache()
+                        for pd in api_obj.gen_plan_install(fmris):
+                                continue
+                        api_obj.prepare()
+                        api_obj.execute_plan()
+
+                api_obj = self.image_create(self.durl)
+                api_obj.img.set_property("flush-content-cache-on-success",
+                    False)
+                install_shared(api_obj, ["bundle"])
+                self.pkg("verify bundle")
+                shared = api_obj.img.shared_cache_dir
+                self.assertEqual(shared, os.path.join(api_obj.img.imgdir,
+                    "cache", "shared"))
+
+                def shared_files():
+                        return sorted(
+                            f for dp, dn, fn in os.walk(shared) for f in fn
+                        )
+                cached = shared_files()
+                self.assertEqual(len(cached), 3)
+
+                with open(self.dc.get_logpath()) as f:
+                        log = f.read()
+                os.environ["PKG_SHARED_CACHEDIR"] = shared
+                try:
+                        img_path = os.path.join(self.test_root, "child")
+                        api_obj2 = self.image_create(self.durl,
+                            img_path=img_path)
+                        self.assertEqual(api_obj2.img.shared_cache_dir,
+                            shared)
+                        self.__do_install(api_obj2, ["bundle"])
+                        self.assertTrue(os.path.isfile(os.path.join(img_path,
+                            "bin", "cat")))
+                        with open(self.dc.get_logpath()) as f:
+                                self.assertEqual(f.read().count("/file"),
+                                    log.count("/file"))
+
+                        # The cache isn't the image's to add to or flush.
+                        self.assertEqual(shared_files(), cached)
+                finally:
+                        del os.environ["PKG_SHARED_CACHEDIR"]
+
+                # The image that owns the cache flushes it when its policy is
+                # to flush content.
+                api_obj.img.set_property("flush-content-cache-on-success",
+                    True)
+                self.__do_uninstall(api_obj, ["bundle"])
+                install_shared(api_obj, ["bundle"])
+                self.assertFalse(os.path.exists(shared))
+
+        def test_repo_stats(self):
+                """Verify that repository statistics are kept between client
+                invocations and forgotten once they are old."""
+
+                self.dc.start()
+                self.pkgsend_bulk(self.durl, self.foo11)
+                api_obj = self.image_create(self.durl)
+                self.__do_install(api_obj, ["foo"])
+
+                path = api_obj.img.transport.cfg.stats_path
+                ruri = publisher.TransportRepoURI(self.durl)
+                rc = tstats.RepoChooser()
+                rc.load(path)
+                rs = rc.get_repostats([ruri])[0][0]
+                self.assertTrue(rs.used)
+                self.assertTrue(rs.success > 0)
+                self.assertTrue(rs.bytes_xfr > 0)
+
+                # Resetting the statistics for a new operation keeps what
+                # was loaded.
+                success = rs.success
+                rc.reset()
+                self.assertEqual(rs.success, success)
+
+                with open(path) as f:
+                        version, entries = json.load(f)
+                for ent in entries:
+                        ent[2] -= 30 * 24 * 60 * 60
+                with open(path, "w") as f:
+                        json.dump((version, entries), f)
+                rc = tstats.RepoChooser()
+                rc.load(path)
+                rs = rc.get_repostats([ruri])[0][0]
+                self.assertFalse(rs.used)
+
+        def test_transfer_params(self):
+                """Verify the chunk size and number of connections chosen
+                from repository statistics."""
+
+                chunk_bounds = (10, 1024)
+                conn_bounds = (2, 20)
+                rc = tstats.RepoChooser()
+                ruri1 = publisher.TransportRepoURI("http://origin1.test")
+                ruri2 = publisher.TransportRepoURI("http://origin2.test")
+
+                # A lone origin gets the largest chunk, even before it has
+                # been visited, as there's no other choice.
+                self.assertEqual(rc.get_transfer_params([ruri1],
+                    chunk_bounds, conn_bounds), (1024, 20))
+
+                # Until every origin has been visited, the smallest chunk
+                # is used so that little is transferred from a poor choice.
+                rs1 = rc[ruri1.key()]
+                rs1.record_tx()
+                self.assertEqual(rc.get_transfer_params([ruri1, ruri2],
+                    chunk_bounds, conn_bounds), (10, 20))
+
+                # Once the origins have been visited, connections are added
+                # in proportion to the time spent connecting, and the chunk
+                # is sized to take about ten seconds.
+                rs2 = rc[ruri2.key()]
+                rs2.record_tx()
+                for rs in (rs1, rs2):
+                        for i in range(9):
+                                rs.record_tx()
+                        for i in range(10):
+                                rs.record_connection(0.1)
+                        rs.record_progress(10000, 1.0)
+                self.assertEqual(rc.get_transfer_params([ruri1],
+                    chunk_bounds, conn_bounds), (1024, 4))
+                self.assertEqual(rc.get_transfer_params([ruri1, ruri2],
+                    chunk_bounds, conn_bounds), (200, 4))
+
+        def test_http2(self):
+                """Verify that when HTTP/2 is enabled, requests made through
+                a proxy that speaks HTTP/2 are multiplexed over a few
+                connections."""
+
+                nghttpx = None
+                for d in os.environ.get("PATH", "").split(os.pathsep):
+                        if os.access(os.path.join(d, "nghttpx"), os.X_OK):
+                                nghttpx = os.path.join(d, "nghttpx")
+                                break
+                if not nghttpx:
+                        raise pkg5unittest.TestSkippedException(
+                            "nghttpx is required to test HTTP/2.")
+
+                # Retrieve files individually so that there are concurrent
+                # requests to multiplex.
+                self.dc.set_disable_ops(["files"])
+                self.dc.start()
+                pkgs = []
+                for i in range(8):
+                        fname = "tmp/http2_{0:d}".format(i)
+                        self.make_misc_files({ fname: fname })
+                        pkgs.append("""
+                            open http2_{0:d}@1.0
+                            add file {1} mode=0444 owner=root group=bin path={1}
+                            close """.format(i, fname))
+                plist = self.pkgsend_bulk(self.durl, pkgs)
+
+                port = self.next_free_port
+                purl = "http://localhost:{0:d}".format(port)
+                alog = os.path.join(self.test_root, "nghttpx_access.log")
+                proxy = subprocess.Popen([nghttpx,
+                    "--backend=127.0.0.1,{0:d}".format(self.dc.get_port()),
+                    "--frontend=127.0.0.1,{0:d};no-tls".format(port),
+                    "--workers=1", "--no-ocsp", "--accesslog-file=" + alog,
+                    "--accesslog-format=$alpn $request",
+                    "--errorlog-file=" + os.path.join(self.test_root,
+                    "nghttpx_error.log")])
+                try:
+                        for i in range(50):
+                                try:
+                                        socket.create_connection(
+                                            ("127.0.0.1", port)).close()
+                                        break
+                                except socket.error:
+                                        time.sleep(0.1)
+
+                        global_settings.PKG_CLIENT_HTTP2 = True
+                        api_obj = self.image_create(purl)
+                        self.__do_install(api_obj, plist)
+
+                        ruri = publisher.TransportRepoURI(purl)
+                        rs = api_obj.img.transport.stats.get_repostats(
+                            [ruri])[0][0]
+                        self.assertTrue(rs.num_multiplexed > 0)
+                        self.assertTrue(rs.num_connect < rs.num_multiplexed)
+                finally:
+                        global_settings.PKG_CLIENT_HTTP2 = False
+                        proxy.terminate()
+                        proxy.wait()
+
+                with open(alog) as f:
+                        reqs = f.read().splitlines()
+                self.assertTrue(any("/file/" in r for r in reqs))
+                for r in reqs:
+                        self.assertTrue(r.startswith("h2"), r)
+
 
 class TestActionExecutionErrors(pkg5unittest.SingleDepotTestCase):
         """This set of tests is intended to verify that the client API will
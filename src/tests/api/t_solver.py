@@ -41,6 +41,53 @@ class TestSolver(pkg5unittest.Pkg5TestCase):
         def test_solution(self):
                 cnf_test(working_test_case.splitlines())
 
+        def test_bulk(self):
+                """Verify that clauses can be added and the solution
+                retrieved in a single call."""
+
+                clauses = []
+                flat = []
+                for l in working_test_case.splitlines():
+                        if l and l[0] not in 'pc%0':
+                                cl = [int(i) for i in l.split()[0:-1]]
+                                clauses.append(cl)
+                                flat.extend(cl)
+                                flat.append(0)
+
+                s = solver.msat_solver()
+                self.assertTrue(s.add_clauses(flat))
+                self.assertTrue(s.solve([]))
+                true_vars = set(s.get_solution())
+                self.assertEqual(true_vars, set(
+                    i + 1 for i in range(max(true_vars))
+                    if s.dereference(i)
+                ))
+                for cl in clauses:
+                        self.assertTrue([
+                            l for l in cl
+                            if (l > 0) == (abs(l) in true_vars)
+                        ])
+                self.assertEqual(s.get_solution(10),
+                    [i for i in sorted(true_vars) if i <= 10])
+
+                # Malformed lists are rejected without adding any clauses.
+                s = solver.msat_solver()
+                for bad in ([1, 2], [1, 0, 0], [1, "2", 0], (1, 0)):
+                        self.assertRaises(TypeError, s.add_clauses, bad)
+                self.assertTrue(s.add_clauses([1, 0, -1, 2, 0]))
+                self.assertTrue(s.solve([]))
+                self.assertEqual(s.get_solution(), [1, 2])
+
+                # Clauses that can't be satisfied leave the solver needing
+                # to be reset, as for add_clause().
+                s = solver.msat_solver()
+                self.assertFalse(s.add_clauses([1, 0, -1, 0, 2, 0]))
+                self.assertRaises(RuntimeError, s.add_clauses, [2, 0])
+                self.assertRaises(RuntimeError, s.solve, [])
+                s.reset()
+                self.assertTrue(s.add_clauses([2, 0]))
+                self.assertTrue(s.solve([]))
+
 def cnf_test(lines):
         s = solver.msat_solver()
         
@@ -22,7 +22,7 @@
 #
 
 #
-# Copyright (c) 2013, 2016, Oracle and/or its affiliates. All rights reserved.
+# Copyright (c) 2013, 2017, Oracle and/or its affiliates. All rights reserved.
 #
 
 from . import testutils
@@ -37,10 +37,11 @@ import time
 import unittest
 import certgenerator
 import shutil
+import tarfile
 from six.moves import http_client
 from six.moves.urllib.error import HTTPError
 from six.moves.urllib.parse import quote
-from six.moves.urllib.request import urlopen
+from six.moves.urllib.request import Request, urlopen
 
 from pkg.client.debugvalues import DebugValues
 import pkg.fmri
@@ -921,6 +922,51 @@ class TestHttpDepot(_Apache, pkg5unittest.ApacheDepotTestCase):
                 self.pkgrepo("-s {0}/testpkg5/usr refresh".format(
                     self.ac.url), exit=1)
 
+        def test_17_htfiles(self):
+                """Test that files/0 requests are served by the WSGI
+                application, and that anything other than a list of file
+                hashes in the request body is rejected."""
+
+                self.pkgsend_bulk(self.dcs[1].get_repo_url(), self.sample_pkg)
+                self.pkgrepo("-s {0} refresh".format(self.dcs[1].get_repo_url()))
+                self.depotconfig("")
+                self.start_depot()
+
+                self.image_create()
+                ret, output = self.pkg("search -s {0}/default -H -o action.hash "
+                     "-r /usr/bin/sample".format(self.ac.url), out=True)
+                file_hash = output.strip()
+
+                def post_files(data, content_type="text/plain"):
+                        req = Request("{0}/default/files/0/".format(
+                            self.ac.url), data=data.encode("utf-8"),
+                            headers={"Content-Type": content_type})
+                        return urlopen(req)
+
+                # The request body is read by files_0(), not CherryPy, so it
+                # doesn't matter whether it looks like form data.  Files that
+                # the repository doesn't have are omitted from the stream.
+                for content_type in ("text/plain",
+                    "application/x-www-form-urlencoded"):
+                        u = post_files("\n".join([file_hash, "0" * 40]),
+                            content_type=content_type)
+                        self.assertEqual(u.headers.get("Content-Type"),
+                            "application/x-tar")
+                        tar_stream = tarfile.open(mode="r|", fileobj=u)
+                        self.assertEqual([ti.name for ti in tar_stream],
+                            [file_hash])
+                        u.close()
+
+                for bad in ("../../cfg_cache", "0" * 39, "A" * 40):
+                        try:
+                                post_files("\n".join([file_hash, bad]))
+                        except HTTPError as e:
+                                self.assertEqual(e.code,
+                                    http_client.BAD_REQUEST)
+                        else:
+                                self.assertTrue(False, "files/0 accepted "
+                                    "{0}".format(bad))
+
 
 class TestHttpsDepot(_Apache, pkg5unittest.HTTPSTestClass):
         """Tests that exercise the pkg.depot-config CLI as well as checking the
@@ -41,7 +41,7 @@ import unittest
 from six.moves import http_client
 from six.moves.urllib.error import HTTPError, URLError
 from six.moves.urllib.parse import quote, urljoin
-from six.moves.urllib.request import urlopen
+from six.moves.urllib.request import Request, urlopen
 
 import pkg.client.publisher as publisher
 import pkg.depotcontroller as dc
@@ -1167,6 +1167,61 @@ class TestDepotOutput(pkg5unittest.SingleDepotTestCase):
                         self.assertEqual(cc, None)
                         self.assertEqual(prg, None)
 
+        def test_4_etags(self):
+                """Ensure that responses which only change when the
+                repository does have entity tags, and that conditional requests
+                for them are answered with 304 (Not Modified) until the
+                repository changes."""
+
+                self.dc.start()
+
+                durl = self.dc.get_depot_url()
+                pfmri = fmri.PkgFmri(self.pkgsend_bulk(durl, self.file10)[0],
+                    "5.11")
+
+                def get(req_path, etag=None):
+                        req = Request(urljoin(durl, req_path))
+                        if etag:
+                                req.add_header("If-None-Match", etag)
+                        try:
+                                res = urlopen(req)
+                        except HTTPError as e:
+                                return e.code, e.info().get("ETag")
+                        return res.code, res.info().get("ETag")
+
+                req_paths = ["publisher/0", "publisher/1", "versions/0",
+                    "status/0", "manifest/0/{0}".format(pfmri.get_url_path()),
+                    "catalog/1/catalog.attrs"]
+                etags = {}
+                for req_path in req_paths:
+                        code, etag = get(req_path)
+                        self.assertEqual(code, http_client.OK)
+                        self.assertTrue(etag and etag.startswith('"'))
+                        etags[req_path] = etag
+
+                        # The same response is returned until the repository
+                        # changes.
+                        self.assertEqual(get(req_path)[1], etag)
+                        code, etag = get(req_path, etag=etag)
+                        self.assertEqual(code, http_client.NOT_MODIFIED)
+                        self.assertEqual(get(req_path, etag='"bogus"'),
+                            (http_client.OK, etags[req_path]))
+
+                # Publishing a package changes the catalog, so clients must get
+                # the new one.
+                self.pkgsend_bulk(durl, self.quux10)
+                code, etag = get("catalog/1/catalog.attrs",
+                    etag=etags["catalog/1/catalog.attrs"])
+                self.assertEqual(code, http_client.OK)
+                self.assertNotEqual(etag, etags["catalog/1/catalog.attrs"])
+                self.assertEqual(get("catalog/1/catalog.attrs", etag=etag)[0],
+                    http_client.NOT_MODIFIED)
+
+                # The manifest of the original package hasn't changed.
+                req_path = "manifest/0/{0}".format(pfmri.get_url_path())
+                self.assertEqual(get(req_path, etag=etags[req_path])[0],
+                    http_client.NOT_MODIFIED)
+
         def test_bug_15482(self):
                 """Test to make sure BUI search doesn't trigger a traceback."""
 
@@ -89,6 +89,32 @@ class TestPkgPropertyBasics(pkg5unittest.SingleDepotTestCase):
                 self.pkg("property -H flush-content-cache-on-success |"
                     "grep -i flush-content-cache-on-success.*false$")
 
+        def test_transport_properties(self):
+                """Verify that the bounds on the transport's chunk size and
+                connections can be set and are used."""
+
+                self.pkgsend_bulk(self.rurl, """
+                    open foo@1.0,5.11-0
+                    add dir mode=0755 owner=root group=bin path=/lib
+                    close """)
+                self.image_create(self.rurl)
+
+                self.pkg("property -H transport-chunk-max |"
+                    "grep 'transport-chunk-max.*1024$'")
+                self.pkg("set-property transport-chunk-max 0", exit=1)
+                self.pkg("set-property transport-connections-max many",
+                    exit=1)
+                self.pkg("set-property transport-chunk-max 50")
+                self.pkg("set-property transport-connections-min 3")
+                self.pkg("set-property transport-connections-max 5")
+
+                # With a single origin, the largest chunk size allowed is
+                # used.  No time is spent connecting to a file repository,
+                # so the fewest connections allowed are used.
+                self.pkg("install foo", env_arg={"PKG_DUMP_STATS": "1"})
+                self.assertTrue("Chunk size: 50 Connections: 3" in self.output,
+                    self.output)
+
         def test_missing_permissions(self):
                 """Bug 2393"""
 
@@ -700,6 +700,120 @@ class TestPkgRefreshMulti(pkg5unittest.ManyDepotTestCase):
                 self.pkg("install foo@latest")
                 self.pkg("list foo@1.2")
 
+        def test_parallel_refresh(self):
+                """Test that publishers can be refreshed in parallel and that
+                errors are still reported for each publisher."""
+
+                env = { "PKG_CLIENT_REFRESH_CONCURRENCY": "0" }
+                self.image_create(self.durl1, prefix="test1")
+                self.pkg("set-publisher -O " + self.durl2 + " test2")
+                self.pkgsend_bulk(self.durl1, self.foo10)
+                self.pkgsend_bulk(self.durl2, self.foo12)
+
+                self.pkg("refresh --full", env_arg=env)
+                self.pkg("list -aH pkg:/foo")
+                expected = \
+                    "foo 1.0-0 ---\n" + \
+                    "foo (test2) 1.2-0 ---\n"
+                self.checkAnswer(expected, self.output)
+
+                # Incremental updates should be applied as well.
+                self.pkgsend_bulk(self.durl1, self.foo11)
+                self.pkgsend_bulk(self.durl2, self.foo121)
+                self.pkg("refresh", env_arg=env)
+                self.pkg("list -afH pkg:/foo")
+                expected = \
+                    "foo 1.0-0 ---\n" + \
+                    "foo 1.1-0 ---\n" + \
+                    "foo (test2) 1.2-0 ---\n" + \
+                    "foo (test2) 1.2.1-0 ---\n"
+                self.checkAnswer(expected, self.output)
+
+                # A publisher that can't be refreshed should not prevent
+                # the others from being refreshed.
+                self.dcs[2].stop()
+                self.pkgsend_bulk(self.durl1, self.foo12)
+                self.pkg("refresh", env_arg=env, exit=3)
+                self.assertTrue("test2" in self.errout)
+                self.pkg("list -afH pkg:/foo@1.2")
+                expected = \
+                    "foo 1.2-0 ---\n" + \
+                    "foo (test2) 1.2-0 ---\n"
+                self.checkAnswer(expected, self.output)
+
+        def test_incremental_rebuild(self):
+                """Verify that the image catalogs are updated in place when
+                publisher catalogs change and that the result matches a full
+                rebuild."""
+
+                rurl = self.dcs[3].get_repo_url()
+                self.image_create(rurl, prefix="test1")
+                self.pkgsend_bulk(rurl, (self.foo10, self.food12))
+                self.pkg("refresh")
+                self.pkg("install foo@1.0 food")
+
+                statedir = os.path.join(self.get_img_api_obj().img.imgdir,
+                    "state")
+                sources = os.path.join(statedir, "catalog_sources")
+                self.assertTrue(os.path.exists(sources))
+                ibase = os.path.join(statedir, "installed", "catalog.base.C")
+
+                def check(expected_all, expected_upgradable):
+                        self.pkg("list -afH")
+                        self.assertEqualDiff(expected_all,
+                            self.reduce_spaces(self.output))
+                        self.pkg("list -uH", exit=0 if expected_upgradable else 1)
+                        self.assertEqualDiff(expected_upgradable,
+                            self.reduce_spaces(self.output))
+
+                def check_full(expected_all, expected_upgradable):
+                        check(expected_all, expected_upgradable)
+                        # Discarding the record of what the image catalogs
+                        # were built from forces a full rebuild.
+                        os.unlink(sources)
+                        self.pkg("refresh --full")
+                        check(expected_all, expected_upgradable)
+
+                # When the image catalogs are updated in place, the installed
+                # catalog is only rewritten if installed packages changed.
+                os.utime(ibase, (0, 0))
+                self.pkgsend_bulk(rurl, self.cache10)
+                self.pkg("refresh")
+                self.pkg("list -afH cache")
+                self.assertEqual(os.stat(ibase).st_mtime, 0)
+                self.pkgrepo("remove -s {0} cache".format(rurl))
+                self.pkg("refresh")
+                self.pkg("list -afH cache", exit=1)
+                self.assertEqual(os.stat(ibase).st_mtime, 0)
+
+                # New packages make installed ones upgradable.
+                self.pkgsend_bulk(rurl, (self.foo11, self.foo12))
+                self.pkg("refresh")
+                self.assertNotEqual(os.stat(ibase).st_mtime, 0)
+                check_full(
+                    "foo 1.2-0 ---\n"
+                    "foo 1.1-0 ---\n"
+                    "foo 1.0-0 i--\n"
+                    "food 1.2-0 i--\n",
+                    "foo 1.0-0 i--\n")
+
+                # Removed packages disappear unless installed; the newest
+                # remaining version determines upgradability.
+                self.pkgrepo("remove -s {0} foo@1.2 food@1.2".format(rurl))
+                self.pkg("refresh")
+                check_full(
+                    "foo 1.1-0 ---\n"
+                    "foo 1.0-0 i--\n"
+                    "food 1.2-0 i--\n",
+                    "foo 1.0-0 i--\n")
+
+                self.pkgrepo("remove -s {0} foo@1.1".format(rurl))
+                self.pkg("refresh")
+                check_full(
+                    "foo 1.0-0 i--\n"
+                    "food 1.2-0 i--\n",
+                    "")
+
         def __gen_expected(self, count):
                 """Generate expected header fields result."""
                 expected = []
@@ -30,6 +30,7 @@ if __name__ == "__main__":
 import pkg5unittest
 
 from pkg.server.query_parser import Query
+import pkg.query_parser as qp
 import os
 import pkg
 import pkg.catalog
@@ -3582,6 +3583,231 @@ publisher\tprefix\t""
                 # publisher will not result in partial failure.
                 self.pkgrepo("contents -s {0} zoo".format(repo_path))
 
+        def test_41_rebuild_file_attrs(self):
+                """Verify that the file attribute index is maintained and that
+                the rebuild-file-attrs subcommand works as expected."""
+
+                repo_path = self.dc.get_repodir()
+                repo_uri = self.dc.get_repo_url()
+                self.pkgsend_bulk(repo_path, self.truck10)
+                fhash = self.fhashes["tmp/truck1"]
+
+                # Verify graceful exit if invalid or incomplete set of
+                # options specified.
+                self.pkgrepo("rebuild-file-attrs", exit=2)
+                self.pkgrepo("rebuild-file-attrs -s {0} operand".format(
+                    repo_path), exit=2)
+                self.pkgrepo("rebuild-file-attrs -s {0} -p nosuchpub".format(
+                    repo_path), exit=1)
+                self.pkgrepo("rebuild-file-attrs -s http://localhost/",
+                    exit=2)
+
+                # Attributes missing from the index are computed and then
+                # recorded.
+                index_path = os.path.join(repo_path, "publisher", "test",
+                    "file_attrs")
+                repo = self.get_repo(repo_path)
+                fpath = repo.file(fhash)
+                expected = misc.compute_compressed_attrs(fhash,
+                    file_path=fpath)
+                self.assertEqual(repo.file_attrs(fhash, pub="test"),
+                    (fpath,) + expected)
+                with open(index_path) as f:
+                        self.assertTrue(fhash in f.read())
+
+                # Recorded attributes are served without reading the file.
+                st = os.stat(fpath)
+                with open(index_path, "a") as f:
+                        f.write("{0} {1} {2} {3} pkg.csize-test=1\n".format(
+                            fhash, st.st_size, int(st.st_mtime),
+                            expected[0]))
+                repo = self.get_repo(repo_path)
+                self.assertEqual(repo.file_attrs(fhash)[1:],
+                    (expected[0], { "pkg.csize-test": "1" }))
+
+                # Once the file has been modified, they're computed again,
+                # even if its size is the same.
+                os.utime(fpath, (st.st_atime, st.st_mtime - 60))
+                self.assertEqual(repo.file_attrs(fhash)[1:], expected)
+
+                # Entries that don't describe the file as stored are ignored.
+                with open(index_path, "w") as f:
+                        f.write("{0} 1 1 1 pkg.content-hash=bogus\n"
+                            "partial".format(fhash))
+                repo = self.get_repo(repo_path)
+                self.assertEqual(repo.file_attrs(fhash)[1:], expected)
+
+                # The index is rewritten once most of its entries have been
+                # superseded.
+                with open(index_path, "w") as f:
+                        for i in range(sr.FILE_ATTRS_MIN_STALE + 1):
+                                f.write("{0} -\n".format(fhash))
+                repo = self.get_repo(repo_path)
+                self.assertEqual(repo.file_attrs(fhash)[1:], expected)
+                with open(index_path) as f:
+                        entries = f.read().splitlines()
+                self.assertEqual(len(entries), 1)
+                self.assertTrue(entries[0].startswith(fhash))
+
+                # Rebuilding the index records every file again.
+                self.pkgrepo("rebuild-file-attrs -s {0}".format(repo_path))
+                with open(index_path) as f:
+                        entries = f.read().splitlines()
+                self.assertEqual(sorted(e.split()[0] for e in entries),
+                    sorted([self.fhashes["tmp/empty"], fhash]))
+                for e in entries:
+                        if e.startswith(fhash):
+                                self.assertEqual(e.split()[3], expected[0])
+
+                # Removing packages discards the entries of removed files.
+                self.pkgrepo("remove -s {0} truck".format(repo_path))
+                repo = self.get_repo(repo_path)
+                self.assertRaises(sr.RepositoryFileNotFoundError,
+                    repo.file_attrs, fhash)
+                self.pkgrepo("rebuild-file-attrs -s {0}".format(repo_path))
+                with open(index_path) as f:
+                        self.assertEqual(f.read(), "")
+
+        def test_42_rebuild_jobs(self):
+                """Verify that rebuilding package data using multiple processes
+                produces the same catalog as a single process."""
+
+                repo_path = self.dc.get_repodir()
+                self.pkgsend_bulk(repo_path, (self.tree10, self.amber10,
+                    self.amber20, self.amber30, self.amber40, self.truck10,
+                    self.truck20, self.zoo10, self.refuse10))
+
+                # Verify graceful exit for invalid job counts or for a
+                # network repository.
+                for jobs in ("0", "-1", "bogus"):
+                        self.pkgrepo("rebuild -s {0} --jobs {1}".format(
+                            repo_path, jobs), exit=2)
+                self.pkgrepo("rebuild -s http://localhost/ --jobs 2", exit=2)
+
+                # Add a corrupt manifest; it should be skipped either way.
+                mdir = os.path.join(repo_path, "publisher", "test", "pkg",
+                    "zoo")
+                with open(os.path.join(mdir, "2.0%2C5.11-0%3A20110804T203458Z"),
+                    "w") as f:
+                        f.write("bogus action\n")
+
+                def get_parts():
+                        cat_root = os.path.join(repo_path, "publisher", "test",
+                            "catalog")
+                        parts = {}
+                        for name in os.listdir(cat_root):
+                                if not name.startswith("catalog.") or \
+                                    name == "catalog.attrs":
+                                        continue
+                                with open(os.path.join(cat_root, name)) as f:
+                                        parts[name] = json.load(f)
+                        return parts
+
+                self.pkgrepo("rebuild -s {0} --jobs 1".format(repo_path))
+                expected = get_parts()
+                self.assertTrue("zoo" in expected["catalog.base.C"]["test"])
+                self.assertEqual(len(
+                    expected["catalog.base.C"]["test"]["zoo"]), 1)
+
+                self.pkgrepo("rebuild -s {0} --jobs 3".format(repo_path))
+                self.assertEqualDiff(expected, get_parts())
+
+        def test_43_verify_ledger(self):
+                """Verify that files which haven't changed since they were
+                last verified are only hashed again if --full is used, and that
+                verifying using multiple threads finds the same errors."""
+
+                repo_path = self.dc.get_repodir()
+                ta_dir = os.path.join(self.test_root, "ta_dir")
+                os.mkdir(ta_dir)
+                self.pkgrepo("-s {0} set repository/trust-anchor-directory="
+                    "{1}".format(repo_path, ta_dir))
+
+                # Verify graceful exit for invalid job counts.
+                for jobs in ("0", "-1", "bogus"):
+                        self.pkgrepo("verify -s {0} --jobs {1}".format(
+                            repo_path, jobs), exit=2)
+
+                # Dependencies aren't the subject of this test.
+                verify = "verify -s {0} --disable dependency".format(repo_path)
+
+                self.pkgsend_bulk(repo_path, (self.tree10, self.truck10))
+                self.pkgrepo(verify)
+                fpath = self.__get_file_path("tmp/truck1")
+                ledger = os.path.join(repo_path, "publisher", "test",
+                    "verify_ledger")
+                with open(ledger) as f:
+                        fnames = [l.split()[0] for l in f]
+                self.assertTrue(os.path.basename(fpath) in fnames)
+
+                # Give a file a known modification time; it is hashed again
+                # since it changed.
+                os.utime(fpath, (1000000000, 1000000000))
+                self.pkgrepo(verify)
+
+                # Corrupt the file without changing its size or modification
+                # time; only a full verification should notice.
+                with open(fpath, "r+b") as f:
+                        data = bytearray(f.read())
+                        data[len(data) // 2] ^= 0xff
+                        f.seek(0)
+                        f.write(data)
+                os.utime(fpath, (1000000000, 1000000000))
+                self.pkgrepo(verify)
+                self.pkgrepo(verify + " --full", exit=1)
+                self.assertTrue(fpath in self.output)
+
+                # The file is no longer considered valid, so it is always
+                # hashed now, and the results don't depend on the number of
+                # threads used.
+                self.pkgrepo(verify + " --jobs 1", exit=1)
+                expected = self.output
+                self.assertTrue(fpath in expected)
+                self.pkgrepo(verify + " --jobs 4", exit=1)
+                self.assertEqualDiff(expected, self.output)
+
+                self.__repair_badhash("tmp/truck1")
+                self.pkgrepo(verify + " --jobs 4")
+
+        def test_44_search_cache(self):
+                """Verify that repeated queries return the same results, and
+                that those results reflect changes to the search index."""
+
+                repo_path = self.dc.get_repodir()
+                self.pkgsend_bulk(repo_path, (self.tree10,))
+                self.pkgrepo("refresh -s {0} --no-catalog".format(repo_path))
+                repo = self.get_repo(repo_path)
+
+                def search(text):
+                        query = Query(text, False, Query.RETURN_PACKAGES, None,
+                            None)
+                        return sorted(
+                            (v, rt, str(vals))
+                            for v, rt, vals in repo.search([query])[0]
+                        )
+
+                expected = search("tree")
+                self.assertTrue(expected)
+                self.assertEqualDiff(expected, search("tree"))
+                self.assertEqual([], search("Millenia"))
+
+                # Invalid queries must still be rejected each time.
+                for i in range(2):
+                        self.assertRaises(sr.RepositoryError, repo.search,
+                            ["bogus"])
+                        self.assertRaises(qp.ParseError, search, "AND")
+
+                # Publish a package that mentions the same term using a
+                # separate process; the cached results must be discarded.
+                self.pkgsend_bulk(repo_path, (self.amber10,))
+                self.pkgrepo("refresh -s {0} --no-catalog".format(repo_path))
+                self.assertEqual(1, len(search("Millenia")))
+                self.assertTrue(len(search("tree")) > len(expected))
+
+                # Rebuilding the index in this process discards them as well.
+                repo.rebuild(build_catalog=False, build_index=True)
+                self.assertEqual(1, len(search("Millenia")))
+
 
 class TestPkgrepoMultiRepo(pkg5unittest.ManyDepotTestCase):
         # Only start/stop the depot once (instead of for every test)
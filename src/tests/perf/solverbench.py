@@ -0,0 +1,200 @@
+#!/usr/bin/python2.7
+#
+# CDDL HEADER START
+#
+# The contents of this file are subject to the terms of the
+# Common Development and Distribution License (the "License").
+# You may not use this file except in compliance with the License.
+#
+# You can obtain a copy of the license at usr/src/OPENSOLARIS.LICENSE
+# or http://www.opensolaris.org/os/licensing.
+# See the License for the specific language governing permissions
+# and limitations under the License.
+#
+# When distributing Covered Code, include this CDDL HEADER in each
+# file and include the License file at usr/src/OPENSOLARIS.LICENSE.
+# If applicable, add the following below this CDDL HEADER, with the
+# fields enclosed by brackets "[]" replaced with your own identifying
+# information: Portions Copyright [yyyy] [name of copyright owner]
+#
+# CDDL HEADER END
+#
+
+#
+# Copyright (c) 2017, Oracle and/or its affiliates. All rights reserved.
+#
+
+#
+# solverbench - benchmark package solver operations against a generated
+# catalog, reporting the time taken and the number of SAT solver calls
+#
+# usage: solverbench.py [stems [versions [repeat]]]
+#
+
+from __future__ import division
+from __future__ import print_function
+
+import gettext
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+gettext.install("pkg")
+
+import pkg.client.api
+import pkg.catalog as catalog
+import pkg.client.pkg_solver as pkg_solver
+import pkg.client.progress as progress
+import pkg.fmri as fmri
+import pkg.manifest as manifest
+import pkg.solver
+
+class CountingSolver(object):
+        """Wraps a SAT solver instance, counting the calls made to it by the
+        package solver."""
+
+        calls = {}
+        msat_solver = pkg.solver.msat_solver
+
+        def __init__(self, *args):
+                args = [getattr(a, "_solver", a) for a in args]
+                self._solver = self.msat_solver(*args)
+
+        def __getattr__(self, name):
+                func = getattr(self._solver, name)
+
+                def counted(*args, **kwargs):
+                        self.calls[name] = self.calls.get(name, 0) + 1
+                        if name == "add_clause":
+                                self.calls["clauses"] = \
+                                    self.calls.get("clauses", 0) + 1
+                        elif name == "add_clauses":
+                                # each clause is terminated by 0
+                                self.calls["clauses"] = \
+                                    self.calls.get("clauses", 0) + \
+                                    args[0].count(0)
+                        return func(*args, **kwargs)
+                return counted
+
+pkg.solver.msat_solver = CountingSolver
+
+PUB = "test"
+TS = "20160101T{0:02d}0000Z"
+
+def gen_catalog(meta_root, nstems, nvers):
+        """Create a catalog of 'nstems' packages with 'nvers' versions each;
+        every version depends on three other packages at the previous version
+        and an incorporation constrains each set of versions."""
+
+        random.seed(1)
+        c = catalog.Catalog(meta_root=meta_root, batch_mode=True, sign=False)
+        for v in range(nvers):
+                for i in range(nstems):
+                        lines = ["set name=variant.arch value=i386 "
+                            "value=sparc"]
+                        for d in random.sample(range(nstems), 3):
+                                if d == i:
+                                        continue
+                                lines.append("depend type=require "
+                                    "fmri=pkg:/p{0:d}@1.{1:d}".format(d,
+                                    max(0, v - 1)))
+                        m = manifest.Manifest()
+                        m.set_content("\n".join(lines) + "\n")
+                        c.add_package(fmri.PkgFmri(
+                            "pkg://{0}/p{1:d}@1.{2:d},5.11-0:{3}".format(PUB,
+                            i, v, TS.format(v))), manifest=m)
+
+                m = manifest.Manifest()
+                m.set_content("\n".join(
+                    "depend type=incorporate fmri=pkg:/p{0:d}@1.{1:d}".format(
+                    i, v)
+                    for i in range(nstems)) + "\n")
+                c.add_package(fmri.PkgFmri(
+                    "pkg://{0}/incorp@1.{1:d},5.11-0:{2}".format(PUB, v,
+                    TS.format(v))), manifest=m)
+
+                m = manifest.Manifest()
+                m.set_content("\n".join(
+                    "depend type=require fmri=pkg:/p{0:d}@1.{1:d}".format(
+                    i, v)
+                    for i in range(0, nstems, 2)) + "\n")
+                c.add_package(fmri.PkgFmri(
+                    "pkg://{0}/top@1.{1:d},5.11-0:{2}".format(PUB, v,
+                    TS.format(v))), manifest=m)
+        c.finalize()
+        c.save()
+
+def get_solver(meta_root, nstems, incorp):
+        """Return a solver for an image with version 1.0 of every package
+        installed."""
+
+        cat = catalog.Catalog(meta_root=meta_root, read_only=True)
+        installed = dict(
+            ("p{0:d}".format(i), fmri.PkgFmri(
+            "pkg://{0}/p{1:d}@1.0,5.11-0:{2}".format(PUB, i, TS.format(0))))
+            for i in range(nstems)
+        )
+        if incorp:
+                installed["incorp"] = fmri.PkgFmri(
+                    "pkg://{0}/incorp@1.0,5.11-0:{1}".format(PUB,
+                    TS.format(0)))
+        return pkg_solver.PkgSolver(cat, installed,
+            { PUB: (1, True, True) }, { "variant.arch": "i386" }, set(), None,
+            progress.NullProgressTracker())
+
+def bench_update_all(meta_root, nstems, nvers, incorp):
+        s = get_solver(meta_root, nstems, incorp)
+        s.solve_update_all([], excludes=[])
+
+def bench_install(meta_root, nstems, nvers, incorp):
+        s = get_solver(meta_root, nstems, incorp)
+        proposed = {}
+        for stem in ("top", "incorp"):
+                if stem == "incorp" and not incorp:
+                        continue
+                proposed[stem] = [fmri.PkgFmri(
+                    "pkg://{0}/{1}@1.{2:d},5.11-0:{3}".format(PUB, stem,
+                    nvers - 1, TS.format(nvers - 1)))]
+        s.solve_install([], proposed, excludes=[])
+
+benches = [
+        [ "update all (incorporation)", bench_update_all, True ],
+        [ "update all", bench_update_all, False ],
+        [ "install (incorporation)", bench_install, True ],
+        [ "install", bench_install, False ],
+]
+
+if __name__ == "__main__":
+        nstems = 400
+        nvers = 6
+        repeat = 3
+        if len(sys.argv) > 1:
+                nstems = int(sys.argv[1])
+        if len(sys.argv) > 2:
+                nvers = int(sys.argv[2])
+        if len(sys.argv) > 3:
+                repeat = int(sys.argv[3])
+
+        meta_root = tempfile.mkdtemp(prefix="solverbench.")
+        try:
+                gen_catalog(meta_root, nstems, nvers)
+                print("{0:d} packages, {1:d} versions".format(nstems, nvers))
+                for name, func, incorp in benches:
+                        best = None
+                        for i in range(repeat):
+                                CountingSolver.calls.clear()
+                                t = time.time()
+                                func(meta_root, nstems, nvers, incorp)
+                                t = time.time() - t
+                                if best is None or t < best:
+                                        best = t
+                        print("{0:>12f} {1:>6d} solves {2:>8d} clauses  "
+                            "{3}".format(best,
+                            CountingSolver.calls.get("solve", 0),
+                            CountingSolver.calls.get("clauses", 0), name))
+        except KeyboardInterrupt:
+                sys.exit(0)
+        finally:
+                shutil.rmtree(meta_root)
@@ -232,9 +232,12 @@ for repo_prefix in repo_prefixes:
 
 # These location matches are based on the final Rewrite paths for file,
 # manifest, catalog and publisher responses.
+# File content is served as-is, so byte range requests from clients
+# resuming an interrupted download can always be satisfied.
 <LocationMatch ".*/file/../[a-zA-Z0-9]+$">
         Header set Cache-Control "must-revalidate, no-transform, max-age=31536000"
         Header set Content-Type application/data
+        Header set Accept-Ranges bytes
 </LocationMatch>
 <LocationMatch ".*/publisher/.*/pkg/.*">
         Header set Cache-Control "must-revalidate, no-transform, max-age=31536000"
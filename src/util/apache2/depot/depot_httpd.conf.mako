@@ -416,6 +416,10 @@ CacheEnable disk /${root}${repo_prefix}${pub}/manifest
         context.write("RewriteRule ^/{root}{repo_prefix}{pub}/p5i/(.*)$ "
             "{root}/depot/{repo_prefix}{pub}/p5i/$1 [NE,PT]\n".format(
             **locals()))
+        # files responses
+        context.write("RewriteRule ^/{root}{repo_prefix}{pub}/files/(.*)$ "
+            "{root}/depot/{repo_prefix}{pub}/files/$1 [NE,PT]\n".format(
+            **locals()))
         # Deal with languages - any two letter language code.
         context.write("RewriteRule ^/{root}{repo_prefix}{pub}/([a-z][a-z])/(.*)$ "
             "{root}/depot/{repo_prefix}{pub}/$1/$2 [NE,PT]\n".format(
@@ -463,6 +467,10 @@ RewriteRule ^${sroot}/repos.shtml$ ${sroot}/depot/repos.shtml [NE,PT]
                 context.write("RewriteRule ^/{root}{repo_prefix}p5i/(.*)$ "
                     "{root}/depot/{repo_prefix}{pub}/p5i/$1 [NE,PT]\n"
                    .format(**locals()))
+                # files
+                context.write("RewriteRule ^/{root}{repo_prefix}files/(.*)$ "
+                    "{root}/depot/{repo_prefix}{pub}/files/$1 [NE,PT]\n"
+                   .format(**locals()))
                 # Deal with languages - any two-letter language code.
                 context.write("RewriteRule ^/{root}{repo_prefix}([a-z][a-z])/(.*)$ "
                         "{root}/depot/{repo_prefix}{pub}/$1/$2 [NE,PT]\n".format(
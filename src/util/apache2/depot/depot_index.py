@@ -249,10 +249,10 @@ class DepotBUI(object):
 
 
 class WsgiDepot(object):
-        """A WSGI application object that allows us to process search/1 and
-        certain admin/0 requests from pkg(7) clients of the depot.  Other
-        requests for BUI content are dealt with by instances of DepotHTTP, which
-        are created as necessary.
+        """A WSGI application object that allows us to process search/1,
+        files/0 and certain admin/0 requests from pkg(7) clients of the
+        depot.  Other requests for BUI content are dealt with by instances of
+        DepotHTTP, which are created as necessary.
 
         In the server-side WSGI environment, apart from the default WSGI
         values, defined in PEP333, we expect the following:
@@ -580,6 +580,15 @@ class WsgiDepot(object):
                 headers["Content-Type"] = pkg.p5i.MIME_TYPE
                 return dh.p5i_0(*tokens[3:])
 
+        def files(self, *tokens):
+                """Use a DepotHTTP to return a files/0 response.  The
+                hashes in the request body are checked by files_0(), which
+                answers anything other than a file hash with a 400 error;
+                that HTTPError is passed through by Pkg5Dispatch."""
+
+                dh = self.__build_depot_http()
+                return dh.files_0()
+
         def search_1(self, *tokens, **params):
                 """Use a DepotHTTP to return a search/1 response."""
 
@@ -763,6 +772,15 @@ class Pkg5Dispatch(object):
                         elif "/p5i/0/" in path_info:
                                 cherrypy.response.body = self.app.p5i(*toks,
                                     **params)
+                        elif "/files/0" in path_info:
+                                # files_0() reads the request body itself,
+                                # and as it's called here, before CherryPy
+                                # would process the body, its _cp_config
+                                # doesn't apply; make sure CherryPy doesn't
+                                # try to read the body again afterwards.
+                                request.process_request_body = False
+                                cherrypy.response.stream = True
+                                cherrypy.response.body = self.app.files(*toks)
                         elif "/admin/0" in path_info:
                                 cherrypy.response.body = self.app.admin(*toks,
                                     **params)